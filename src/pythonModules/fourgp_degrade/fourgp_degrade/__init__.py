@@ -5,10 +5,13 @@ import logging
 from numpy import RankWarning
 from warnings import simplefilter
 
-from .convolve import SpectrumConvolver
-from .interpolate import SpectrumInterpolator
+from .convolve import SpectrumConvolver, ConvolutionOperator
+from .degradation import DegradationOperator, DegradationCache
+from .interpolate import SpectrumInterpolator, InterpolationPlan
+from .library_degrader import LibraryDegrader
+from .pipeline import DegradationPipeline, DegradationStage, Redden, Convolve, Resample, Interpolate, AddNoise
 from .gaussian_noise import GaussianNoise
-from .resample import SpectrumResampler
+from .resample import SpectrumResampler, ResamplingOperator
 from .redden import SpectrumReddener
 from .snr_conversion import SNRConverter, SNRValue
 from .spectrum_properties import SpectrumProperties
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 
+import numpy as np
+from scipy import sparse
 from scipy.ndimage.filters import gaussian_filter1d
+from scipy.signal import fftconvolve
 
-from fourgp_speclib import Spectrum
+from fourgp_speclib import Spectrum, SpectrumArray, raster_cache
 
 
 class SpectrumConvolver(object):
@@ -19,12 +22,19 @@ class SpectrumConvolver(object):
         Convolve this spectrum with a Gaussian PSF.
 
         :param sigma:
-            Standard deviation of point spread function in pixels.
+            Standard deviation of point spread function in pixels. This may either be a constant, or an array
+            specifying the width of the PSF at each pixel.
 
         :return:
             New Spectrum object.
         """
 
+        if np.ndim(sigma) > 0:
+            operator = ConvolutionOperator.for_raster(wavelengths=self._input.wavelengths,
+                                                      sigma=sigma,
+                                                      raster_hash=self._input.raster_hash)
+            return operator.apply(self._input)
+
         new_values = gaussian_filter1d(input=self._input.values, sigma=sigma)
 
         output = Spectrum(wavelengths=self._input.wavelengths,
@@ -37,3 +47,323 @@ class SpectrumConvolver(object):
             output.copy_mask_from(self._input)
 
         return output
+
+
+class ConvolutionOperator(object):
+    """
+    The convolution of spectra on a particular wavelength raster with a Gaussian line-spread function, whose width
+    may vary along the raster.
+
+    Where the width of the line-spread function varies, each output pixel is a weighted mean of the input pixels
+    around it, using a Gaussian kernel of the width appropriate to that output pixel. This is a banded linear
+    operator, which we build once for each raster and line-spread function, and apply to many spectra with a single
+    sparse matrix product. Where the width is constant, we convolve using FFTs instead. In both cases, the ends of
+    the spectrum are reflected, as in <scipy.ndimage.gaussian_filter1d>.
+
+    :ivar np.ndarray wavelengths:
+        The wavelength raster of the spectra we convolve.
+
+    :ivar np.ndarray sigma:
+        The standard deviation of the line-spread function in pixels. This is a scalar if the width is constant, or
+        otherwise an array specifying the width at each pixel.
+
+    :ivar float truncate:
+        The number of standard deviations at which the Gaussian kernel is truncated.
+    """
+
+    # Constant kernels whose radius is at least this number of pixels are applied using FFTs rather than sparse
+    # matrices
+    fft_minimum_radius = 24
+
+    def __init__(self, wavelengths, sigma, truncate=4.0, raster_hash=None):
+        """
+        Instantiate a convolution operator. Normally operators should be created using <for_raster> or <for_lsf>.
+
+        :param wavelengths:
+            The wavelength raster of the spectra we convolve.
+
+        :type wavelengths:
+            np.ndarray
+
+        :param sigma:
+            The standard deviation of the line-spread function in pixels. This may either be a constant, or an array
+            specifying the width of the line-spread function at each pixel.
+
+        :type sigma:
+            float or np.ndarray
+
+        :param truncate:
+            The number of standard deviations at which the Gaussian kernel is truncated.
+
+        :type truncate:
+            float
+
+        :param raster_hash:
+            The hash of the wavelength raster, if already known.
+
+        :type raster_hash:
+            str
+        """
+
+        self.wavelengths = np.asarray(wavelengths)
+        self.truncate = float(truncate)
+        self._raster_hash = raster_hash
+
+        sigma = np.asarray(sigma, dtype=np.float64)
+        if sigma.ndim > 0:
+            assert sigma.shape == self.wavelengths.shape, \
+                "Array of line-spread function widths must have the same length as the wavelength raster."
+            if np.all(sigma == sigma[0]):
+                sigma = sigma[0]
+        assert np.all(sigma >= 0), "Line-spread function widths must not be negative."
+
+        self.constant_width = (sigma.ndim == 0)
+        self.sigma = sigma
+        self._sigma_parameter = float(sigma) if self.constant_width else sigma
+        self._matrix = None
+
+    @classmethod
+    def for_raster(cls, wavelengths, sigma, truncate=4.0, raster_hash=None):
+        """
+        Return the operator which convolves spectra on a wavelength raster with a Gaussian line-spread function.
+
+        :param wavelengths:
+            The wavelength raster of the spectra we convolve.
+
+        :type wavelengths:
+            np.ndarray
+
+        :param sigma:
+            The standard deviation of the line-spread function in pixels. This may either be a constant, or an array
+            specifying the width of the line-spread function at each pixel.
+
+        :type sigma:
+            float or np.ndarray
+
+        :param truncate:
+            The number of standard deviations at which the Gaussian kernel is truncated.
+
+        :type truncate:
+            float
+
+        :param raster_hash:
+            The hash of the wavelength raster, if already known.
+
+        :type raster_hash:
+            str
+
+        :return:
+            ConvolutionOperator
+        """
+
+        return cls(wavelengths=wavelengths, sigma=sigma, truncate=truncate, raster_hash=raster_hash)
+
+    @classmethod
+    def for_lsf(cls, wavelengths, fwhm, truncate=4.0, raster_hash=None):
+        """
+        Return the operator which convolves spectra on a wavelength raster with a Gaussian line-spread function,
+        whose full width at half maximum is specified in A.
+
+        :param wavelengths:
+            The wavelength raster of the spectra we convolve.
+
+        :type wavelengths:
+            np.ndarray
+
+        :param fwhm:
+            The FWHM of the line-spread function in A. This may either be a constant, an array specifying the FWHM at
+            each pixel, or a function which returns the FWHM at an array of wavelengths.
+
+        :type fwhm:
+            float, np.ndarray or callable
+
+        :param truncate:
+            The number of standard deviations at which the Gaussian kernel is truncated.
+
+        :type truncate:
+            float
+
+        :param raster_hash:
+            The hash of the wavelength raster, if already known.
+
+        :type raster_hash:
+            str
+
+        :return:
+            ConvolutionOperator
+        """
+
+        wavelengths = np.asarray(wavelengths)
+
+        if callable(fwhm):
+            fwhm = fwhm(wavelengths)
+
+        # Convert the FWHM in A into a standard deviation in pixels, using the local pixel spacing
+        sigma_wavelength = np.asarray(fwhm, dtype=np.float64) / (2 * np.sqrt(2 * np.log(2)))
+        sigma = sigma_wavelength / np.gradient(wavelengths)
+
+        return cls(wavelengths=wavelengths, sigma=sigma, truncate=truncate, raster_hash=raster_hash)
+
+    @staticmethod
+    def _reflect_indices(indices, length):
+        """
+        Map pixel indices beyond the ends of a spectrum back onto the spectrum, reflecting about its edges in the
+        same way as the "reflect" mode of <scipy.ndimage>: (d c b a | a b c d | d c b a).
+
+        :param indices:
+            Array of pixel indices, which may lie outside the range [0, length).
+
+        :param length:
+            The number of pixels in the spectrum.
+
+        :return:
+            Array of pixel indices within the range [0, length).
+        """
+
+        indices = np.mod(indices, 2 * length)
+        return np.where(indices >= length, 2 * length - 1 - indices, indices)
+
+    @classmethod
+    def _build_matrix(cls, wavelengths, sigma, truncate):
+        """
+        Builder for the sparse convolution matrix for a raster, for use by the raster cache.
+
+        :param wavelengths:
+            The wavelength raster of the spectra we convolve.
+
+        :param sigma:
+            The standard deviation of the line-spread function in pixels, either constant or at each pixel.
+
+        :param truncate:
+            The number of standard deviations at which the Gaussian kernel is truncated.
+
+        :return:
+            Dictionary containing the data, indices and indptr arrays of a CSR sparse matrix.
+        """
+
+        length = wavelengths.shape[0]
+        sigma = np.asarray(sigma, dtype=np.float64) * np.ones(length)
+
+        # Radius of the kernel at each pixel, computed in the same way as in <gaussian_filter1d>
+        radius = (truncate * sigma + 0.5).astype(int)
+        max_radius = int(np.max(radius))
+        offsets = np.arange(-max_radius, max_radius + 1)
+
+        # Unnormalised kernel for each output pixel, which is zero beyond that pixel's own radius
+        with np.errstate(divide='ignore', invalid='ignore'):
+            kernel = np.exp(-0.5 * np.square(offsets[np.newaxis, :] / sigma[:, np.newaxis]))
+        kernel[sigma == 0, :] = (offsets == 0)
+        kernel[np.abs(offsets[np.newaxis, :]) > radius[:, np.newaxis]] = 0
+        kernel /= np.sum(kernel, axis=1)[:, np.newaxis]
+
+        rows = np.repeat(np.arange(length), offsets.shape[0])
+        columns = cls._reflect_indices(indices=(np.arange(length)[:, np.newaxis] + offsets).flatten(), length=length)
+
+        # Pixels which are reflected onto the same input pixel more than once are summed
+        matrix = sparse.coo_matrix((kernel.flatten(), (rows, columns)), shape=(length, length)).tocsr()
+        matrix.eliminate_zeros()
+
+        return {
+            "data": matrix.data,
+            "indices": matrix.indices,
+            "indptr": matrix.indptr
+        }
+
+    @property
+    def matrix(self):
+        """
+        Sparse matrix with shape (n_pixels, n_pixels), which maps input spectra onto convolved spectra.
+        """
+
+        if self._matrix is None:
+            item = raster_cache.fetch("convolution_matrix", self.wavelengths, raster_hash=self._raster_hash,
+                                      sigma=self._sigma_parameter, truncate=self.truncate)
+            length = self.wavelengths.shape[0]
+            self._matrix = sparse.csr_matrix((item["data"], item["indices"], item["indptr"]),
+                                             shape=(length, length))
+        return self._matrix
+
+    def _fft_kernel(self):
+        """
+        Return the normalised Gaussian kernel used to convolve spectra when the line-spread function has constant
+        width.
+
+        :return:
+            1D numpy array
+        """
+
+        sigma = float(self.sigma)
+        radius = int(self.truncate * sigma + 0.5)
+        offsets = np.arange(-radius, radius + 1)
+        kernel = np.exp(-0.5 * np.square(offsets / sigma))
+        return kernel / np.sum(kernel)
+
+    def convolve_values(self, values):
+        """
+        Convolve a 1D array of values, or a 2D array of many spectra, with the line-spread function.
+
+        :param values:
+            Array with shape (n_pixels,) or (n_spectra, n_pixels).
+
+        :type values:
+            np.ndarray
+
+        :return:
+            Array with the same shape as the input.
+        """
+
+        values = np.asarray(values, dtype=np.float64)
+
+        if self.constant_width and int(self.truncate * float(self.sigma) + 0.5) >= self.fft_minimum_radius:
+            kernel = self._fft_kernel()
+            radius = (kernel.shape[0] - 1) // 2
+            pad_width = [(0, 0)] * (values.ndim - 1) + [(radius, radius)]
+            padded = np.pad(values, pad_width=pad_width, mode='symmetric')
+            kernel = kernel.reshape([1] * (values.ndim - 1) + [-1])
+            return fftconvolve(padded, kernel, mode='valid', axes=-1)
+
+        if values.ndim == 1:
+            return self.matrix.dot(values)
+        return self.matrix.dot(values.T).T
+
+    def apply(self, spectra):
+        """
+        Convolve a Spectrum, or every spectrum in a SpectrumArray, with the line-spread function. As in
+        <SpectrumConvolver>, the errors are left unchanged.
+
+        :param spectra:
+            The spectra to convolve. These must be sampled on the wavelength raster of this operator.
+
+        :type spectra:
+            Spectrum or SpectrumArray
+
+        :return:
+            New Spectrum or SpectrumArray object.
+        """
+
+        assert isinstance(spectra, (Spectrum, SpectrumArray)), \
+            "The ConvolutionOperator class can only operate on Spectrum or SpectrumArray objects."
+        assert spectra.wavelengths.shape == self.wavelengths.shape, \
+            "Spectra are not sampled on the wavelength raster of this convolution operator."
+
+        new_values = self.convolve_values(spectra.values)
+
+        if isinstance(spectra, SpectrumArray):
+            return SpectrumArray(wavelengths=spectra.wavelengths,
+                                 values=new_values,
+                                 value_errors=spectra.value_errors.copy(),
+                                 metadata_list=[metadata.copy() for metadata in spectra.metadata_list])
+
+        output = Spectrum(wavelengths=spectra.wavelengths,
+                          values=new_values,
+                          value_errors=spectra.value_errors,
+                          metadata=spectra.metadata.copy()
+                          )
+
+        if spectra.mask_set:
+            output.copy_mask_from(spectra)
+
+        return output
+
+
+raster_cache.register_builder(product="convolution_matrix", builder=ConvolutionOperator._build_matrix)
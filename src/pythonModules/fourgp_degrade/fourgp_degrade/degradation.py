@@ -0,0 +1,473 @@
+# -*- coding: utf-8 -*-
+
+"""
+A class which degrades spectra to the resolution and wavelength raster of an instrument, by convolving them with the
+instrument's line-spread function and then resampling them onto the pixels of each wavelength arm.
+
+Both of these steps are linear, so for each input raster we multiply the convolution and resampling matrices together
+once, and can then degrade any number of spectra with a single sparse matrix product, without ever storing the
+convolved spectrum on the high-resolution input raster.
+"""
+
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from os import path as os_path
+
+import numpy as np
+from scipy import sparse
+
+from fourgp_speclib import Spectrum, SpectrumArray, hash_numpy_array, raster_cache
+from .convolve import ConvolutionOperator
+from .resample import ResamplingOperator
+
+logger = logging.getLogger(__name__)
+
+
+class DegradationOperator(object):
+    """
+    The convolution of spectra with a Gaussian line-spread function, followed by their resampling onto one or more
+    wavelength arms, expressed as a single sparse matrix.
+
+    :ivar np.ndarray input_raster:
+        The wavelength raster of the spectra we degrade.
+
+    :ivar list arm_rasters:
+        List of the wavelength rasters of each of the output arms.
+
+    :ivar np.ndarray output_raster:
+        The wavelength rasters of all of the output arms, concatenated together.
+
+    :ivar scipy.sparse.csr_matrix matrix:
+        Sparse matrix with shape (n_output_pixels, n_input_pixels), which maps input spectra onto degraded spectra.
+    """
+
+    def __init__(self, input_raster, arm_rasters, matrix):
+        """
+        Instantiate a degradation operator from a precomputed matrix. Normally operators should be created using
+        <for_arm> or <for_arms>, which cache the matrices for each input raster.
+
+        :param input_raster:
+            The wavelength raster of the spectra we degrade.
+
+        :type input_raster:
+            np.ndarray
+
+        :param arm_rasters:
+            List of the wavelength rasters of each of the output arms.
+
+        :type arm_rasters:
+            list of np.ndarray
+
+        :param matrix:
+            Sparse matrix with shape (n_output_pixels, n_input_pixels).
+
+        :type matrix:
+            scipy.sparse.csr_matrix
+        """
+
+        self.input_raster = input_raster
+        self.arm_rasters = arm_rasters
+        self.output_raster = np.concatenate(arm_rasters)
+        self.matrix = matrix
+
+        # The index of the first pixel of each arm within the output raster, with a final entry for the end
+        self.arm_boundaries = np.cumsum([0] + [len(raster) for raster in arm_rasters])
+
+    @staticmethod
+    def _build_matrix(input_raster, output_raster, sigma):
+        """
+        Builder for the matrix which degrades spectra onto a single wavelength arm, for use by the raster cache.
+
+        :param input_raster:
+            The wavelength raster of the spectra we degrade.
+
+        :param output_raster:
+            The wavelength raster of the output arm.
+
+        :param sigma:
+            The standard deviation of the line-spread function in pixels of the input raster, either constant or at
+            each input pixel.
+
+        :return:
+            Dictionary containing the data, indices and indptr arrays of a CSR sparse matrix.
+        """
+
+        convolution = ConvolutionOperator.for_raster(wavelengths=input_raster, sigma=sigma)
+        resampling = ResamplingOperator.for_rasters(input_raster=input_raster, output_raster=output_raster)
+
+        matrix = resampling.matrix.dot(convolution.matrix).tocsr()
+        matrix.sort_indices()
+
+        return {
+            "data": matrix.data,
+            "indices": matrix.indices,
+            "indptr": matrix.indptr
+        }
+
+    @classmethod
+    def _arm_matrix(cls, input_raster, output_raster, sigma, input_raster_hash=None):
+        """
+        Fetch the matrix which degrades spectra onto a single wavelength arm from the raster cache.
+
+        :return:
+            scipy.sparse.csr_matrix
+        """
+
+        output_raster = np.asarray(output_raster)
+        sigma = np.asarray(sigma, dtype=np.float64)
+        sigma = float(sigma) if sigma.ndim == 0 else sigma
+
+        item = raster_cache.fetch("degradation_matrix", input_raster, raster_hash=input_raster_hash,
+                                  output_raster=output_raster, sigma=sigma)
+
+        return sparse.csr_matrix((item["data"], item["indices"], item["indptr"]),
+                                 shape=(output_raster.shape[0], input_raster.shape[0]))
+
+    @classmethod
+    def for_arm(cls, input_raster, output_raster, sigma, input_raster_hash=None):
+        """
+        Return the operator which convolves spectra on an input raster with a Gaussian line-spread function, and
+        then resamples them onto the raster of a single wavelength arm.
+
+        :param input_raster:
+            The wavelength raster of the spectra we degrade.
+
+        :type input_raster:
+            np.ndarray
+
+        :param output_raster:
+            The wavelength raster of the output arm.
+
+        :type output_raster:
+            np.ndarray
+
+        :param sigma:
+            The standard deviation of the line-spread function in pixels of the input raster. This may either be a
+            constant, or an array specifying the width of the line-spread function at each input pixel.
+
+        :type sigma:
+            float or np.ndarray
+
+        :param input_raster_hash:
+            The hash of the input raster, if already known.
+
+        :type input_raster_hash:
+            str
+
+        :return:
+            DegradationOperator
+        """
+
+        return cls.for_arms(input_raster=input_raster,
+                            wavelength_arms=[(output_raster, sigma)],
+                            input_raster_hash=input_raster_hash)
+
+    @classmethod
+    def for_arms(cls, input_raster, wavelength_arms, input_raster_hash=None):
+        """
+        Return the operator which degrades spectra on an input raster onto several wavelength arms, each with its
+        own line-spread function. The degraded arms are concatenated together into a single output raster.
+
+        :param input_raster:
+            The wavelength raster of the spectra we degrade.
+
+        :type input_raster:
+            np.ndarray
+
+        :param wavelength_arms:
+            List of [arm raster, sigma] for each wavelength arm, where sigma is the standard deviation of the
+            line-spread function of that arm, in pixels of the input raster. This is the format returned by
+            <SpectrumProperties.wavelength_arms>.
+
+        :type wavelength_arms:
+            list
+
+        :param input_raster_hash:
+            The hash of the input raster, if already known.
+
+        :type input_raster_hash:
+            str
+
+        :return:
+            DegradationOperator
+        """
+
+        input_raster = np.asarray(input_raster)
+
+        arm_rasters = [np.asarray(raster) for raster, sigma in wavelength_arms]
+        matrices = [cls._arm_matrix(input_raster=input_raster,
+                                    output_raster=raster,
+                                    sigma=sigma,
+                                    input_raster_hash=input_raster_hash)
+                    for raster, sigma in wavelength_arms]
+
+        matrix = matrices[0] if len(matrices) == 1 else sparse.vstack(matrices, format='csr')
+
+        return cls(input_raster=input_raster, arm_rasters=arm_rasters, matrix=matrix)
+
+    def degrade_values(self, values):
+        """
+        Degrade a 1D array of values, or a 2D array of many spectra, onto the output raster.
+
+        :param values:
+            Array with shape (n_input_pixels,) or (n_spectra, n_input_pixels).
+
+        :type values:
+            np.ndarray
+
+        :return:
+            Array with shape (n_output_pixels,) or (n_spectra, n_output_pixels).
+        """
+
+        values = np.asarray(values, dtype=np.float64)
+        if values.ndim == 1:
+            return self.matrix.dot(values)
+        return self.matrix.dot(values.T).T
+
+    def arm_values(self, values, index_arm):
+        """
+        Extract the pixels of a single wavelength arm from spectra on the output raster.
+
+        :param values:
+            Array with shape (n_output_pixels,) or (n_spectra, n_output_pixels).
+
+        :param index_arm:
+            The number of the wavelength arm to extract.
+
+        :return:
+            View into the input array, containing only the pixels of the requested arm.
+        """
+
+        return values[..., self.arm_boundaries[index_arm]:self.arm_boundaries[index_arm + 1]]
+
+    def apply(self, spectra):
+        """
+        Degrade a Spectrum, or every spectrum in a SpectrumArray, onto the output raster. As in <SpectrumResampler>,
+        the errors are degraded in the same way as the values.
+
+        :param spectra:
+            The spectra to degrade. These must be sampled on the input raster of this operator.
+
+        :type spectra:
+            Spectrum or SpectrumArray
+
+        :return:
+            New Spectrum or SpectrumArray object.
+        """
+
+        assert isinstance(spectra, (Spectrum, SpectrumArray)), \
+            "The DegradationOperator class can only operate on Spectrum or SpectrumArray objects."
+        assert spectra.wavelengths.shape == self.input_raster.shape, \
+            "Spectra are not sampled on the input raster of this degradation operator."
+
+        new_values = self.degrade_values(spectra.values)
+        new_value_errors = self.degrade_values(spectra.value_errors)
+
+        if isinstance(spectra, SpectrumArray):
+            return SpectrumArray(wavelengths=self.output_raster,
+                                 values=new_values,
+                                 value_errors=new_value_errors,
+                                 metadata_list=[metadata.copy() for metadata in spectra.metadata_list])
+
+        return Spectrum(wavelengths=self.output_raster,
+                        values=new_values,
+                        value_errors=new_value_errors,
+                        metadata=spectra.metadata.copy())
+
+
+class DegradationCache(object):
+    """
+    A cache of noiseless degraded spectra, indexed by the uid of the source object, a hash of its input values, and a
+    hash of the degradation recipe which produced them. Including the input values in the key means that a spectrum
+    is degraded afresh if its source library is regenerated with different values but the same uids.
+
+    Convolving and resampling input spectra is the expensive part of degrading them, but it does not depend on the
+    SNRs we add noise at, or on how SNR is defined. Caching its output means that noise can be added at new SNRs
+    without repeating it. Items are held in memory, and can optionally be saved to disk so that they are reused by
+    later processes.
+
+    :ivar str cache_directory:
+        The directory in which degraded spectra are saved to disk, or None to keep them only in memory.
+
+    :ivar int max_items:
+        The maximum number of degraded spectra to keep in memory.
+    """
+
+    def __init__(self, cache_directory=None, max_items=1024):
+        """
+        Instantiate a new cache of degraded spectra.
+
+        :param cache_directory:
+            The directory in which degraded spectra are saved to disk, or None to keep them only in memory. This is
+            created if it does not already exist.
+
+        :type cache_directory:
+            str
+
+        :param max_items:
+            The maximum number of degraded spectra to keep in memory.
+
+        :type max_items:
+            int
+        """
+
+        if cache_directory is not None and not os_path.exists(cache_directory):
+            os.makedirs(cache_directory)
+
+        self.cache_directory = cache_directory
+        self.max_items = max_items
+        self._items = OrderedDict()
+
+    def __getstate__(self):
+        # Don't send the contents of the cache in memory when this object is passed to another process
+        state = self.__dict__.copy()
+        state['_items'] = OrderedDict()
+        return state
+
+    @staticmethod
+    def recipe_hash(*items):
+        """
+        Produce a string hash of a degradation recipe, described by any number of items. Numpy arrays are
+        represented by their hashes.
+
+        :return:
+            String hash
+        """
+
+        items = [(item.shape, str(item.dtype), hash_numpy_array(np.ascontiguousarray(item)))
+                 if isinstance(item, np.ndarray) else item
+                 for item in items]
+        return hashlib.sha1(repr(items).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def values_hash(values):
+        """
+        Produce a string hash of the input values of a spectrum, or of a stack of spectra, which are to be degraded.
+
+        :param values:
+            Numpy array of input values.
+
+        :type values:
+            np.ndarray
+
+        :return:
+            String hash
+        """
+
+        values = np.ascontiguousarray(values)
+        return hashlib.sha1(repr((values.shape, str(values.dtype),
+                                  hash_numpy_array(values))).encode('utf-8')).hexdigest()
+
+    def _filename(self, uid, values_hash, recipe_hash):
+        """
+        Return the filename used to save a degraded spectrum to disk.
+
+        :return:
+            str
+        """
+
+        uid_hash = hashlib.sha1(str(uid).encode('utf-8')).hexdigest()
+        return os_path.join(self.cache_directory, recipe_hash, "{}_{}.npy".format(uid_hash, values_hash))
+
+    def fetch(self, uid, values_hash, recipe_hash):
+        """
+        Fetch a degraded spectrum from the cache.
+
+        :param uid:
+            The uid of the source object.
+
+        :param values_hash:
+            The hash of the input values of the source object, as returned by <values_hash>.
+
+        :type values_hash:
+            str
+
+        :param recipe_hash:
+            The hash of the degradation recipe, as returned by <recipe_hash>.
+
+        :type recipe_hash:
+            str
+
+        :return:
+            Numpy array, or None if this spectrum is not in the cache.
+        """
+
+        key = (uid, values_hash, recipe_hash)
+
+        item = self._items.pop(key, None)
+
+        if item is None and self.cache_directory is not None:
+            filename = self._filename(uid=uid, values_hash=values_hash, recipe_hash=recipe_hash)
+            if os_path.exists(filename):
+                try:
+                    item = np.load(filename)
+                except (IOError, ValueError):
+                    logger.warning("Could not read cached degraded spectrum <{}>".format(filename))
+
+        if item is not None:
+            self._remember(key=key, item=item)
+
+        return item
+
+    def store(self, uid, values_hash, recipe_hash, item):
+        """
+        Store a degraded spectrum in the cache.
+
+        :param uid:
+            The uid of the source object.
+
+        :param values_hash:
+            The hash of the input values of the source object, as returned by <values_hash>.
+
+        :type values_hash:
+            str
+
+        :param recipe_hash:
+            The hash of the degradation recipe, as returned by <recipe_hash>.
+
+        :type recipe_hash:
+            str
+
+        :param item:
+            The degraded spectrum.
+
+        :type item:
+            np.ndarray
+
+        :return:
+            None
+        """
+
+        item = np.array(item)
+        self._remember(key=(uid, values_hash, recipe_hash), item=item)
+
+        if self.cache_directory is not None:
+            filename = self._filename(uid=uid, values_hash=values_hash, recipe_hash=recipe_hash)
+            directory = os_path.dirname(filename)
+            temporary_filename = "{}.{}.tmp".format(filename, os.getpid())
+            try:
+                if not os_path.exists(directory):
+                    os.makedirs(directory, exist_ok=True)
+                with open(temporary_filename, "wb") as f:
+                    np.save(f, item)
+                os.replace(temporary_filename, filename)
+            except (IOError, OSError):
+                logger.warning("Could not write cached degraded spectrum <{}>".format(filename))
+
+    def _remember(self, key, item):
+        """
+        Keep an item in memory, discarding the least recently used items if the cache is full.
+
+        :return:
+            None
+        """
+
+        item.flags.writeable = False
+        self._items[key] = item
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+
+raster_cache.register_builder(product="degradation_matrix", builder=DegradationOperator._build_matrix)
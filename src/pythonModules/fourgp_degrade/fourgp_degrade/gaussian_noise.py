@@ -10,9 +10,8 @@ and we treat each arm separately.
 import numpy as np
 import logging
 
-from fourgp_speclib import Spectrum
-from .convolve import SpectrumConvolver
-from .resample import SpectrumResampler
+from fourgp_speclib import Spectrum, SpectrumArray, raster_cache
+from .degradation import DegradationOperator
 from .spectrum_properties import SpectrumProperties
 
 logger = logging.getLogger(__name__)
@@ -23,7 +22,9 @@ class GaussianNoise:
                  wavelength_raster,
                  snr_list=None,
                  snr_definitions=None,
-                 use_snr_definitions=None
+                 use_snr_definitions=None,
+                 random_seed=None,
+                 degradation_cache=None
                  ):
         """
         Instantiate a class for adding Gaussian noise to spectra.
@@ -40,12 +41,24 @@ class GaussianNoise:
 
         :param use_snr_definitions:
             List of the SNR definitions to use for each wavelength arm.
+
+        :param random_seed:
+            Seed for the random number generator used to synthesise noise, so that the noise added to spectra is
+            reproducible. If None, a fresh seed is drawn from the operating system.
+
+        :param degradation_cache:
+            A cache in which to keep the noiseless degraded version of each input spectrum, indexed by its uid and
+            a hash of its values, so that noise can later be added at different SNRs without convolving and
+            resampling it again.
+
+        :type degradation_cache:
+            DegradationCache
         """
 
         # Divide wavelength raster into spectral arms, which have distinct pixel spacing
         # We convolve each wavelength arm separately
         self.wavelength_arms = SpectrumProperties(wavelength_raster).wavelength_arms()['wavelength_arms']
-        self.wavelength_raster = wavelength_raster
+        self.wavelength_raster = np.asarray(wavelength_raster)
 
         logger.info("Detected {} wavelength arms".format(len(self.wavelength_arms)))
 
@@ -55,6 +68,9 @@ class GaussianNoise:
             snr_list = (10, 12, 14, 16, 18, 20, 23, 26, 30, 35, 40, 45, 50, 80, 100, 130, 180, 250)
         self.snr_list = snr_list
 
+        # Random number generator used to synthesise noise
+        self.set_random_seed(random_seed)
+
         # Read the list of SNR definitions supplied, or default to using a window between 6180 and 6680 A
         if snr_definitions is None:
             snr_definitions = [("MEDIANSNR", 6180, 6680)]
@@ -65,16 +81,200 @@ class GaussianNoise:
         self.snr_definitions = snr_definitions
         self.use_snr_definitions = use_snr_definitions
 
+        # Look up which pixels fall within the wavelength window of each SNR definition
+        self._snr_windows = raster_cache.fetch("snr_windows", self.wavelength_raster,
+                                               snr_definitions=tuple(tuple(i) for i in self.snr_definitions))
+
+        # Operators which convolve and resample input spectra onto our wavelength arms, indexed by input raster hash
+        self._degradation_operators = {}
+
+        # Cache of noiseless degraded spectra, and the hashes of our degradation recipe for each input raster
+        self.degradation_cache = degradation_cache
+        self._recipe_hashes = {}
+
         assert len(self.use_snr_definitions) == len(self.wavelength_arms), \
             "Need an SNR definition for each wavelength arm. " \
             "Received {} definitions, but autodetected {} arms.". \
                 format(len(self.use_snr_definitions), len(self.wavelength_arms))
 
+    def _degradation_operator(self, input_spectrum):
+        """
+        Return the operator which convolves and resamples spectra on the raster of an input spectrum onto all of
+        our wavelength arms. Operators are kept for each distinct input raster.
+
+        :param input_spectrum:
+            A spectrum sampled on the input raster.
+
+        :type input_spectrum:
+            Spectrum
+
+        :return:
+            DegradationOperator
+        """
+
+        raster_hash = input_spectrum.raster_hash
+        if raster_hash not in self._degradation_operators:
+            self._degradation_operators[raster_hash] = DegradationOperator.for_arms(
+                input_raster=input_spectrum.wavelengths,
+                wavelength_arms=self.wavelength_arms,
+                input_raster_hash=raster_hash
+            )
+        return self._degradation_operators[raster_hash]
+
+    def _degrade_noiseless(self, spectrum):
+        """
+        Convolve and resample the flux-normalised and continuum-normalised versions of an input spectrum onto our
+        wavelength raster, without adding noise. If we have a degradation cache, and the input spectrum has a uid,
+        the result is looked up in the cache, or added to it, keyed by the uid and a hash of the input values.
+
+        :param spectrum:
+            Tuple of (input_spectrum, input_spectrum_continuum_normalised).
+
+        :return:
+            Array with shape (2, n_pixels), containing the degraded flux-normalised and continuum-normalised spectra.
+        """
+
+        for item in spectrum:
+            assert item.raster_hash == spectrum[0].raster_hash, \
+                "Flux and continuum-normalised spectra must be sampled on the same wavelength raster."
+
+        uid = spectrum[0].metadata.get('uid', None)
+        use_cache = (self.degradation_cache is not None) and (uid is not None)
+        input_values = np.vstack([item.values for item in spectrum])
+
+        if use_cache:
+            raster_hash = spectrum[0].raster_hash
+            if raster_hash not in self._recipe_hashes:
+                self._recipe_hashes[raster_hash] = self.degradation_cache.recipe_hash(
+                    "GaussianNoise", raster_hash, self.wavelength_raster,
+                    [float(pixel_spacing) for (raster, pixel_spacing) in self.wavelength_arms]
+                )
+            recipe_hash = self._recipe_hashes[raster_hash]
+            values_hash = self.degradation_cache.values_hash(input_values)
+
+            degraded = self.degradation_cache.fetch(uid=uid, values_hash=values_hash, recipe_hash=recipe_hash)
+            if degraded is not None:
+                return degraded
+
+        # Each wavelength arm is separately convolved by mean pixel spacing.
+        degradation = self._degradation_operator(spectrum[0])
+        degraded = degradation.degrade_values(input_values)
+
+        if use_cache:
+            self.degradation_cache.store(uid=uid, values_hash=values_hash, recipe_hash=recipe_hash, item=degraded)
+
+        return degraded
+
+    def set_random_seed(self, random_seed):
+        """
+        Reset the random number generator used to synthesise noise.
+
+        :param random_seed:
+            Seed for the random number generator, or None to draw a fresh seed from the operating system.
+
+        :return:
+            None
+        """
+
+        self._random_generator = np.random.default_rng(random_seed)
+
+    def output_metadata(self, metadata):
+        """
+        Return the metadata of each of the noisy spectra we produce from an input spectrum: first the
+        flux-normalised spectra at each SNR, and then the continuum-normalised spectra at each SNR.
+
+        :param metadata:
+            The metadata of the input spectrum.
+
+        :type metadata:
+            dict
+
+        :return:
+            List of dictionaries
+        """
+
+        metadata_list = []
+        for continuum_normalised in (0, 1):
+            for snr_value in self.snr_list:
+                item = metadata.copy()
+                item['continuum_normalised'] = continuum_normalised
+                item['SNR'] = float(snr_value)
+                metadata_list.append(item)
+        return metadata_list
+
     def close(self):
         # Do cleanup...
         pass
 
-    def process_spectra(self, spectra_list):
+    def noise_cube(self, spectra_list):
+        """
+        Degrade a list of 4GP Spectrum objects onto our wavelength raster, and add Gaussian noise to each of them at
+        each of the SNRs in our list.
+
+        :param spectra_list:
+            A list of the spectra we should degrade. Each entry in the list should be a list of tuple with
+            two entries: (input_spectrum, input_spectrum_continuum_normalised). These reflect the contents of the
+            third and second columns of Turbospectrum's ASCII output respectively.
+
+        :type spectra_list:
+            (list, tuple) of (list, tuple) of Spectrum objects
+
+        :return:
+            Dictionary of arrays with shape (n_spectra, n_snr, n_pixels), containing the noisy flux-normalised spectra
+            ("values"), their errors ("value_errors"), and the corresponding continuum-normalised spectra
+            ("values_cn" and "value_errors_cn").
+        """
+
+        spectrum_count = len(spectra_list)
+        arm_count = len(self.wavelength_arms)
+        snr_values = np.asarray(self.snr_list, dtype=np.float64)
+        pixel_count = len(self.wavelength_raster)
+
+        # Convolve and resample onto new wavelength raster.
+        # Noiseless degraded spectra are reused from the degradation cache where possible.
+        # degraded[ spectrum_number, 0=full spectrum ; 1=continuum normalised, pixel ]
+        degraded = np.empty((spectrum_count, 2, pixel_count))
+        for index, spectrum in enumerate(spectra_list):
+            degraded[index] = self._degrade_noiseless(spectrum)
+
+        # Calculate continuum spectrum by dividing the flux normalised spectrum by continuum normalised spectrum
+        flux = degraded[:, 0, :]
+        continuum = flux / degraded[:, 1, :]
+
+        # Measure the mean signal per pixel within the range of each SNR definition
+        mean_signal_per_pixel = {}
+        for snr_definition_name, wavelength_min, wavelength_max in self.snr_definitions:
+            indices = self._snr_windows[snr_definition_name]
+            mean_signal_per_pixel[snr_definition_name] = np.mean(continuum[:, indices], axis=1)
+
+        # Signal level used to define the SNR of each pixel, based on the SNR definition used in its arm
+        arm_signal = np.empty((spectrum_count, arm_count))
+        for index_arm in range(arm_count):
+            arm_signal[:, index_arm] = mean_signal_per_pixel[self.use_snr_definitions[index_arm]]
+        arm_lengths = [len(raster) for (raster, pixel_spacing) in self.wavelength_arms]
+        pixel_signal = np.repeat(arm_signal, arm_lengths, axis=1)
+
+        # Synthesize Gaussian noise at every SNR at once, and add it into the flux-normalised spectra
+        shape = (spectrum_count, len(snr_values), pixel_count)
+        value_errors = np.empty(shape)
+        np.divide(pixel_signal[:, np.newaxis, :], snr_values[np.newaxis, :, np.newaxis], out=value_errors)
+
+        values = self._random_generator.standard_normal(size=shape)
+        values *= value_errors
+        values += flux[:, np.newaxis, :]
+
+        # Compute the new continuum-normalised spectra by dividing by the pure continuum we computed
+        values_cn = values / continuum[:, np.newaxis, :]
+        value_errors_cn = value_errors / continuum[:, np.newaxis, :]
+
+        return {
+            "values": values,
+            "value_errors": value_errors,
+            "values_cn": values_cn,
+            "value_errors_cn": value_errors_cn
+        }
+
+    def process_spectra(self, spectra_list, output_library=None, origin="GaussianNoise"):
         """
         Add Gaussian noise to a list of 4GP Spectrum objects.
 
@@ -85,91 +285,84 @@ class GaussianNoise:
 
         :type spectra_list:
             (list, tuple) of (list, tuple) of Spectrum objects
+
+        :param output_library:
+            If specified, the noisy spectra are inserted directly into this spectrum library, rather than being
+            returned.
+
+        :type output_library:
+            SpectrumLibrary
+
+        :param origin:
+            The origin to record for spectra inserted into <output_library>.
+
+        :type origin:
+            str
+
+        :return:
+            Nested structure output[ spectrum_number ][ snr ] = [ flux normalised , continuum normalised ], or None
+            if the spectra were inserted into <output_library>.
         """
 
+        cube = self.noise_cube(spectra_list=spectra_list)
+
         output = []  # output[ spectrum_number ][ snr ] = [ full_spectrum, continuum normalised ]
 
-        for spectrum in spectra_list:
-
-            # Convolve and resample onto new wavelength raster.
-            # Each wavelength arm is separately convolved by mean pixel spacing.
-            resampled_spectrum = []  # resampled_spectrum[ 0=full spectrum ; 1=continuum normalised ][ wavelength_arm ]
-            for index, item in enumerate(spectrum):
-                resampled_spectrum.append([])
-                for (raster, pixel_spacing) in self.wavelength_arms:
-                    convolver = SpectrumConvolver(item)
-                    convolved = convolver.gaussian_convolve(pixel_spacing)
-                    resampler = SpectrumResampler(convolved)
-                    resampled = resampler.onto_raster(raster)
-                    resampled_spectrum[-1].append(resampled.values)
-
-            # Calculate continuum spectrum by dividing the flux normalised spectrum by continuum normalised spectrum
-            continuum_per_arm = []
-            for index_arm in range(len(self.wavelength_arms)):
-                continuum_per_arm.append(resampled_spectrum[0][index_arm] / resampled_spectrum[1][index_arm])
-            continuum = np.concatenate(continuum_per_arm)
-
-            # Measure the integrated signal within the range of each SNR definition
-            mean_signal_per_pixel = {}
-            for snr_definition_name, wavelength_min, wavelength_max in self.snr_definitions:
-                indices = (wavelength_min <= self.wavelength_raster) * (self.wavelength_raster <= wavelength_max)
-                pixel_count = np.sum(indices)
-                pixel_sum = np.sum(continuum[indices])
-                mean_signal_per_pixel[snr_definition_name] = pixel_sum / pixel_count
-
-            # Add noise to spectra at each SNR in turn
+        for index, spectrum in enumerate(spectra_list):
+
+            # Metadata for the flux-normalised and continuum-normalised spectra at each SNR
+            metadata_list = self.output_metadata(metadata=spectrum[0].metadata)
+
+            # Insert all of the noisy versions of this spectrum into the output library in one go
+            if output_library is not None:
+                spectra = SpectrumArray(wavelengths=self.wavelength_raster,
+                                        values=np.concatenate([cube['values'][index], cube['values_cn'][index]]),
+                                        value_errors=np.concatenate([cube['value_errors'][index],
+                                                                     cube['value_errors_cn'][index]]),
+                                        metadata_list=metadata_list)
+                output_library.insert(spectra=spectra,
+                                      filenames=[None] * len(metadata_list),
+                                      origin=origin)
+                continue
+
+            # Convert output spectra into Spectrum objects
             output_item = {}
             output.append(output_item)
-            for snr_value in self.snr_list:
-                output_values = np.zeros(0)
-                output_value_errors = np.zeros(0)
-                output_values_cn = np.zeros(0)
-                output_value_errors_cn = np.zeros(0)
-
-                # Add noise to each wavelength arm individually
-                for index_arm, (raster, pixel_spacing) in enumerate(self.wavelength_arms):
-                    snr_definition = self.use_snr_definitions[index_arm]
-                    signal_level = mean_signal_per_pixel[snr_definition]
-                    noise_level = signal_level / snr_value
-                    arm_length = len(raster)
-
-                    # Synthesize some Gaussian noise
-                    noise = np.random.normal(loc=0,
-                                             scale=noise_level,
-                                             size=arm_length)
-
-                    # Add noise into flux-normalised spectrum
-                    noised_signal = resampled_spectrum[0][index_arm] + noise
-                    noised_signal_errors = np.ones_like(noised_signal) * noise_level
-
-                    # Compute the new continuum-normalised spectrum by dividing by the pure continuum we computed
-                    noised_signal_cn = noised_signal / continuum_per_arm[index_arm]
-                    noised_signal_errors_cn = noised_signal_errors / continuum_per_arm[index_arm]
-
-                    # Concatenate the various wavelength arms together
-                    output_values = np.append(output_values, noised_signal)
-                    output_value_errors = np.append(output_value_errors, noised_signal_errors)
-                    output_values_cn = np.append(output_values_cn, noised_signal_cn)
-                    output_value_errors_cn = np.append(output_value_errors_cn, noised_signal_errors_cn)
-
-                # Convert output spectra into Spectrum objects
-                metadata = spectrum[0].metadata.copy()
-                metadata['continuum_normalised'] = 0
-                metadata['SNR'] = float(snr_value)
+            for index_snr, snr_value in enumerate(self.snr_list):
                 output_spectrum = Spectrum(wavelengths=self.wavelength_raster,
-                                           values=output_values,
-                                           value_errors=output_value_errors,
-                                           metadata=metadata.copy())
+                                           values=cube['values'][index, index_snr],
+                                           value_errors=cube['value_errors'][index, index_snr],
+                                           metadata=metadata_list[index_snr])
 
-                metadata['continuum_normalised'] = 1
                 output_spectrum_cn = Spectrum(wavelengths=self.wavelength_raster,
-                                              values=output_values_cn,
-                                              value_errors=output_value_errors_cn,
-                                              metadata=metadata.copy())
+                                              values=cube['values_cn'][index, index_snr],
+                                              value_errors=cube['value_errors_cn'][index, index_snr],
+                                              metadata=metadata_list[len(self.snr_list) + index_snr])
 
                 # Add to output data structure
                 output_item[snr_value] = (output_spectrum, output_spectrum_cn)
 
+        if output_library is not None:
+            return None
+
         # Return output spectra to user
         # output[ spectrum_number ][ snr ] = [ flux normalised , continuum normalised ]
         return output
+
+
+def _build_snr_windows(wavelengths, snr_definitions):
+    """
+    Builder for the pixel masks of the wavelength windows in which SNR is defined, for use by the raster cache.
+
+    :param wavelengths:
+        The wavelength raster of the output spectra.
+    :param snr_definitions:
+        Tuple of SNR definitions, each of the form (name, min, max).
+    :return:
+        Dictionary of a boolean mask for each SNR definition
+    """
+    return dict((name, (wavelength_min <= wavelengths) * (wavelengths <= wavelength_max))
+                for name, wavelength_min, wavelength_max in snr_definitions)
+
+
+raster_cache.register_builder(product="snr_windows", builder=_build_snr_windows)
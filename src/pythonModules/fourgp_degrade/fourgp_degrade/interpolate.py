@@ -2,7 +2,7 @@
 
 import numpy as np
 
-from fourgp_speclib import Spectrum
+from fourgp_speclib import Spectrum, SpectrumArray, raster_cache
 
 
 class SpectrumInterpolator(object):
@@ -11,8 +11,8 @@ class SpectrumInterpolator(object):
     """
 
     def __init__(self, input_spectrum):
-        assert isinstance(input_spectrum,
-                          Spectrum), "The SpectrumInterpolate class can only operate on Spectrum objects."
+        assert isinstance(input_spectrum, (Spectrum, SpectrumArray)), \
+            "The SpectrumInterpolate class can only operate on Spectrum or SpectrumArray objects."
         self._input = input_spectrum
 
     def onto_raster(self, output_raster, interpolate_errors=True, interpolate_mask=True):
@@ -31,20 +31,32 @@ class SpectrumInterpolator(object):
             the function will return 30% quicker.
 
         :return:
-            New Spectrum object.
+            New Spectrum object, or SpectrumArray if this interpolator was instantiated with a SpectrumArray.
         """
 
-        new_values = np.interp(x=output_raster,
-                               xp=self._input.wavelengths,
-                               fp=self._input.values)
+        # A SpectrumArray is interpolated with a cached plan, as the same pair of rasters is likely to be reused.
+        # Single spectra are often Doppler shifted onto unique rasters, so we don't pollute the cache with them.
+        if isinstance(self._input, SpectrumArray):
+            plan = InterpolationPlan.for_rasters(input_raster=self._input.wavelengths,
+                                                 output_raster=output_raster,
+                                                 input_raster_hash=self._input.raster_hash)
+        else:
+            plan = InterpolationPlan(input_raster=self._input.wavelengths,
+                                     output_raster=output_raster)
+
+        new_values = plan.interpolate_values(self._input.values)
 
         if interpolate_errors:
-            new_value_errors = np.interp(x=output_raster,
-                                         xp=self._input.wavelengths,
-                                         fp=self._input.value_errors)
+            new_value_errors = plan.interpolate_values(self._input.value_errors)
         else:
             new_value_errors = np.zeros_like(new_values)
 
+        if isinstance(self._input, SpectrumArray):
+            return SpectrumArray(wavelengths=plan.output_raster,
+                                 values=new_values,
+                                 value_errors=new_value_errors,
+                                 metadata_list=[metadata.copy() for metadata in self._input.metadata_list])
+
         output = Spectrum(wavelengths=output_raster,
                           values=new_values,
                           value_errors=new_value_errors,
@@ -52,9 +64,7 @@ class SpectrumInterpolator(object):
                           )
 
         if interpolate_mask and self._input.mask_set:
-            output.mask = np.interp(x=output_raster,
-                                    xp=self._input.wavelengths,
-                                    fp=self._input.mask) > 0.5
+            output.mask = plan.interpolate_mask(self._input.mask)
             output.mask_set = not np.all(output.mask)
 
         return output
@@ -81,3 +91,182 @@ class SpectrumInterpolator(object):
         return self.onto_raster(output_raster=other.wavelengths,
                                 interpolate_errors=interpolate_errors,
                                 interpolate_mask=interpolate_mask)
+
+
+class InterpolationPlan(object):
+    """
+    The linear interpolation of spectra from one wavelength raster onto another, precomputed as the indices of the
+    pair of input pixels which bracket each output wavelength, and the weight given to the upper pixel of each pair.
+    As with <np.interp>, output wavelengths beyond the ends of the input raster take the value of the nearest end.
+
+    :ivar np.ndarray input_raster:
+        The wavelength raster of the spectra we interpolate.
+
+    :ivar np.ndarray output_raster:
+        The wavelength raster we interpolate spectra onto.
+
+    :ivar np.ndarray lower_indices:
+        The index of the input pixel below each output wavelength.
+
+    :ivar np.ndarray weights:
+        The weight given to the input pixel above each output wavelength.
+    """
+
+    def __init__(self, input_raster, output_raster, lower_indices=None, weights=None):
+        """
+        Instantiate an interpolation plan. If the indices and weights are not supplied, they are computed. To reuse
+        plans between many spectra, use <for_rasters>, which caches them for each pair of rasters.
+
+        :param input_raster:
+            The wavelength raster of the spectra we interpolate. This must be in increasing order, but may repeat
+            wavelengths.
+
+        :type input_raster:
+            np.ndarray
+
+        :param output_raster:
+            The wavelength raster we interpolate spectra onto.
+
+        :type output_raster:
+            np.ndarray
+
+        :param lower_indices:
+            The index of the input pixel below each output wavelength.
+
+        :type lower_indices:
+            np.ndarray
+
+        :param weights:
+            The weight given to the input pixel above each output wavelength.
+
+        :type weights:
+            np.ndarray
+        """
+
+        self.input_raster = np.asarray(input_raster)
+        self.output_raster = np.asarray(output_raster)
+
+        if lower_indices is None or weights is None:
+            plan = self._build_plan(input_raster=self.input_raster, output_raster=self.output_raster)
+            lower_indices = plan["lower_indices"]
+            weights = plan["weights"]
+
+        self.lower_indices = lower_indices
+        self.weights = weights
+
+    @classmethod
+    def for_rasters(cls, input_raster, output_raster, input_raster_hash=None):
+        """
+        Return the plan for interpolating spectra from one wavelength raster onto another. Plans are cached for each
+        pair of rasters.
+
+        :param input_raster:
+            The wavelength raster of the spectra we interpolate.
+
+        :type input_raster:
+            np.ndarray
+
+        :param output_raster:
+            The wavelength raster we interpolate spectra onto.
+
+        :type output_raster:
+            np.ndarray
+
+        :param input_raster_hash:
+            The hash of the input raster, if already known.
+
+        :type input_raster_hash:
+            str
+
+        :return:
+            InterpolationPlan
+        """
+
+        input_raster = np.asarray(input_raster)
+        output_raster = np.asarray(output_raster)
+
+        plan = raster_cache.fetch("interpolation_plan", input_raster, raster_hash=input_raster_hash,
+                                  output_raster=output_raster)
+
+        return cls(input_raster=input_raster, output_raster=output_raster,
+                   lower_indices=plan["lower_indices"], weights=plan["weights"])
+
+    @staticmethod
+    def _build_plan(input_raster, output_raster):
+        """
+        Builder for the bracketing indices and weights of an interpolation plan, for use by the raster cache.
+
+        :param input_raster:
+            The wavelength raster of the spectra we interpolate.
+
+        :param output_raster:
+            The wavelength raster we interpolate spectra onto.
+
+        :return:
+            Dictionary containing the lower indices and upper weights.
+        """
+
+        assert input_raster.shape[0] > 1, "Need at least two input pixels to interpolate."
+
+        lower_indices = np.searchsorted(input_raster, output_raster, side='right') - 1
+        lower_indices = np.clip(lower_indices, 0, input_raster.shape[0] - 2)
+
+        lower = input_raster[lower_indices]
+        upper = input_raster[lower_indices + 1]
+
+        # If the raster repeats a wavelength at either end, the bracketing pixels can have zero separation. These
+        # output wavelengths lie beyond the end of the raster, so take the value of the end pixel, as elsewhere.
+        width = upper - lower
+        weights = np.divide(output_raster - lower, width, out=(output_raster >= upper).astype(np.float64),
+                            where=width > 0)
+        weights = np.clip(weights, 0, 1)
+
+        return {
+            "lower_indices": lower_indices,
+            "weights": weights
+        }
+
+    def interpolate_values(self, values):
+        """
+        Interpolate a 1D array of values, or a 2D array of many spectra, onto the output raster.
+
+        :param values:
+            Array with shape (n_input_pixels,) or (n_spectra, n_input_pixels).
+
+        :type values:
+            np.ndarray
+
+        :return:
+            Array with shape (n_output_pixels,) or (n_spectra, n_output_pixels).
+        """
+
+        values = np.asarray(values, dtype=np.float64)
+        lower = np.take(values, self.lower_indices, axis=-1)
+        output = np.take(values, self.lower_indices + 1, axis=-1)
+        output -= lower
+        output *= self.weights
+        output += lower
+        return output
+
+    def interpolate_mask(self, mask):
+        """
+        Interpolate a boolean mask onto the output raster. An output pixel is included if the linearly interpolated
+        mask exceeds one half, i.e. if the nearer of the two bracketing input pixels is included, or both are.
+
+        :param mask:
+            Boolean array with shape (n_input_pixels,) or (n_spectra, n_input_pixels).
+
+        :type mask:
+            np.ndarray
+
+        :return:
+            Boolean array with shape (n_output_pixels,) or (n_spectra, n_output_pixels).
+        """
+
+        mask = np.asarray(mask, dtype=bool)
+        lower = mask[..., self.lower_indices]
+        upper = mask[..., self.lower_indices + 1]
+        return (lower & upper) | (lower & (self.weights < 0.5)) | (upper & (self.weights > 0.5))
+
+
+raster_cache.register_builder(product="interpolation_plan", builder=InterpolationPlan._build_plan, persist=False)
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+
+"""
+A class which degrades every spectrum in a spectrum library with Gaussian noise, using a pool of worker processes, and
+writes the degraded spectra into an output library.
+
+Input spectra are read by the parent process in chunks, and copied into a block of multiprocessing shared memory
+which the workers inherit when the pool is started, so that the high-resolution input spectra are never pickled and
+sent between processes. Inserting spectra into a library is not atomic, so if the process is interrupted, the output
+library may hold only some of the degraded spectra of the last object written. When the process is restarted, it skips
+every object which has all of its degraded spectra in the output library, and deletes the spectra of any object which
+does not, before degrading it again. Noise is seeded separately for each object, so a resumed run adds the same noise
+as an uninterrupted one.
+"""
+
+import logging
+from ctypes import c_double
+from multiprocessing import Pool, cpu_count
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+
+from fourgp_speclib import Spectrum, SpectrumArray
+from .gaussian_noise import GaussianNoise
+
+logger = logging.getLogger(__name__)
+
+# State of each worker process, set up by <_initialise_worker>
+_worker_state = {}
+
+
+def _initialise_worker(recipe, wavelengths_shared, values_shared, spectrum_length):
+    """
+    Set up a worker process, with a GaussianNoise instance built from the degradation recipe, and numpy views into
+    the shared memory which holds the input spectra.
+
+    :return:
+        None
+    """
+
+    _worker_state['noise_model'] = GaussianNoise(**recipe)
+    _worker_state['wavelengths'] = np.frombuffer(wavelengths_shared)
+    _worker_state['values'] = np.frombuffer(values_shared).reshape([-1, 2, spectrum_length])
+
+
+def _degrade_batch(task):
+    """
+    Degrade a batch of spectra held in shared memory. This is a module-level function so that it can be passed to
+    a multiprocessing pool.
+
+    :param task:
+        Tuple of (first index in shared memory, number of spectra, list of the random seed for each spectrum, or
+        None if noise is not reproducible)
+
+    :return:
+        Dictionary of arrays returned by <GaussianNoise.noise_cube>.
+    """
+
+    start, count, random_seeds = task
+
+    noise_model = _worker_state['noise_model']
+    wavelengths = _worker_state['wavelengths']
+    values = _worker_state['values']
+
+    spectra_list = [[Spectrum(wavelengths=wavelengths,
+                              values=values[index, spectrum_type],
+                              value_errors=np.zeros_like(wavelengths))
+                     for spectrum_type in (0, 1)]
+                    for index in range(start, start + count)]
+
+    if random_seeds is None:
+        return noise_model.noise_cube(spectra_list=spectra_list)
+
+    # Draw the noise for each spectrum from its own seed, so that it does not depend on which batch it is in
+    cubes = []
+    for spectra, random_seed in zip(spectra_list, random_seeds):
+        noise_model.set_random_seed(random_seed)
+        cubes.append(noise_model.noise_cube(spectra_list=[spectra]))
+
+    return {key: np.concatenate([cube[key] for cube in cubes]) for key in cubes[0]}
+
+
+class LibraryDegrader(object):
+    """
+    A class which adds Gaussian noise to all of the spectra in a spectrum library matching some search constraints,
+    in parallel, and writes the results into an output library.
+    """
+
+    def __init__(self, input_library, output_library, recipe, search_constraints=None, batch_size=16,
+                 processes=None, uid_field="uid", origin="LibraryDegrader"):
+        """
+        Instantiate a driver for degrading the spectra in a spectrum library.
+
+        :param input_library:
+            The spectrum library containing the spectra to degrade. This should contain both a flux-normalised and a
+            continuum-normalised version of each object, which share the same uid, as produced by Turbospectrum.
+
+        :type input_library:
+            SpectrumLibrary
+
+        :param output_library:
+            The spectrum library into which degraded spectra should be inserted.
+
+        :type output_library:
+            SpectrumLibrary
+
+        :param recipe:
+            Dictionary of keyword arguments used to instantiate <GaussianNoise>, which describe how spectra should be
+            degraded. If this contains a <random_seed>, the noise added to each object is reproducible.
+
+        :type recipe:
+            dict
+
+        :param search_constraints:
+            Dictionary of metadata constraints selecting which spectra in the input library to degrade.
+
+        :type search_constraints:
+            dict
+
+        :param batch_size:
+            The number of objects degraded by each worker task, and inserted into the output library together.
+
+        :type batch_size:
+            int
+
+        :param processes:
+            The number of worker processes to use. If None, one per CPU core. If 1, spectra are degraded in this
+            process without starting a pool.
+
+        :type processes:
+            int
+
+        :param uid_field:
+            The metadata field which uniquely identifies each object.
+
+        :type uid_field:
+            str
+
+        :param origin:
+            The origin to record for spectra inserted into the output library.
+
+        :type origin:
+            str
+        """
+
+        self.input_library = input_library
+        self.output_library = output_library
+        self.recipe = dict(recipe)
+        self.search_constraints = dict(search_constraints) if search_constraints is not None else {}
+        self.batch_size = int(batch_size)
+        self.processes = processes if processes is not None else cpu_count()
+        self.uid_field = uid_field
+        self.origin = origin
+
+        assert self.batch_size > 0, "Batch size must be positive."
+
+        # Noise model used to generate output metadata, and to degrade spectra when we are not using a pool
+        self._noise_model = GaussianNoise(**self.recipe)
+
+    def _input_spectra(self):
+        """
+        Search the input library for the flux-normalised and continuum-normalised spectra of each object.
+
+        :return:
+            List of [uid, flux-normalised specId, continuum-normalised specId], sorted by uid.
+        """
+
+        spectrum_ids = {}
+        for continuum_normalised in (0, 1):
+            constraints = self.search_constraints.copy()
+            constraints['continuum_normalised'] = continuum_normalised
+            ids = [item['specId'] for item in self.input_library.search(**constraints)]
+            metadata_list = self.input_library.get_metadata(ids=ids) if ids else []
+            for spectrum_id, metadata in zip(ids, metadata_list):
+                uid = metadata[self.uid_field]
+                spectrum_ids.setdefault(uid, [None, None])[continuum_normalised] = spectrum_id
+
+        output = []
+        for uid in sorted(spectrum_ids):
+            flux_id, continuum_normalised_id = spectrum_ids[uid]
+            if flux_id is None or continuum_normalised_id is None:
+                logger.warning("Object <{}> does not have both flux-normalised and continuum-normalised spectra; "
+                               "skipping it".format(uid))
+                continue
+            output.append([uid, flux_id, continuum_normalised_id])
+        return output
+
+    def _completed_uids(self):
+        """
+        Return the set of the uids of the objects which already have all of their degraded spectra in the output
+        library. The spectra of any object which was only partly written, and any spectra which we inserted but
+        whose metadata was never set, are deleted from the output library, so that they can be written again.
+
+        :return:
+            set
+        """
+
+        items = self.output_library.search()
+        if not items:
+            return set()
+
+        metadata_list = self.output_library.get_metadata(ids=[item['specId'] for item in items])
+
+        spectrum_ids = {}
+        orphan_ids = []
+        for item, metadata in zip(items, metadata_list):
+            uid = metadata.get(self.uid_field, None)
+            if uid is not None:
+                spectrum_ids.setdefault(uid, []).append(item['specId'])
+            elif item['name'] == self.origin:
+                orphan_ids.append(item['specId'])
+
+        # Each object has a flux-normalised and a continuum-normalised spectrum at each SNR
+        expected_count = 2 * len(self._noise_model.snr_list)
+
+        completed = set()
+        incomplete_ids = list(orphan_ids)
+        for uid, ids in spectrum_ids.items():
+            if len(ids) >= expected_count:
+                completed.add(uid)
+            else:
+                incomplete_ids.extend(ids)
+
+        if incomplete_ids:
+            logger.info("Deleting {:d} spectra of partly written objects from output library".format(
+                len(incomplete_ids)))
+            self.output_library.delete(ids=incomplete_ids)
+
+        return completed
+
+    def _write_batch(self, cube, metadata_list):
+        """
+        Insert the degraded versions of a batch of objects into the output library.
+
+        :param cube:
+            Dictionary of arrays returned by <GaussianNoise.noise_cube>.
+
+        :param metadata_list:
+            The metadata of the flux-normalised input spectrum of each object in the batch.
+
+        :return:
+            None
+        """
+
+        snr_count = len(self._noise_model.snr_list)
+        pixel_count = len(self._noise_model.wavelength_raster)
+
+        # For each object, the flux-normalised spectra at each SNR, followed by the continuum-normalised spectra
+        values = np.stack([cube['values'], cube['values_cn']], axis=1).reshape([-1, pixel_count])
+        value_errors = np.stack([cube['value_errors'], cube['value_errors_cn']], axis=1).reshape([-1, pixel_count])
+
+        output_metadata = []
+        for metadata in metadata_list:
+            output_metadata.extend(self._noise_model.output_metadata(metadata=metadata))
+        assert len(output_metadata) == len(metadata_list) * 2 * snr_count
+
+        spectra = SpectrumArray(wavelengths=self._noise_model.wavelength_raster,
+                                values=values,
+                                value_errors=value_errors,
+                                metadata_list=output_metadata)
+
+        self.output_library.insert(spectra=spectra,
+                                   filenames=[None] * len(output_metadata),
+                                   origin=self.origin)
+
+    def run(self):
+        """
+        Degrade all of the spectra in the input library which have not already been degraded.
+
+        :return:
+            The number of objects degraded.
+        """
+
+        objects = self._input_spectra()
+        completed = self._completed_uids()
+        random_seed = self.recipe.get('random_seed', None)
+
+        # Divide the objects which remain to be degraded into batches. Each object is seeded with its index in the
+        # full list of objects, so that a resumed run adds the same noise as an uninterrupted one.
+        remaining = [(index, item) for index, item in enumerate(objects) if item[0] not in completed]
+        batches = []
+        for start in range(0, len(remaining), self.batch_size):
+            batch = [item for index, item in remaining[start:start + self.batch_size]]
+            seeds = None
+            if random_seed is not None:
+                seeds = [[random_seed, index] for index, item in remaining[start:start + self.batch_size]]
+            batches.append((batch, seeds))
+
+        logger.info("Degrading {:d} objects in {:d} batches; {:d} objects already completed".format(
+            len(remaining), len(batches),
+            sum(1 for item in objects if item[0] in completed)))
+
+        if not batches:
+            return 0
+
+        # Each chunk of spectra loaded into shared memory contains a few batches for each worker
+        batches_per_chunk = 2 * self.processes
+        chunk_length = self.batch_size * batches_per_chunk
+
+        # Allocate shared memory to hold a chunk of input spectra, based on the raster of the first spectrum
+        first_spectrum = self.input_library.open(ids=[batches[0][0][0][1]])
+        wavelengths = first_spectrum.wavelengths
+        spectrum_length = len(wavelengths)
+
+        wavelengths_shared = RawArray(c_double, spectrum_length)
+        np.frombuffer(wavelengths_shared)[:] = wavelengths
+        values_shared = RawArray(c_double, chunk_length * 2 * spectrum_length)
+        values = np.frombuffer(values_shared).reshape([chunk_length, 2, spectrum_length])
+
+        initargs = (self.recipe, wavelengths_shared, values_shared, spectrum_length)
+        pool = None
+        if self.processes > 1:
+            pool = Pool(processes=self.processes, initializer=_initialise_worker, initargs=initargs)
+        else:
+            _initialise_worker(*initargs)
+
+        object_count = 0
+        try:
+            for chunk_start in range(0, len(batches), batches_per_chunk):
+                chunk = batches[chunk_start:chunk_start + batches_per_chunk]
+
+                # Load the input spectra for this chunk into shared memory
+                tasks = []
+                metadata_lists = []
+                position = 0
+                for batch, seeds in chunk:
+                    for spectrum_type in (0, 1):
+                        spectra = self.input_library.open(ids=[item[1 + spectrum_type] for item in batch])
+                        assert spectra.raster_hash == first_spectrum.raster_hash, \
+                            "All input spectra must be sampled on the same wavelength raster."
+                        values[position:position + len(batch), spectrum_type] = spectra.values
+                        if spectrum_type == 0:
+                            metadata_lists.append(spectra.metadata_list)
+                    tasks.append((position, len(batch), seeds))
+                    position += len(batch)
+
+                # Degrade each batch, and write the results as they arrive
+                results = pool.imap(_degrade_batch, tasks) if pool is not None else map(_degrade_batch, tasks)
+                for cube, metadata_list in zip(results, metadata_lists):
+                    self._write_batch(cube=cube, metadata_list=metadata_list)
+                    object_count += len(metadata_list)
+                    logger.info("Degraded {:d} objects".format(object_count))
+        except BaseException:
+            if pool is not None:
+                pool.terminate()
+            raise
+        else:
+            if pool is not None:
+                pool.close()
+        finally:
+            if pool is not None:
+                pool.join()
+
+        return object_count
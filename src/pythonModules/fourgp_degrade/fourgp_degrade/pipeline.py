@@ -0,0 +1,454 @@
+# -*- coding: utf-8 -*-
+
+"""
+A composable pipeline of degradation stages, which can be declared once and then applied lazily to a stream of
+spectra.
+
+Reddening, convolution, resampling and interpolation are all linear operations on the flux of a spectrum, so any
+consecutive run of these stages is fused into a single sparse matrix for each input wavelength raster. Stages which
+are not linear, such as adding noise, are applied to whole batches of spectra at once. Spectra are processed one item
+at a time from an input iterable, so memory use is bounded by the size of each item, not the number of items.
+"""
+
+from itertools import islice
+
+import numpy as np
+from scipy import sparse
+
+from fourgp_speclib import Spectrum, SpectrumArray, hash_numpy_array
+from .convolve import ConvolutionOperator
+from .interpolate import InterpolationPlan
+from .redden import SpectrumReddener
+from .resample import ResamplingOperator
+
+
+class DegradationStage(object):
+    """
+    Base class for a single stage of a degradation pipeline.
+
+    Linear stages implement <matrix>, which returns the sparse matrix by which they multiply spectra on a given input
+    raster. Other stages implement <process>, which operates on 2D arrays of spectra directly.
+    """
+
+    # Boolean flag indicating whether this stage is a linear operation, which can be fused with its neighbours
+    linear = False
+
+    def output_raster(self, wavelengths):
+        """
+        Return the wavelength raster of spectra output by this stage.
+
+        :param wavelengths:
+            The wavelength raster of spectra input to this stage.
+
+        :type wavelengths:
+            np.ndarray
+
+        :return:
+            np.ndarray
+        """
+        return wavelengths
+
+    def matrix(self, wavelengths, raster_hash=None):
+        """
+        Return the sparse matrix with shape (n_output_pixels, n_input_pixels) which applies this stage to spectra on
+        an input raster. Only implemented by linear stages.
+
+        :param wavelengths:
+            The wavelength raster of spectra input to this stage.
+
+        :type wavelengths:
+            np.ndarray
+
+        :param raster_hash:
+            The hash of the input raster, if already known.
+
+        :type raster_hash:
+            str
+
+        :return:
+            scipy.sparse.csr_matrix
+        """
+        raise NotImplementedError
+
+    def process(self, wavelengths, values, value_errors):
+        """
+        Apply this stage to a 2D array of spectra. Only implemented by stages which are not linear.
+
+        :param wavelengths:
+            The wavelength raster of the input spectra.
+
+        :param values:
+            Array with shape (n_spectra, n_pixels).
+
+        :param value_errors:
+            Array with shape (n_spectra, n_pixels).
+
+        :return:
+            Tuple of (wavelengths, values, value_errors) of the output spectra.
+        """
+        raise NotImplementedError
+
+
+class Redden(DegradationStage):
+    """
+    Pipeline stage which reddens spectra, using the extinction law in <SpectrumReddener>.
+    """
+
+    linear = True
+
+    def __init__(self, e_bv, r=3.1):
+        """
+        :param e_bv:
+            E(B-V). Positive values redden spectra; negative values deredden them.
+
+        :type e_bv:
+            float
+
+        :param r:
+            A(V)/E(B-V).
+
+        :type r:
+            float
+        """
+        self.e_bv = float(e_bv)
+        self.r = float(r)
+
+    def matrix(self, wavelengths, raster_hash=None):
+        extinction = SpectrumReddener.extinction_curve(wavelengths=wavelengths, r=self.r, raster_hash=raster_hash)
+        return sparse.diags(np.power(10, -0.4 * extinction * self.e_bv), format='csr')
+
+
+class Convolve(DegradationStage):
+    """
+    Pipeline stage which convolves spectra with a Gaussian line-spread function, using <ConvolutionOperator>.
+    """
+
+    linear = True
+
+    def __init__(self, sigma=None, fwhm=None):
+        """
+        The width of the line-spread function must be specified either in pixels, or in A.
+
+        :param sigma:
+            The standard deviation of the line-spread function in pixels, either constant, or at each input pixel.
+
+        :type sigma:
+            float or np.ndarray
+
+        :param fwhm:
+            The FWHM of the line-spread function in A. This may be a constant, an array, or a function of wavelength.
+
+        :type fwhm:
+            float, np.ndarray or callable
+        """
+        assert (sigma is None) != (fwhm is None), "Must specify exactly one of sigma or fwhm."
+        self.sigma = sigma
+        self.fwhm = fwhm
+
+    def matrix(self, wavelengths, raster_hash=None):
+        if self.sigma is not None:
+            operator = ConvolutionOperator.for_raster(wavelengths=wavelengths, sigma=self.sigma,
+                                                      raster_hash=raster_hash)
+        else:
+            operator = ConvolutionOperator.for_lsf(wavelengths=wavelengths, fwhm=self.fwhm, raster_hash=raster_hash)
+        return operator.matrix
+
+
+class Resample(DegradationStage):
+    """
+    Pipeline stage which resamples spectra onto a new raster, conserving flux, using <ResamplingOperator>.
+    """
+
+    linear = True
+
+    def __init__(self, output_raster):
+        """
+        :param output_raster:
+            The wavelength raster to resample spectra onto.
+
+        :type output_raster:
+            np.ndarray
+        """
+        self._output_raster = np.asarray(output_raster)
+
+    def output_raster(self, wavelengths):
+        return self._output_raster
+
+    def matrix(self, wavelengths, raster_hash=None):
+        return ResamplingOperator.for_rasters(input_raster=wavelengths, output_raster=self._output_raster,
+                                              input_raster_hash=raster_hash).matrix
+
+
+class Interpolate(DegradationStage):
+    """
+    Pipeline stage which linearly interpolates spectra onto a new raster, using <InterpolationPlan>.
+    """
+
+    linear = True
+
+    def __init__(self, output_raster):
+        """
+        :param output_raster:
+            The wavelength raster to interpolate spectra onto.
+
+        :type output_raster:
+            np.ndarray
+        """
+        self._output_raster = np.asarray(output_raster)
+
+    def output_raster(self, wavelengths):
+        return self._output_raster
+
+    def matrix(self, wavelengths, raster_hash=None):
+        plan = InterpolationPlan.for_rasters(input_raster=wavelengths, output_raster=self._output_raster,
+                                             input_raster_hash=raster_hash)
+        length = self._output_raster.shape[0]
+        data = np.stack([1 - plan.weights, plan.weights], axis=1).flatten()
+        indices = np.stack([plan.lower_indices, plan.lower_indices + 1], axis=1).flatten()
+        return sparse.csr_matrix((data, indices, np.arange(0, 2 * length + 1, 2)),
+                                 shape=(length, wavelengths.shape[0]))
+
+
+class AddNoise(DegradationStage):
+    """
+    Pipeline stage which adds Gaussian noise to spectra at a fixed SNR. The noise level of each spectrum is its mean
+    flux within a wavelength window, divided by the SNR.
+    """
+
+    def __init__(self, snr, wavelength_min=0, wavelength_max=np.inf, random_seed=None):
+        """
+        :param snr:
+            The SNR per pixel to degrade spectra to.
+
+        :type snr:
+            float
+
+        :param wavelength_min:
+            The short-wavelength end of the window in which the signal level is measured.
+
+        :type wavelength_min:
+            float
+
+        :param wavelength_max:
+            The long-wavelength end of the window in which the signal level is measured.
+
+        :type wavelength_max:
+            float
+
+        :param random_seed:
+            Seed for the random number generator used to synthesise noise.
+        """
+        self.snr = float(snr)
+        self.wavelength_min = wavelength_min
+        self.wavelength_max = wavelength_max
+        self._random_generator = np.random.default_rng(random_seed)
+
+    def process(self, wavelengths, values, value_errors):
+        window = (wavelengths >= self.wavelength_min) * (wavelengths <= self.wavelength_max)
+        assert np.any(window), "No pixels fall within the window in which the signal level is measured."
+
+        noise_level = np.mean(values[:, window], axis=1)[:, np.newaxis] / self.snr
+
+        new_values = values + self._random_generator.standard_normal(size=values.shape) * noise_level
+        new_value_errors = np.sqrt(np.square(value_errors) + np.square(noise_level))
+
+        return wavelengths, new_values, new_value_errors
+
+
+class DegradationPipeline(object):
+    """
+    A sequence of degradation stages, which is applied lazily to a stream of spectra. Consecutive linear stages are
+    fused into a single sparse matrix for each input raster, and errors are propagated through them in quadrature.
+    This gives the exact variance of each output pixel for independent errors on the input pixels, whereas applying
+    each stage in turn would neglect the correlations which one stage introduces between the inputs to the next.
+    """
+
+    def __init__(self, stages):
+        """
+        :param stages:
+            List of the stages to apply to each spectrum, in order.
+
+        :type stages:
+            list of DegradationStage
+        """
+        for stage in stages:
+            assert isinstance(stage, DegradationStage), "Pipeline stages must be DegradationStage objects."
+        self.stages = list(stages)
+
+        # The fused steps of this pipeline, indexed by input raster hash
+        self._plans = {}
+
+    def _plan(self, wavelengths, raster_hash):
+        """
+        Return the list of steps which apply this pipeline to spectra on an input raster. Each step is either a tuple
+        of (matrix, squared matrix, output raster) for a run of fused linear stages, or a stage which is not linear.
+
+        :param wavelengths:
+            The wavelength raster of the input spectra.
+
+        :param raster_hash:
+            The hash of the wavelength raster.
+
+        :return:
+            list
+        """
+
+        if raster_hash in self._plans:
+            return self._plans[raster_hash]
+
+        steps = []
+        matrix = None
+        stage_raster_hash = raster_hash
+        for stage in self.stages:
+            if not stage.linear:
+                if matrix is not None:
+                    steps.append((matrix, matrix.multiply(matrix).tocsr(), wavelengths))
+                    matrix = None
+                steps.append(stage)
+                wavelengths = stage.output_raster(wavelengths)
+                stage_raster_hash = None
+                continue
+
+            stage_matrix = stage.matrix(wavelengths=wavelengths, raster_hash=stage_raster_hash)
+            matrix = stage_matrix if matrix is None else stage_matrix.dot(matrix).tocsr()
+            wavelengths = stage.output_raster(wavelengths)
+            stage_raster_hash = None
+
+        if matrix is not None:
+            steps.append((matrix, matrix.multiply(matrix).tocsr(), wavelengths))
+
+        self._plans[raster_hash] = steps
+        return steps
+
+    def apply_arrays(self, wavelengths, values, value_errors, raster_hash=None):
+        """
+        Apply this pipeline to a 2D array of spectra.
+
+        :param wavelengths:
+            The wavelength raster of the input spectra.
+
+        :type wavelengths:
+            np.ndarray
+
+        :param values:
+            Array with shape (n_spectra, n_pixels).
+
+        :type values:
+            np.ndarray
+
+        :param value_errors:
+            Array with shape (n_spectra, n_pixels).
+
+        :type value_errors:
+            np.ndarray
+
+        :param raster_hash:
+            The hash of the input raster, if already known.
+
+        :type raster_hash:
+            str
+
+        :return:
+            Tuple of (wavelengths, values, value_errors) of the output spectra.
+        """
+
+        if raster_hash is None:
+            raster_hash = hash_numpy_array(wavelengths)
+
+        for step in self._plan(wavelengths=wavelengths, raster_hash=raster_hash):
+            if isinstance(step, DegradationStage):
+                wavelengths, values, value_errors = step.process(wavelengths=wavelengths,
+                                                                 values=values,
+                                                                 value_errors=value_errors)
+            else:
+                matrix, matrix_squared, wavelengths = step
+                values = matrix.dot(values.T).T
+                value_errors = np.sqrt(matrix_squared.dot(np.square(value_errors).T).T)
+
+        return wavelengths, values, value_errors
+
+    def apply(self, item):
+        """
+        Apply this pipeline to a single Spectrum or SpectrumArray.
+
+        :param item:
+            The spectra to degrade.
+
+        :type item:
+            Spectrum or SpectrumArray
+
+        :return:
+            New Spectrum or SpectrumArray object.
+        """
+
+        assert isinstance(item, (Spectrum, SpectrumArray)), \
+            "The DegradationPipeline class can only operate on Spectrum or SpectrumArray objects."
+
+        if isinstance(item, Spectrum):
+            wavelengths, values, value_errors = self.apply_arrays(wavelengths=item.wavelengths,
+                                                                  values=item.values[np.newaxis, :],
+                                                                  value_errors=item.value_errors[np.newaxis, :],
+                                                                  raster_hash=item.raster_hash)
+            return Spectrum(wavelengths=wavelengths,
+                            values=values[0],
+                            value_errors=value_errors[0],
+                            metadata=item.metadata.copy())
+
+        wavelengths, values, value_errors = self.apply_arrays(wavelengths=item.wavelengths,
+                                                              values=item.values,
+                                                              value_errors=item.value_errors,
+                                                              raster_hash=item.raster_hash)
+        return SpectrumArray(wavelengths=wavelengths,
+                             values=values,
+                             value_errors=value_errors,
+                             metadata_list=[metadata.copy() for metadata in item.metadata_list])
+
+    def process(self, items):
+        """
+        Lazily apply this pipeline to each item in an iterable of Spectrum or SpectrumArray objects.
+
+        :param items:
+            Iterable of Spectrum or SpectrumArray objects.
+
+        :return:
+            Generator of degraded Spectrum or SpectrumArray objects.
+        """
+
+        for item in items:
+            yield self.apply(item)
+
+    def process_batches(self, spectra, batch_size=64):
+        """
+        Lazily apply this pipeline to an iterable of Spectrum objects, grouping them into SpectrumArray batches so
+        that each fused stage is applied to many spectra with a single matrix product. A new batch is started
+        whenever the wavelength raster changes.
+
+        :param spectra:
+            Iterable of Spectrum objects.
+
+        :param batch_size:
+            The maximum number of spectra in each batch.
+
+        :type batch_size:
+            int
+
+        :return:
+            Generator of degraded SpectrumArray objects.
+        """
+
+        iterator = iter(spectra)
+        pending = []
+        while True:
+            chunk = list(islice(iterator, batch_size - len(pending)))
+            pending.extend(chunk)
+            if not pending:
+                return
+
+            # Take the longest run of spectra at the start of the batch which share a common raster
+            raster_hash = pending[0].raster_hash
+            run_length = 1
+            while run_length < len(pending) and pending[run_length].raster_hash == raster_hash:
+                run_length += 1
+
+            batch, pending = pending[:run_length], pending[run_length:]
+            yield self.apply(SpectrumArray.from_spectra(batch))
@@ -2,7 +2,7 @@
 
 import numpy as np
 
-from fourgp_speclib import Spectrum
+from fourgp_speclib import Spectrum, SpectrumArray, raster_cache
 
 
 class SpectrumReddener(object):
@@ -16,84 +16,60 @@ class SpectrumReddener(object):
     def __init__(self, input_spectrum):
         """
         :param input_spectrum:
-            Spectrum object. Wavelength raster must be specified in A. Flux and flux errors can be in arbitrary units.
+            Spectrum object, or SpectrumArray of many spectra. Wavelength raster must be specified in A. Flux and
+            flux errors can be in arbitrary units.
 
         :type input_spectrum:
-            Spectrum
+            Spectrum or SpectrumArray
         """
-        assert isinstance(input_spectrum, Spectrum), "The SpectrumReddener class can only operate on Spectrum objects."
+        assert isinstance(input_spectrum, (Spectrum, SpectrumArray)), \
+            "The SpectrumReddener class can only operate on Spectrum or SpectrumArray objects."
         self._input = input_spectrum
 
-    def redden(self, e_bv, r=3.1):
-        return self.deredden(-e_bv, r)
-
-    def deredden(self, e_bv, r=3.1):
+    @staticmethod
+    def _build_extinction_curve(wavelengths, r):
         """
-        Redden this spectrum.
+        Builder for the extinction curve A(lambda)/E(B-V) on a wavelength raster, for use by the raster cache. Each
+        regime of the extinction law is only evaluated at the wavelengths which fall within it.
 
-        :param e_bv:
-            E(B-V). Positive values deredden a spectrum. Negative values increase the reddening of a spectrum.
-        :type e_bv:
-            float
+        :param wavelengths:
+            The wavelength raster, in A.
         :param r:
-            A(V)/E(B-V). Typically assumed to be 3.1 for a standard dust grain size spectrum.
-        :type r:
-            float
-
+            A(V)/E(B-V).
         :return:
-            New Spectrum object.
+            Dictionary containing the extinction curve.
         """
 
-        x = 1e4 / self._input.wavelengths
-        extinction = np.zeros_like(self._input.wavelengths)
+        x = 1e4 / np.asarray(wavelengths, dtype=np.float64)
+        extinction = np.zeros_like(x)
 
         # Regime 1
         mask = (x >= 8)
-        h = x - 8
-        a = -1.073 - 0.628 * h + 0.137 * h * h - 0.070 * h * h * h
-        b = 13.670 + 4.257 * h - 0.420 * h * h + 0.374 * h * h * h
-        extinction[mask] = r * a[mask] + b[mask]
-
-        # Regime 2
-        mask = (x >= 5.9) * (x < 8)
-        h = x - 5.9
-        fa = -0.04473 * h * h - 0.009779 * h * h * h
-        fb = 0.2130 * h * h + 0.1207 * h * h * h
-        a = 1.752 - 0.316 * x - 0.104 / ((x - 4.67) ** 2 + 0.341) + fa
-        b = -3.090 + 1.825 * x + 1.206 / ((x - 4.62) ** 2 + 0.263) + fb
-        extinction[mask] = r * a[mask] + b[mask]
-
-        # Regime 3
-        mask = (x >= 3.3) * (x < 5.9)
-        a = 1.752 - 0.316 * x - 0.104 / ((x - 4.67) ** 2 + 0.341)
-        b = -3.090 + 1.825 * x + 1.206 / ((x - 4.62) ** 2 + 0.263)
-        extinction[mask] = r * a[mask] + b[mask]
+        h = x[mask] - 8
+        a = -1.073 + h * (-0.628 + h * (0.137 - 0.070 * h))
+        b = 13.670 + h * (4.257 + h * (-0.420 + 0.374 * h))
+        extinction[mask] = r * a + b
+
+        # Regimes 2 and 3 share the same functional form, with an additional far-UV curvature term in regime 2
+        mask = (x >= 3.3) * (x < 8)
+        xm = x[mask]
+        a = 1.752 - 0.316 * xm - 0.104 / ((xm - 4.67) ** 2 + 0.341)
+        b = -3.090 + 1.825 * xm + 1.206 / ((xm - 4.62) ** 2 + 0.263)
+        h = np.maximum(xm - 5.9, 0)
+        a += h * h * (-0.04473 - 0.009779 * h)
+        b += h * h * (0.2130 + 0.1207 * h)
+        extinction[mask] = r * a + b
 
         # Regime 4
         mask = (x >= 1.1) * (x < 3.3)
-        y = x - 1.82
-        a = (1
-             + 0.17699 * y
-             - 0.50447 * y * y
-             - 0.02427 * y ** 3
-             + 0.72085 * y ** 4
-             + 0.01979 * y ** 5
-             - 0.77530 * y ** 6
-             + 0.32999 * y ** 7)
-        b = (1.41338 * y
-             + 2.28305 * y * y
-             + 1.07233 * y ** 3
-             - 5.38434 * y ** 4
-             - 0.62251 * y ** 5
-             + 5.30260 * y ** 6
-             - 2.09002 * y ** 7)
-        extinction[mask] = r * a[mask] + b[mask]
+        y = x[mask] - 1.82
+        a = np.polyval([0.32999, -0.77530, 0.01979, 0.72085, -0.02427, -0.50447, 0.17699, 1], y)
+        b = np.polyval([-2.09002, 5.30260, -0.62251, -5.38434, 1.07233, 2.28305, 1.41338, 0], y)
+        extinction[mask] = r * a + b
 
         # Regime 5
         mask = (x >= 0.2) * (x < 1.1)
-        a = 0.574 * x ** 1.61
-        b = -0.527 * x ** 1.61
-        extinction[mask] = r * a[mask] + b[mask]
+        extinction[mask] = (r * 0.574 - 0.527) * x[mask] ** 1.61
 
         # Regime 6
         mask = (x < 0.2)
@@ -103,8 +79,76 @@ class SpectrumReddener(object):
         # 0.05056 is A_lambda/E(B-V) of Howarth, 1983 at x=0.2
         xx = 0.2 ** 1.61
         hilfy = (r * 0.574 - 0.527) * xx / 0.05056
-        extinction_6 = hilfy * x * ((1.86 - 0.48 * x) * x - 0.1)
-        extinction[mask] = extinction_6[mask]
+        xm = x[mask]
+        extinction[mask] = hilfy * xm * ((1.86 - 0.48 * xm) * xm - 0.1)
+
+        return {"extinction": extinction}
+
+    @staticmethod
+    def extinction_curve(wavelengths, r=3.1, raster_hash=None):
+        """
+        Return the extinction curve A(lambda)/E(B-V) on a wavelength raster. Curves are cached for each raster and
+        value of R_V, and must not be modified.
+
+        :param wavelengths:
+            The wavelength raster, in A.
+        :type wavelengths:
+            np.ndarray
+        :param r:
+            A(V)/E(B-V). Typically assumed to be 3.1 for a standard dust grain size spectrum.
+        :type r:
+            float
+        :param raster_hash:
+            The hash of the wavelength raster, if already known.
+        :type raster_hash:
+            str
+
+        :return:
+            np.ndarray
+        """
+
+        return raster_cache.fetch("extinction_curve", wavelengths, raster_hash=raster_hash, r=float(r))["extinction"]
+
+    def redden(self, e_bv, r=3.1):
+        return self.deredden(-np.asarray(e_bv), r)
+
+    def deredden(self, e_bv, r=3.1):
+        """
+        Redden this spectrum.
+
+        :param e_bv:
+            E(B-V). Positive values deredden a spectrum. Negative values increase the reddening of a spectrum. If
+            this reddener was instantiated with a SpectrumArray, this may be an array of values, one for each
+            spectrum, which are all applied in a single operation.
+        :type e_bv:
+            float or np.ndarray
+        :param r:
+            A(V)/E(B-V). Typically assumed to be 3.1 for a standard dust grain size spectrum.
+        :type r:
+            float
+
+        :return:
+            New Spectrum or SpectrumArray object.
+        """
+
+        extinction = self.extinction_curve(wavelengths=self._input.wavelengths, r=r,
+                                           raster_hash=self._input.raster_hash)
+
+        if isinstance(self._input, SpectrumArray):
+            e_bv = np.asarray(e_bv, dtype=np.float64)
+            if e_bv.ndim > 0:
+                assert e_bv.shape == (len(self._input),), \
+                    "Need one value of E(B-V) for each spectrum in SpectrumArray."
+                e_bv = e_bv[:, np.newaxis]
+
+            multiplier = np.power(10, 0.4 * e_bv * extinction)
+
+            return SpectrumArray(wavelengths=self._input.wavelengths,
+                                 values=self._input.values * multiplier,
+                                 value_errors=self._input.value_errors * multiplier,
+                                 metadata_list=[metadata.copy() for metadata in self._input.metadata_list])
+
+        assert np.ndim(e_bv) == 0, "Can only apply a single value of E(B-V) to a Spectrum object."
 
         multiplier = 10 ** (0.4 * (extinction * e_bv))
 
@@ -118,3 +162,7 @@ class SpectrumReddener(object):
             output.copy_mask_from(self._input)
 
         return output
+
+
+raster_cache.register_builder(product="extinction_curve", builder=SpectrumReddener._build_extinction_curve,
+                              persist=False)
@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
+from scipy import sparse
 
-from fourgp_speclib import Spectrum
+from fourgp_speclib import Spectrum, SpectrumArray, raster_cache
 
 
 class SpectrumResampler(object):
@@ -63,6 +64,24 @@ class SpectrumResampler(object):
         pixel_widths = left_edges[1:] - left_edges[:-1]
         return pixel_widths
 
+    @staticmethod
+    def _build_pixel_edges(raster):
+        """
+        Builder for the edges and widths of the pixels in a raster, for use by the raster cache.
+
+        :param raster:
+            Numpy array containing the input raster of the central wavelengths of pixels
+        :return:
+            Dictionary containing the left-hand edge of each pixel (N+1 entries) and the width of each pixel
+            (N entries)
+        """
+
+        left_edges = SpectrumResampler._pixel_left_edges(raster)
+        return {
+            "left_edges": left_edges,
+            "widths": SpectrumResampler._pixel_widths(left_edges)
+        }
+
     @staticmethod
     def _resample(x_new, x_in, y_in):
         """
@@ -107,16 +126,17 @@ class SpectrumResampler(object):
         assert x_new.ndim == 1, \
             "New x array should have exactly one dimension. Passed array has {} dimensions".format(x_new.ndim)
 
-        # Make an array of the left edge of each pixel in the input raster. The final entry is the right-edge of the
-        # last pixel, so if we have N input pixels, we output N+1 left edges (length N+1)
-        x_in_pixel_left_edges = SpectrumResampler._pixel_left_edges(x_in)
-
-        # Compute the width of each pixel in the input raster (length N)
-        x_in_pixel_width = SpectrumResampler._pixel_widths(x_in_pixel_left_edges)
+        # Look up the left edge of each pixel in the input raster. The final entry is the right-edge of the
+        # last pixel, so if we have N input pixels, we have N+1 left edges (length N+1). Also look up the width of each
+        # pixel in the input raster (length N)
+        x_in_pixel_edges = raster_cache.fetch("pixel_edges", x_in)
+        x_in_pixel_left_edges = x_in_pixel_edges["left_edges"]
+        x_in_pixel_width = x_in_pixel_edges["widths"]
 
         # Do the same for the output raster
-        x_new_pixel_left_edges = SpectrumResampler._pixel_left_edges(x_new)
-        x_new_pixel_width = SpectrumResampler._pixel_widths(x_new_pixel_left_edges)
+        x_new_pixel_edges = raster_cache.fetch("pixel_edges", x_new)
+        x_new_pixel_left_edges = x_new_pixel_edges["left_edges"]
+        x_new_pixel_width = x_new_pixel_edges["widths"]
 
         # Create an array of the integrated flux per A leftwards of wavelength i in <x_in_pixel_left_edges> (length N+1)
         x_in_integrated = np.cumsum(np.insert(y_in * x_in_pixel_width, 0, 0))
@@ -152,14 +172,15 @@ class SpectrumResampler(object):
             New Spectrum object.
         """
 
-        new_values = self._resample(x_new=output_raster,
-                                    x_in=self._input.wavelengths,
-                                    y_in=self._input.values)
+        operator = ResamplingOperator.for_rasters(input_raster=self._input.wavelengths,
+                                                  output_raster=output_raster,
+                                                  input_raster_hash=self._input.raster_hash)
 
+        new_values = operator.resample_values(self._input.values)
+
+        # For backwards compatibility, errors are resampled in the same way as the values themselves
         if resample_errors:
-            new_value_errors = self._resample(x_new=output_raster,
-                                              x_in=self._input.wavelengths,
-                                              y_in=self._input.value_errors)
+            new_value_errors = operator.resample_values(self._input.value_errors)
         else:
             new_value_errors = np.zeros_like(new_values)
 
@@ -170,9 +191,7 @@ class SpectrumResampler(object):
                           )
 
         if resample_mask and self._input.mask_set:
-            output.mask = self._resample(x_new=output_raster,
-                                         x_in=self._input.wavelengths,
-                                         y_in=self._input.mask) > 0.5
+            output.mask = operator.resample_values(self._input.mask) > 0.5
             output.mask_set = not np.all(output.mask)
 
         return output
@@ -199,3 +218,273 @@ class SpectrumResampler(object):
         return self.onto_raster(output_raster=other.wavelengths,
                                 resample_errors=resample_errors,
                                 resample_mask=resample_mask)
+
+
+class ResamplingOperator(object):
+    """
+    The flux-conserving resampling of spectra from one wavelength raster onto another, expressed as a sparse matrix.
+
+    Each output pixel is a weighted mean of the input pixels which overlap it, so resampling is a linear operation
+    which depends only on the two rasters. We build the matrix once for each pair of rasters, and can then resample
+    a single Spectrum or a whole SpectrumArray with a single sparse matrix product.
+
+    :ivar np.ndarray input_raster:
+        The wavelength raster of the spectra we resample.
+
+    :ivar np.ndarray output_raster:
+        The wavelength raster we resample spectra onto.
+
+    :ivar scipy.sparse.csr_matrix matrix:
+        Sparse matrix with shape (n_output_pixels, n_input_pixels), which maps input spectra onto output spectra.
+    """
+
+    def __init__(self, input_raster, output_raster, matrix):
+        """
+        Instantiate a resampling operator from a precomputed matrix. Normally operators should be created using
+        <for_rasters>, which caches the matrices for each pair of rasters.
+
+        :param input_raster:
+            The wavelength raster of the spectra we resample.
+
+        :type input_raster:
+            np.ndarray
+
+        :param output_raster:
+            The wavelength raster we resample spectra onto.
+
+        :type output_raster:
+            np.ndarray
+
+        :param matrix:
+            Sparse matrix with shape (n_output_pixels, n_input_pixels).
+
+        :type matrix:
+            scipy.sparse.csr_matrix
+        """
+
+        self.input_raster = input_raster
+        self.output_raster = output_raster
+        self.matrix = matrix
+        self._matrix_squared = None
+
+    @classmethod
+    def for_rasters(cls, input_raster, output_raster, input_raster_hash=None):
+        """
+        Return the operator which resamples spectra from one wavelength raster onto another. The matrices are cached
+        in the raster cache, so they are only computed once for each pair of rasters.
+
+        :param input_raster:
+            The wavelength raster of the spectra we resample.
+
+        :type input_raster:
+            np.ndarray
+
+        :param output_raster:
+            The wavelength raster we resample spectra onto.
+
+        :type output_raster:
+            np.ndarray
+
+        :param input_raster_hash:
+            The hash of the input raster, if already known.
+
+        :type input_raster_hash:
+            str
+
+        :return:
+            ResamplingOperator
+        """
+
+        input_raster = np.asarray(input_raster)
+        output_raster = np.asarray(output_raster)
+
+        item = raster_cache.fetch("resampling_matrix", input_raster, raster_hash=input_raster_hash,
+                                  output_raster=output_raster)
+
+        matrix = sparse.csr_matrix((item["data"], item["indices"], item["indptr"]),
+                                   shape=(output_raster.shape[0], input_raster.shape[0]))
+
+        return cls(input_raster=input_raster, output_raster=output_raster, matrix=matrix)
+
+    @staticmethod
+    def _build_matrix(input_raster, output_raster):
+        """
+        Builder for the sparse resampling matrix between two rasters, for use by the raster cache.
+
+        We integrate the flux per A leftwards of each pixel edge of the output raster, as a linear combination of the
+        input pixels. The value of each output pixel is the difference between the integrals at its two edges,
+        divided by its width. Outside the input raster, the integral is clamped to its end values, as in
+        <SpectrumResampler._resample>.
+
+        :param input_raster:
+            The wavelength raster of the spectra we resample.
+
+        :type input_raster:
+            np.ndarray
+
+        :param output_raster:
+            The wavelength raster we resample spectra onto.
+
+        :type output_raster:
+            np.ndarray
+
+        :return:
+            Dictionary containing the data, indices and indptr arrays of a CSR sparse matrix.
+        """
+
+        input_raster = np.asarray(input_raster)
+        output_raster = np.asarray(output_raster)
+
+        assert input_raster.ndim == 1, \
+            "Input raster should have exactly one dimension. Passed array has {} dimensions".format(input_raster.ndim)
+        assert input_raster.shape[0] > 3, \
+            "Input spectrum must have at least three pixels for resampling to produce sensible output"
+        assert output_raster.ndim == 1, \
+            "Output raster should have exactly one dimension. Passed array has {} dimensions".format(output_raster.ndim)
+
+        input_edges = raster_cache.fetch("pixel_edges", input_raster)
+        input_left_edges = input_edges["left_edges"]
+        input_widths = input_edges["widths"]
+        input_length = input_widths.shape[0]
+
+        output_edges = raster_cache.fetch("pixel_edges", output_raster)
+        output_left_edges = output_edges["left_edges"]
+        output_widths = output_edges["widths"]
+
+        # For each output pixel edge, find the input pixel it falls within, and the fraction of that pixel which lies
+        # to its left. Edges beyond the ends of the input raster include either none or all of the input pixels.
+        pixel = np.searchsorted(input_left_edges, output_left_edges, side='right') - 1
+        below = pixel < 0
+        above = pixel >= input_length
+        pixel = np.clip(pixel, 0, input_length - 1)
+        fraction = (output_left_edges - input_left_edges[pixel]) / input_widths[pixel]
+        fraction[below] = 0
+        fraction[above] = 1
+
+        # Each output pixel draws on the input pixels between the pixels containing its left and right edges
+        first_pixel = pixel[:-1]
+        last_pixel = pixel[1:]
+        counts = last_pixel - first_pixel + 1
+        indptr = np.concatenate([[0], np.cumsum(counts)])
+        rows = np.repeat(np.arange(output_widths.shape[0]), counts)
+        columns = first_pixel[rows] + np.arange(indptr[-1]) - indptr[:-1][rows]
+
+        # The fraction of each input pixel which lies between the left and right edges of each output pixel
+        overlap = np.where(columns < last_pixel[rows], 1, fraction[1:][rows])
+        overlap -= np.where(columns == first_pixel[rows], fraction[:-1][rows], 0)
+
+        data = overlap * input_widths[columns] / output_widths[rows]
+
+        return {
+            "data": data,
+            "indices": columns,
+            "indptr": indptr
+        }
+
+    @property
+    def matrix_squared(self):
+        """
+        The element-wise square of the resampling matrix, which propagates the variances of uncorrelated errors.
+        """
+
+        if self._matrix_squared is None:
+            self._matrix_squared = self.matrix.multiply(self.matrix).tocsr()
+        return self._matrix_squared
+
+    def resample_values(self, values):
+        """
+        Resample a 1D array of values, or a 2D array of many spectra, onto the output raster.
+
+        :param values:
+            Array with shape (n_input_pixels,) or (n_spectra, n_input_pixels).
+
+        :type values:
+            np.ndarray
+
+        :return:
+            Array with shape (n_output_pixels,) or (n_spectra, n_output_pixels).
+        """
+
+        values = np.asarray(values, dtype=np.float64)
+        if values.ndim == 1:
+            return self.matrix.dot(values)
+        return self.matrix.dot(values.T).T
+
+    def resample_errors(self, value_errors):
+        """
+        Propagate the standard errors of a 1D array of values, or a 2D array of many spectra, onto the output raster.
+        Errors in different input pixels are assumed to be uncorrelated, and are added in quadrature.
+
+        :param value_errors:
+            Array with shape (n_input_pixels,) or (n_spectra, n_input_pixels).
+
+        :type value_errors:
+            np.ndarray
+
+        :return:
+            Array with shape (n_output_pixels,) or (n_spectra, n_output_pixels).
+        """
+
+        variances = np.square(np.asarray(value_errors, dtype=np.float64))
+        if variances.ndim == 1:
+            return np.sqrt(self.matrix_squared.dot(variances))
+        return np.sqrt(self.matrix_squared.dot(variances.T).T)
+
+    def apply(self, spectra, propagate_errors=True, resample_mask=True):
+        """
+        Resample a Spectrum, or every spectrum in a SpectrumArray, onto the output raster.
+
+        :param spectra:
+            The spectra to resample. These must be sampled on the input raster of this operator.
+
+        :type spectra:
+            Spectrum or SpectrumArray
+
+        :param propagate_errors:
+            If True, errors are propagated in quadrature. If False, they are resampled in the same way as the
+            values, as by <SpectrumResampler>.
+
+        :type propagate_errors:
+            bool
+
+        :param resample_mask:
+            Should we resample the mask of a Spectrum? SpectrumArrays do not have masks.
+
+        :type resample_mask:
+            bool
+
+        :return:
+            New Spectrum or SpectrumArray object.
+        """
+
+        assert isinstance(spectra, (Spectrum, SpectrumArray)), \
+            "The ResamplingOperator class can only operate on Spectrum or SpectrumArray objects."
+        assert spectra.wavelengths.shape == self.input_raster.shape, \
+            "Spectra are not sampled on the input raster of this resampling operator."
+
+        new_values = self.resample_values(spectra.values)
+        if propagate_errors:
+            new_value_errors = self.resample_errors(spectra.value_errors)
+        else:
+            new_value_errors = self.resample_values(spectra.value_errors)
+
+        if isinstance(spectra, SpectrumArray):
+            return SpectrumArray(wavelengths=self.output_raster,
+                                 values=new_values,
+                                 value_errors=new_value_errors,
+                                 metadata_list=[metadata.copy() for metadata in spectra.metadata_list])
+
+        output = Spectrum(wavelengths=self.output_raster,
+                          values=new_values,
+                          value_errors=new_value_errors,
+                          metadata=spectra.metadata.copy())
+
+        if resample_mask and spectra.mask_set:
+            output.mask = self.resample_values(spectra.mask) > 0.5
+            output.mask_set = not np.all(output.mask)
+
+        return output
+
+
+raster_cache.register_builder(product="pixel_edges", builder=SpectrumResampler._build_pixel_edges)
+raster_cache.register_builder(product="resampling_matrix", builder=ResamplingOperator._build_matrix)
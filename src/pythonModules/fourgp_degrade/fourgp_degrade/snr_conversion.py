@@ -5,8 +5,11 @@ A class which converts between SNR/pixel and SNR/A.
 """
 
 from math import sqrt
+from os import path as os_path
 import numpy as np
 
+from fourgp_speclib import raster_cache
+
 
 class SNRValue:
     """
@@ -49,12 +52,17 @@ class SNRConverter:
     Class to convert SNRs between SNR/pixel and SNR/A.
     """
 
+    # Wavelength rasters which have already been read from files, with the modification times of the files when
+    # they were read, indexed by filename
+    _file_rasters = {}
+
     def __init__(self, raster_from_file=None, raster=None, snr_at_wavelength=6100):
         """
         Class to convert SNRs between SNR/pixel and SNR/A.
 
         :param raster_from_file:
-            The filename of a file from which we should read the wavelength raster being used. Optional.
+            The filename of a file from which we should read the wavelength raster being used. Optional. Each file
+            is only read once, unless it is modified.
         :param raster:
             A numpy array containing the wavelength raster being used. Optional.
         :param snr_at_wavelength:
@@ -64,15 +72,68 @@ class SNRConverter:
 
         # Load wavelength raster
         if raster is not None:
-            self.raster = raster
+            self.raster = np.asarray(raster)
         elif raster_from_file is not None:
-            self.raster = np.loadtxt(raster_from_file).transpose()[0]
+            self.raster = self._read_raster(filename=raster_from_file)
         else:
             raise ValueError("No wavelength raster supplied")
 
-        # Differentiate raster to get pixels per A
-        raster_diff = np.diff(raster[raster > float(snr_at_wavelength)])
-        self.pixels_per_angstrom = 1.0 / raster_diff[0]
+        # The number of pixels per A, measured from the pixel gap following each pixel
+        self._local_pixels_per_angstrom = raster_cache.fetch("pixels_per_angstrom",
+                                                             self.raster)["pixels_per_angstrom"]
+
+        # Pixels per A beyond the wavelength at which we define SNR
+        self.pixels_per_angstrom = float(self.pixels_per_angstrom_at(snr_at_wavelength))
+
+    @classmethod
+    def _read_raster(cls, filename):
+        """
+        Read a wavelength raster from the first column of a text file, reusing any raster we have already read from
+        the same file.
+
+        :param filename:
+            The filename of the text file.
+        :return:
+            np.ndarray
+        """
+        filename = os_path.abspath(filename)
+        modification_time = os_path.getmtime(filename)
+
+        if filename not in cls._file_rasters or cls._file_rasters[filename][0] != modification_time:
+            raster = np.loadtxt(filename).transpose()[0]
+            raster.flags.writeable = False
+            cls._file_rasters[filename] = (modification_time, raster)
+
+        return cls._file_rasters[filename][1]
+
+    @staticmethod
+    def _build_pixels_per_angstrom(raster):
+        """
+        Builder for the number of pixels per A along a raster, for use by the raster cache. The value at each pixel
+        is measured from the gap between that pixel and the next one. The final pixel uses the preceding gap.
+
+        :param raster:
+            The wavelength raster.
+        :return:
+            Dictionary containing the number of pixels per A at each pixel.
+        """
+        pixel_gaps = np.diff(raster)
+        pixel_gaps = np.append(pixel_gaps, pixel_gaps[-1])
+        return {"pixels_per_angstrom": 1.0 / pixel_gaps}
+
+    def pixels_per_angstrom_at(self, wavelengths):
+        """
+        Look up the number of pixels per A at arbitrary wavelengths, using the gap between the first pair of pixels
+        beyond each wavelength.
+
+        :param wavelengths:
+            Wavelength, or array of wavelengths, in A.
+        :return:
+            float or np.ndarray
+        """
+        indices = np.searchsorted(self.raster, wavelengths, side='right')
+        indices = np.minimum(indices, len(self.raster) - 1)
+        return self._local_pixels_per_angstrom[indices]
 
     def per_pixel(self, value):
         """
@@ -101,3 +162,47 @@ class SNRConverter:
         """
         return SNRValue(value_per_pixel=value / sqrt(self.pixels_per_angstrom),
                         value_per_a=value)
+
+    def per_pixel_to_per_a(self, values, wavelengths=None):
+        """
+        Convert an array of SNRs per pixel into SNRs per A.
+
+        :param values:
+            Array of SNR/pixel values.
+        :type values:
+            np.ndarray
+        :param wavelengths:
+            The wavelengths at which each SNR is defined. This must be broadcastable against <values>. If None, all
+            SNRs are defined at the wavelength passed to our constructor.
+        :type wavelengths:
+            np.ndarray
+        :return:
+            np.ndarray
+        """
+        if wavelengths is None:
+            return np.asarray(values) * sqrt(self.pixels_per_angstrom)
+        return np.asarray(values) * np.sqrt(self.pixels_per_angstrom_at(wavelengths))
+
+    def per_a_to_per_pixel(self, values, wavelengths=None):
+        """
+        Convert an array of SNRs per A into SNRs per pixel.
+
+        :param values:
+            Array of SNR/A values.
+        :type values:
+            np.ndarray
+        :param wavelengths:
+            The wavelengths at which each SNR is defined. This must be broadcastable against <values>. If None, all
+            SNRs are defined at the wavelength passed to our constructor.
+        :type wavelengths:
+            np.ndarray
+        :return:
+            np.ndarray
+        """
+        if wavelengths is None:
+            return np.asarray(values) / sqrt(self.pixels_per_angstrom)
+        return np.asarray(values) / np.sqrt(self.pixels_per_angstrom_at(wavelengths))
+
+
+raster_cache.register_builder(product="pixels_per_angstrom", builder=SNRConverter._build_pixels_per_angstrom,
+                              persist=False)
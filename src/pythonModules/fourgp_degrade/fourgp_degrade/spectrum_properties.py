@@ -7,6 +7,8 @@ degrade separately because they are observed separately.
 
 import numpy as np
 
+from fourgp_speclib import raster_cache
+
 
 class SpectrumProperties:
     """
@@ -14,44 +16,74 @@ class SpectrumProperties:
     degrade separately because they are observed separately.
     """
 
+    # If the ratio of the spacing of successive pixels exceeds this value, we start a new wavelength arm
+    maximum_pixel_gap_ratio = 1.02
+
     def __init__(self, wavelength_raster):
         self.wavelength_raster = wavelength_raster
 
+    @classmethod
+    def _arm_breaks(cls, wavelength_raster):
+        """
+        Find the indices of the pixels at which each new wavelength arm starts.
+
+        The spacing of each pixel is compared with the spacing of the previous pixel in the same arm. The first pixel
+        gap within each arm, and the gap between two arms, are never compared with their predecessors. This means that
+        within a run of consecutive pixel gaps which all differ from their predecessors, every other gap starts a new
+        arm.
+
+        :param wavelength_raster:
+            The wavelength raster to divide into arms.
+
+        :return:
+            Dictionary containing a numpy array of the indices of the first pixel of each arm, excluding the first arm.
+        """
+
+        pixel_gaps = np.diff(wavelength_raster)
+
+        # Ratio of each pixel gap to the preceding one; element i compares the gap before pixel i+2 with its predecessor
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratios = pixel_gaps[1:] / pixel_gaps[:-1]
+            ratios = np.maximum(ratios, 1 / ratios)
+        candidates = ratios > cls.maximum_pixel_gap_ratio
+
+        # Find the start of each run of consecutive candidates, and the position of each candidate within its run
+        positions = np.arange(candidates.shape[0])
+        run_starts = candidates.copy()
+        run_starts[1:] &= ~candidates[:-1]
+        run_start_positions = np.maximum.accumulate(np.where(run_starts, positions, 0))
+        breaks = candidates & ((positions - run_start_positions) % 2 == 0)
+
+        return {"arm_starts": np.flatnonzero(breaks) + 2}
+
     def wavelength_arms(self):
-        wavelength_raster = self.wavelength_raster
+        """
+        Divide the wavelength raster into separate arms, wherever the pixel spacing changes abruptly. The results are
+        cached for each distinct wavelength raster, and the raster of each arm is a view into the input raster, so
+        it must not be modified.
+
+        :return:
+            Dictionary containing a list of [arm raster, mean pixel spacing] for each arm, and a list of the wavelengths
+            of the break points between arms.
+        """
+        wavelength_raster = np.asarray(self.wavelength_raster)
+
+        arm_starts = raster_cache.fetch("wavelength_arm_breaks", wavelength_raster)["arm_starts"]
 
         # Process wavelength raster into spectral arms
-        wavelength_arms = []
-        break_points = []
-
-        wavelength_old = wavelength_raster[0]
-        wavelength_delta = None
-        arm_raster = [wavelength_raster[0]]
-        arm_pixel_gaps = []
-        for i in range(1, len(wavelength_raster)):
-            wavelength_delta_new = wavelength_raster[i] - wavelength_old
-            wavelength_old = wavelength_raster[i]
-            if wavelength_delta is not None:
-                ratio = wavelength_delta_new / wavelength_delta
-                if ratio < 1:
-                    ratio = 1 / ratio
-                if ratio > 1.02:
-                    mean_interval = np.mean(np.asarray(arm_pixel_gaps))
-                    wavelength_arms.append([np.asarray(arm_raster), mean_interval])
-                    wavelength_delta = None
-                    break_points.append((wavelength_raster[i] + wavelength_raster[i - 1]) / 2)
-                    arm_raster = [wavelength_raster[i]]
-                    arm_pixel_gaps = []
-                    continue
-            wavelength_delta = wavelength_delta_new
-            arm_raster.append(wavelength_raster[i])
-            arm_pixel_gaps.append(wavelength_delta_new)
-
-        # Add final wavelength arm to self.wavelength_arms
-        mean_interval = np.mean(np.asarray(arm_pixel_gaps))
-        wavelength_arms.append([np.asarray(arm_raster), mean_interval])
+        starts = np.concatenate([[0], arm_starts])
+        ends = np.concatenate([arm_starts, [len(wavelength_raster)]])
+        pixel_gaps = np.diff(wavelength_raster)
+
+        wavelength_arms = [[wavelength_raster[start:end], np.mean(pixel_gaps[start:end - 1])]
+                           for start, end in zip(starts, ends)]
+
+        break_points = list((wavelength_raster[arm_starts] + wavelength_raster[arm_starts - 1]) / 2)
 
         return {
             "wavelength_arms": wavelength_arms,
             "break_points": break_points
         }
+
+
+raster_cache.register_builder(product="wavelength_arm_breaks", builder=SpectrumProperties._arm_breaks)
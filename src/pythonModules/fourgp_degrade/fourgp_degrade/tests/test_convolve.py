@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Unit tests for the ConvolutionOperator class
+"""
+
+import unittest
+import numpy as np
+from scipy.ndimage import gaussian_filter1d
+import fourgp_degrade
+
+
+class TestConvolutionOperator(unittest.TestCase):
+    def setUp(self):
+        """
+        Create some random spectra on a linear raster, whose pixel spacing is exactly representable, so that a
+        constant FWHM in A gives a constant width in pixels.
+        """
+
+        random_generator = np.random.RandomState(0)
+        self._raster = 5000 + 0.0625 * np.arange(1600)
+        self._values = 1 + 0.1 * random_generator.random_sample((3, self._raster.shape[0]))
+
+    def _assert_matches_gaussian_filter(self, operator, sigma):
+        output = operator.convolve_values(values=self._values)
+        for index in range(self._values.shape[0]):
+            expected = gaussian_filter1d(input=self._values[index], sigma=sigma)
+            self.assertTrue(np.allclose(output[index], expected, rtol=1e-12, atol=0))
+            self.assertTrue(np.allclose(operator.convolve_values(values=self._values[index]), expected,
+                                        rtol=1e-12, atol=0))
+
+    def test_constant_width(self):
+        """
+        Check that constant-width kernels match <gaussian_filter1d> on both sides of the radius at which we switch
+        from sparse matrices to FFTs, including at the ends of the spectrum.
+        """
+
+        radius = fourgp_degrade.ConvolutionOperator.fft_minimum_radius
+        for sigma in (0.8, (radius - 0.6) / 4, (radius - 0.4) / 4, 40.):
+            operator = fourgp_degrade.ConvolutionOperator.for_raster(wavelengths=self._raster, sigma=sigma)
+            self._assert_matches_gaussian_filter(operator=operator, sigma=sigma)
+
+            # The sparse matrix is only built for narrow kernels
+            uses_fft = int(4 * sigma + 0.5) >= radius
+            self.assertEqual(operator._matrix is None, uses_fft)
+
+    def test_fwhm(self):
+        """
+        Check that a line-spread function whose FWHM is specified in A is converted into the right width in pixels,
+        for kernels which are applied both with sparse matrices and with FFTs.
+        """
+
+        pixel_width = self._raster[1] - self._raster[0]
+        for fwhm in (0.5, 2.0, lambda wavelengths: np.full_like(wavelengths, 2.0)):
+            operator = fourgp_degrade.ConvolutionOperator.for_lsf(wavelengths=self._raster, fwhm=fwhm)
+            self.assertTrue(operator.constant_width)
+
+            fwhm_pixels = (fwhm(self._raster)[0] if callable(fwhm) else fwhm) / pixel_width
+            sigma = fwhm_pixels / (2 * np.sqrt(2 * np.log(2)))
+            self.assertAlmostEqual(float(operator.sigma), sigma, places=12)
+            self._assert_matches_gaussian_filter(operator=operator, sigma=sigma)
+
+    def test_variable_width(self):
+        """
+        Check that when the width of the line-spread function varies, each output pixel matches the corresponding
+        pixel of the spectrum convolved with a constant-width kernel of that pixel's width.
+        """
+
+        sigma = np.linspace(1, 8, self._raster.shape[0])
+        operator = fourgp_degrade.ConvolutionOperator.for_raster(wavelengths=self._raster, sigma=sigma)
+        output = operator.convolve_values(values=self._values)
+
+        for pixel in list(range(0, 40)) + list(range(800, 820)) + list(range(1560, 1600)):
+            expected = gaussian_filter1d(input=self._values, sigma=sigma[pixel], axis=-1)[:, pixel]
+            self.assertTrue(np.allclose(output[:, pixel], expected, rtol=1e-12, atol=0))
+
+
+# Run tests if we are run from command line
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Unit tests for the DegradationOperator class
+"""
+
+import unittest
+import numpy as np
+from scipy.ndimage import gaussian_filter1d
+import fourgp_speclib
+import fourgp_degrade
+
+
+class TestDegradationOperator(unittest.TestCase):
+    def setUp(self):
+        """
+        Create some random spectra on a high-resolution raster, and three wavelength arms with coarser rasters and
+        line-spread functions of different widths, one of which varies along the raster.
+        """
+
+        random_generator = np.random.RandomState(0)
+        self._input_raster = np.linspace(5000, 7000, 8001)
+        self._values = 1 + 0.1 * random_generator.random_sample((3, self._input_raster.shape[0]))
+        self._value_errors = 0.01 + 0.01 * random_generator.random_sample((3, self._input_raster.shape[0]))
+        self._wavelength_arms = [[np.geomspace(5100, 5600, 700), 2.5],
+                                 [np.geomspace(5500, 6300, 900), 6.],
+                                 [np.geomspace(6400, 6900, 400), np.linspace(3, 5, self._input_raster.shape[0])]]
+
+    def test_matches_convolve_then_resample(self):
+        """
+        Check that each arm of the stacked operator gives the same answer as convolving spectra with that arm's
+        line-spread function, and then resampling them onto that arm's raster.
+        """
+
+        operator = fourgp_degrade.DegradationOperator.for_arms(input_raster=self._input_raster,
+                                                               wavelength_arms=self._wavelength_arms)
+        output = operator.degrade_values(values=self._values)
+
+        self.assertEqual(output.shape, (self._values.shape[0], operator.output_raster.shape[0]))
+        self.assertTrue(np.array_equal(operator.output_raster,
+                                       np.concatenate([raster for raster, sigma in self._wavelength_arms])))
+
+        for index_arm, (arm_raster, sigma) in enumerate(self._wavelength_arms):
+            arm_output = operator.arm_values(values=output, index_arm=index_arm)
+            self.assertEqual(arm_output.shape, (self._values.shape[0], arm_raster.shape[0]))
+
+            for index in range(self._values.shape[0]):
+                if np.ndim(sigma) == 0:
+                    convolved = gaussian_filter1d(input=self._values[index], sigma=sigma)
+                else:
+                    convolved = fourgp_degrade.ConvolutionOperator.for_raster(
+                        wavelengths=self._input_raster, sigma=sigma).convolve_values(values=self._values[index])
+                expected = fourgp_degrade.SpectrumResampler._resample(x_new=arm_raster,
+                                                                      x_in=self._input_raster,
+                                                                      y_in=convolved)
+                self.assertTrue(np.allclose(arm_output[index], expected, rtol=1e-10, atol=1e-12))
+
+    def test_apply_to_spectrum_array(self):
+        """
+        Check that applying the operator to a SpectrumArray degrades the values and errors in the same way as
+        degrading each arm separately.
+        """
+
+        spectra = fourgp_speclib.SpectrumArray(wavelengths=self._input_raster,
+                                               values=self._values,
+                                               value_errors=self._value_errors,
+                                               metadata_list=[{"index": index} for index in range(3)])
+        output = fourgp_degrade.DegradationOperator.for_arms(input_raster=self._input_raster,
+                                                             wavelength_arms=self._wavelength_arms).apply(spectra)
+
+        start = 0
+        for arm_raster, sigma in self._wavelength_arms:
+            arm = fourgp_degrade.DegradationOperator.for_arm(input_raster=self._input_raster,
+                                                             output_raster=arm_raster,
+                                                             sigma=sigma).apply(spectra)
+            end = start + arm_raster.shape[0]
+            self.assertTrue(np.array_equal(output.wavelengths[start:end], arm.wavelengths))
+            self.assertTrue(np.allclose(output.values[:, start:end], arm.values, rtol=1e-12, atol=0))
+            self.assertTrue(np.allclose(output.value_errors[:, start:end], arm.value_errors, rtol=1e-12, atol=0))
+            start = end
+
+        self.assertEqual([metadata["index"] for metadata in output.metadata_list], [0, 1, 2])
+
+
+# Run tests if we are run from command line
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Unit tests for the DegradationCache class
+"""
+
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import fourgp_speclib
+import fourgp_degrade
+
+
+class TestDegradationCache(unittest.TestCase):
+    def setUp(self):
+        """
+        Create a cache which saves degraded spectra to a temporary directory.
+        """
+
+        self._cache_directory = tempfile.mkdtemp()
+        self._cache = fourgp_degrade.DegradationCache(cache_directory=self._cache_directory)
+        self._recipe_hash = self._cache.recipe_hash("test", np.arange(10.))
+
+    def tearDown(self):
+        shutil.rmtree(self._cache_directory)
+
+    def test_key_includes_values(self):
+        """
+        Check that items are only returned for the same uid, input values and recipe that they were stored with,
+        both from memory and from disk.
+        """
+
+        values_hash = self._cache.values_hash(np.ones((2, 100)))
+        other_values_hash = self._cache.values_hash(2 * np.ones((2, 100)))
+        self._cache.store(uid="star0", values_hash=values_hash, recipe_hash=self._recipe_hash, item=np.arange(5.))
+
+        for cache in (self._cache, fourgp_degrade.DegradationCache(cache_directory=self._cache_directory)):
+            self.assertTrue(np.array_equal(cache.fetch(uid="star0", values_hash=values_hash,
+                                                       recipe_hash=self._recipe_hash), np.arange(5.)))
+            self.assertIsNone(cache.fetch(uid="star0", values_hash=other_values_hash,
+                                          recipe_hash=self._recipe_hash))
+            self.assertIsNone(cache.fetch(uid="star1", values_hash=values_hash,
+                                          recipe_hash=self._recipe_hash))
+
+    def test_modified_source_spectrum(self):
+        """
+        Check that GaussianNoise degrades a spectrum afresh if its values change, even though its uid does not.
+        """
+
+        raster = np.linspace(6000, 7000, 2001)
+        noise_model = fourgp_degrade.GaussianNoise(wavelength_raster=np.geomspace(6100, 6900, 400),
+                                                   snr_list=(1e6,),
+                                                   random_seed=1,
+                                                   degradation_cache=self._cache)
+
+        outputs = []
+        for depth in (0.2, 0.6):
+            values = 1 - depth * np.exp(-0.5 * np.square((raster - 6500) / 0.5))
+            spectra = [fourgp_speclib.Spectrum(wavelengths=raster, values=values,
+                                               value_errors=np.zeros_like(raster), metadata={"uid": "star0"})
+                       for continuum_normalised in (0, 1)]
+            outputs.append(noise_model._degrade_noiseless(spectrum=spectra))
+
+        self.assertFalse(np.allclose(outputs[0], outputs[1]))
+
+
+# Run tests if we are run from command line
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Unit tests for the GaussianNoise class
+"""
+
+import unittest
+import numpy as np
+import fourgp_speclib
+import fourgp_degrade
+
+
+class TestGaussianNoise(unittest.TestCase):
+    def setUp(self):
+        """
+        Create some synthetic spectra on a high-resolution raster, with sloping continua and absorption lines, and
+        an output raster with two arms of different pixel spacing.
+        """
+
+        random_generator = np.random.RandomState(0)
+        input_raster = np.linspace(5700, 6900, 24001)
+        self._output_raster = np.concatenate([np.linspace(5800, 6250, 900), np.linspace(6300, 6800, 2000)])
+        self._snr_list = (10, 50, 200)
+
+        self._spectra_list = []
+        for index in range(3):
+            centres = random_generator.uniform(5700, 6900, (60, 1))
+            continuum_normalised = np.prod(1 - 0.5 * np.exp(-0.5 * np.square((input_raster - centres) / 0.3)), axis=0)
+            continuum = (1 + index) * (1 + 2e-4 * (input_raster - 6300))
+            self._spectra_list.append([fourgp_speclib.Spectrum(wavelengths=input_raster,
+                                                               values=continuum * continuum_normalised,
+                                                               value_errors=np.zeros_like(input_raster),
+                                                               metadata={"index": index}),
+                                       fourgp_speclib.Spectrum(wavelengths=input_raster,
+                                                               values=continuum_normalised,
+                                                               value_errors=np.zeros_like(input_raster),
+                                                               metadata={"index": index})])
+
+    def _noise_model(self, random_seed):
+        """
+        Create a GaussianNoise instance which degrades spectra onto our output raster, at our list of SNRs.
+        """
+
+        return fourgp_degrade.GaussianNoise(wavelength_raster=self._output_raster,
+                                            snr_list=self._snr_list,
+                                            random_seed=random_seed)
+
+    def _reference_noise_cube(self, noise_model, random_seed):
+        """
+        Add noise to each spectrum at each SNR in turn, and to each wavelength arm in turn, as in the original
+        version of <GaussianNoise.process_spectra>.
+        """
+
+        random_generator = np.random.default_rng(random_seed)
+        output = {"values": [], "value_errors": [], "values_cn": [], "value_errors_cn": []}
+
+        for spectrum in self._spectra_list:
+            degradation = fourgp_degrade.DegradationOperator.for_arms(input_raster=spectrum[0].wavelengths,
+                                                                      wavelength_arms=noise_model.wavelength_arms)
+            degraded_values = degradation.degrade_values(np.vstack([item.values for item in spectrum]))
+            continuum = degraded_values[0] / degraded_values[1]
+
+            mean_signal_per_pixel = {}
+            for snr_definition_name, wavelength_min, wavelength_max in noise_model.snr_definitions:
+                indices = (wavelength_min <= self._output_raster) * (self._output_raster <= wavelength_max)
+                mean_signal_per_pixel[snr_definition_name] = np.sum(continuum[indices]) / np.sum(indices)
+
+            for key in output:
+                output[key].append([])
+
+            for snr_value in self._snr_list:
+                values = []
+                value_errors = []
+                for index_arm, (raster, pixel_spacing) in enumerate(noise_model.wavelength_arms):
+                    noise_level = mean_signal_per_pixel[noise_model.use_snr_definitions[index_arm]] / snr_value
+                    noise = random_generator.standard_normal(size=len(raster)) * noise_level
+                    values.append(degradation.arm_values(degraded_values[0], index_arm) + noise)
+                    value_errors.append(np.ones(len(raster)) * noise_level)
+
+                values = np.concatenate(values)
+                value_errors = np.concatenate(value_errors)
+                output["values"][-1].append(values)
+                output["value_errors"][-1].append(value_errors)
+                output["values_cn"][-1].append(values / continuum)
+                output["value_errors_cn"][-1].append(value_errors / continuum)
+
+        return dict((key, np.asarray(value)) for key, value in output.items())
+
+    def test_shape(self):
+        """
+        Check that the noise cube has one row per spectrum and SNR, with one pixel per pixel of the output raster.
+        """
+
+        noise_model = self._noise_model(random_seed=1)
+        self.assertEqual(len(noise_model.wavelength_arms), 2)
+
+        cube = noise_model.noise_cube(spectra_list=self._spectra_list)
+        for key in ("values", "value_errors", "values_cn", "value_errors_cn"):
+            self.assertEqual(cube[key].shape,
+                             (len(self._spectra_list), len(self._snr_list), self._output_raster.shape[0]))
+
+    def test_reproducible(self):
+        """
+        Check that noise is reproducible when a random seed is given, and differs between seeds.
+        """
+
+        cube = self._noise_model(random_seed=1).noise_cube(spectra_list=self._spectra_list)
+        cube_same_seed = self._noise_model(random_seed=1).noise_cube(spectra_list=self._spectra_list)
+        cube_other_seed = self._noise_model(random_seed=2).noise_cube(spectra_list=self._spectra_list)
+
+        for key in ("values", "value_errors", "values_cn", "value_errors_cn"):
+            self.assertTrue(np.array_equal(cube[key], cube_same_seed[key]))
+        self.assertFalse(np.allclose(cube["values"], cube_other_seed["values"]))
+        self.assertTrue(np.array_equal(cube["value_errors"], cube_other_seed["value_errors"]))
+
+        # Resetting the seed reproduces the same noise again
+        noise_model = self._noise_model(random_seed=1)
+        noise_model.noise_cube(spectra_list=self._spectra_list)
+        noise_model.set_random_seed(1)
+        self.assertTrue(np.array_equal(noise_model.noise_cube(spectra_list=self._spectra_list)["values"],
+                                       cube["values"]))
+
+    def test_matches_per_spectrum_path(self):
+        """
+        Check that the noise cube gives the same noisy spectra and errors at each SNR as adding noise to each
+        spectrum, SNR and wavelength arm in turn, when noise is drawn from the same random number generator.
+        """
+
+        noise_model = self._noise_model(random_seed=3)
+        cube = noise_model.noise_cube(spectra_list=self._spectra_list)
+        expected = self._reference_noise_cube(noise_model=noise_model, random_seed=3)
+
+        for key in ("values", "value_errors", "values_cn", "value_errors_cn"):
+            self.assertTrue(np.allclose(cube[key], expected[key], rtol=1e-10, atol=0))
+
+        # At each SNR, the noise is standard normal in units of the quoted errors
+        noiseless_flux = np.asarray([noise_model._degrade_noiseless(spectrum)[0] for spectrum in self._spectra_list])
+        for index_snr in range(len(self._snr_list)):
+            pulls = (cube["values"][:, index_snr] - noiseless_flux) / cube["value_errors"][:, index_snr]
+            self.assertLess(abs(np.mean(pulls)), 0.05)
+            self.assertLess(abs(np.std(pulls) - 1), 0.05)
+
+
+# Run tests if we are run from command line
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Unit tests for the InterpolationPlan class
+"""
+
+import unittest
+import numpy as np
+import fourgp_degrade
+
+
+class TestInterpolationPlan(unittest.TestCase):
+    def setUp(self):
+        """
+        Create some random spectra on an irregular raster, and an output raster which overhangs both of its ends.
+        """
+
+        random_generator = np.random.RandomState(0)
+        self._input_raster = np.sort(random_generator.uniform(6000, 7000, 500))
+        self._values = 1 + 0.1 * random_generator.random_sample((3, self._input_raster.shape[0]))
+        self._output_raster = np.linspace(5990, 7010, 2000)
+
+    def test_matches_numpy(self):
+        """
+        Check that the plan gives the same answer as <np.interp>, including beyond the ends of the input raster.
+        """
+
+        plan = fourgp_degrade.InterpolationPlan.for_rasters(input_raster=self._input_raster,
+                                                            output_raster=self._output_raster)
+        output = plan.interpolate_values(values=self._values)
+        for index in range(self._values.shape[0]):
+            expected = np.interp(self._output_raster, self._input_raster, self._values[index])
+            self.assertTrue(np.allclose(output[index], expected, rtol=1e-12, atol=0))
+
+    def test_duplicate_wavelengths(self):
+        """
+        Check that repeated wavelengths, including at both ends of the input raster, do not give NaN weights, and
+        that output wavelengths beyond the ends take the value of the end pixel.
+        """
+
+        input_raster = self._input_raster.copy()
+        input_raster[1] = input_raster[0]
+        input_raster[250] = input_raster[249]
+        input_raster[-2] = input_raster[-1]
+        output_raster = np.concatenate([self._output_raster, input_raster[[0, 249, -1]]])
+
+        plan = fourgp_degrade.InterpolationPlan(input_raster=input_raster, output_raster=output_raster)
+        self.assertTrue(np.all(np.isfinite(plan.weights)))
+
+        output = plan.interpolate_values(values=self._values)
+        self.assertTrue(np.all(np.isfinite(output)))
+
+        below = output_raster < input_raster[0]
+        above = output_raster > input_raster[-1]
+        self.assertTrue(np.any(below) and np.any(above))
+        self.assertTrue(np.array_equal(output[:, below], np.repeat(self._values[:, [0]], np.sum(below), axis=1)))
+        self.assertTrue(np.array_equal(output[:, above], np.repeat(self._values[:, [-1]], np.sum(above), axis=1)))
+
+        # Between the repeated wavelengths, the result is the same as interpolating on the raster either side
+        inside = ~below & ~above & ~np.isin(output_raster, input_raster[[0, 249, -1]])
+        for index in range(self._values.shape[0]):
+            expected = np.interp(output_raster[inside], input_raster, self._values[index])
+            self.assertTrue(np.allclose(output[index, inside], expected, rtol=1e-12, atol=0))
+
+
+# Run tests if we are run from command line
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Unit tests for the LibraryDegrader class
+"""
+
+from os import path as os_path
+import uuid
+import unittest
+import numpy as np
+import fourgp_speclib
+import fourgp_degrade
+
+
+class TestLibraryDegrader(unittest.TestCase):
+    def setUp(self):
+        """
+        Create an input library containing the flux-normalised and continuum-normalised spectra of six objects.
+        """
+
+        self._libraries = []
+        self._input_library = self._create_library()
+
+        raster = np.linspace(6000, 7000, 2001)
+        random_generator = np.random.RandomState(0)
+        for index in range(6):
+            continuum = 1 + 0.1 * random_generator.random_sample()
+            lines = 1 - 0.5 * np.exp(-0.5 * np.square((raster - random_generator.uniform(6100, 6900, (20, 1))) / 0.3))
+            continuum_normalised = np.prod(lines, axis=0)
+            for flag, values in ((0, continuum * continuum_normalised), (1, continuum_normalised)):
+                spectrum = fourgp_speclib.Spectrum(wavelengths=raster,
+                                                   values=values,
+                                                   value_errors=np.zeros_like(raster),
+                                                   metadata={"uid": "star{:d}".format(index),
+                                                             "continuum_normalised": flag})
+                self._input_library.insert(spectrum, "star{:d}_{:d}".format(index, flag))
+
+        self._recipe = {"wavelength_raster": np.geomspace(6100, 6900, 400),
+                        "snr_list": (10, 50),
+                        "random_seed": 1}
+
+    def _create_library(self):
+        unique_filename = uuid.uuid4()
+        db_path = os_path.join("/tmp", "speclib_test_{}".format(unique_filename))
+        library = fourgp_speclib.SpectrumLibrarySqlite(path=db_path, create=True)
+        self._libraries.append(library)
+        return library
+
+    def _degrade(self, output_library):
+        degrader = fourgp_degrade.LibraryDegrader(input_library=self._input_library,
+                                                  output_library=output_library,
+                                                  recipe=self._recipe,
+                                                  batch_size=4,
+                                                  processes=1)
+        return degrader.run()
+
+    @staticmethod
+    def _read_output(library):
+        """
+        Return a dictionary of the values of each output spectrum, indexed by uid, SNR and continuum normalisation.
+        """
+        ids = [item['specId'] for item in library.search()]
+        spectra = library.open(ids=ids)
+        output = {}
+        for index, metadata in enumerate(spectra.metadata_list):
+            key = (metadata['uid'], metadata['SNR'], metadata['continuum_normalised'])
+            output[key] = spectra.values[index]
+        return output
+
+    def test_resume_after_interruption(self):
+        """
+        Check that a run which is interrupted part way through writing a batch of spectra can be resumed, and then
+        produces the same output as an uninterrupted run.
+        """
+
+        reference_library = self._create_library()
+        self.assertEqual(self._degrade(reference_library), 6)
+        reference = self._read_output(reference_library)
+        self.assertEqual(len(reference), 6 * 4)
+
+        # Interrupt the run while the third spectrum of the second object is being inserted
+        output_library = self._create_library()
+        set_metadata = output_library.set_metadata
+        call_count = [0]
+
+        def interrupted_set_metadata(*args, **kwargs):
+            call_count[0] += 1
+            if call_count[0] == 7:
+                raise KeyboardInterrupt
+            return set_metadata(*args, **kwargs)
+
+        output_library.set_metadata = interrupted_set_metadata
+        with self.assertRaises(KeyboardInterrupt):
+            self._degrade(output_library)
+        output_library.set_metadata = set_metadata
+
+        # Resuming should degrade the partly written object again, together with those not yet started
+        self.assertEqual(self._degrade(output_library), 5)
+        self.assertEqual(len(output_library.search()), 6 * 4)
+
+        output = self._read_output(output_library)
+        self.assertEqual(sorted(output), sorted(reference))
+        for key in reference:
+            self.assertTrue(np.array_equal(output[key], reference[key]))
+
+        # Nothing remains to be done
+        self.assertEqual(self._degrade(output_library), 0)
+
+    def tearDown(self):
+        """
+        Remove the spectrum libraries.
+        """
+        for library in self._libraries:
+            library.purge()
+
+
+# Run tests if we are run from command line
+if __name__ == '__main__':
+    unittest.main()
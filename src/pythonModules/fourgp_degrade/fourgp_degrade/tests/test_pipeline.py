@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Unit tests for the DegradationPipeline class
+"""
+
+import unittest
+import numpy as np
+import fourgp_speclib
+import fourgp_degrade
+
+
+class TestDegradationPipeline(unittest.TestCase):
+    def setUp(self):
+        """
+        Create some random spectra on a linear raster, and the rasters to resample and interpolate them onto.
+        """
+
+        random_generator = np.random.RandomState(0)
+        self._input_raster = np.linspace(6000, 6200, 2001)
+        self._values = 1 + 0.1 * random_generator.random_sample((4, self._input_raster.shape[0]))
+        self._value_errors = 0.01 + 0.01 * random_generator.random_sample((4, self._input_raster.shape[0]))
+        self._resample_raster = np.geomspace(6010, 6190, 500)
+        self._interpolate_raster = np.linspace(6020, 6180, 300)
+
+        self._linear_stages = [fourgp_degrade.Redden(e_bv=0.3),
+                               fourgp_degrade.Convolve(fwhm=0.5),
+                               fourgp_degrade.Resample(output_raster=self._resample_raster),
+                               fourgp_degrade.Interpolate(output_raster=self._interpolate_raster)]
+
+    def _apply_stages_in_turn(self, stages, wavelengths, values):
+        """
+        Apply a list of linear stages one at a time, each as a separate pipeline, returning the values of the output
+        spectra and the dense matrix of the combined operation.
+        """
+
+        matrix = np.identity(wavelengths.shape[0])
+        for stage in stages:
+            stage_matrix = stage.matrix(wavelengths=wavelengths).toarray()
+            wavelengths, values, _ = fourgp_degrade.DegradationPipeline(stages=[stage]).apply_arrays(
+                wavelengths=wavelengths, values=values, value_errors=np.zeros_like(values))
+            matrix = stage_matrix.dot(matrix)
+        return wavelengths, values, matrix
+
+    def test_fused_matches_stages(self):
+        """
+        Check that a pipeline of linear stages, which are fused into a single matrix, gives the same values as
+        applying each stage in turn. Errors are propagated through the fused matrix in quadrature, which gives the
+        exact variance of each output pixel for independent errors on the input pixels.
+        """
+
+        pipeline = fourgp_degrade.DegradationPipeline(stages=self._linear_stages)
+        wavelengths, values, value_errors = pipeline.apply_arrays(wavelengths=self._input_raster,
+                                                                  values=self._values,
+                                                                  value_errors=self._value_errors)
+
+        # All of the stages are fused into a single step
+        steps = pipeline._plan(wavelengths=self._input_raster,
+                               raster_hash=fourgp_speclib.hash_numpy_array(self._input_raster))
+        self.assertEqual(len(steps), 1)
+
+        expected_wavelengths, expected_values, matrix = self._apply_stages_in_turn(
+            stages=self._linear_stages, wavelengths=self._input_raster, values=self._values)
+
+        self.assertTrue(np.array_equal(wavelengths, expected_wavelengths))
+        self.assertTrue(np.allclose(values, expected_values, rtol=1e-10, atol=0))
+
+        for index in range(self._values.shape[0]):
+            covariance = matrix.dot(np.square(self._value_errors[index])[:, np.newaxis] * matrix.T)
+            self.assertTrue(np.allclose(value_errors[index], np.sqrt(np.diag(covariance)), rtol=1e-10, atol=0))
+
+    def test_diagonal_stage_errors(self):
+        """
+        Check that when only the last of the fused stages correlates neighbouring pixels, the errors match those
+        from applying each stage in turn, and adding errors in quadrature at each stage.
+        """
+
+        stages = self._linear_stages[:2]
+        wavelengths, values, value_errors = fourgp_degrade.DegradationPipeline(stages=stages).apply_arrays(
+            wavelengths=self._input_raster, values=self._values, value_errors=self._value_errors)
+
+        expected_values = self._values
+        expected_errors = self._value_errors
+        for stage in stages:
+            _, expected_values, expected_errors = fourgp_degrade.DegradationPipeline(stages=[stage]).apply_arrays(
+                wavelengths=self._input_raster, values=expected_values, value_errors=expected_errors)
+
+        self.assertTrue(np.allclose(values, expected_values, rtol=1e-10, atol=0))
+        self.assertTrue(np.allclose(value_errors, expected_errors, rtol=1e-10, atol=0))
+
+    def test_noise_breaks_fusion(self):
+        """
+        Check that adding noise between two runs of linear stages splits them into two fused steps, and that noise
+        is added on the raster output by the stages before it.
+        """
+
+        before = self._linear_stages[:2]
+        after = self._linear_stages[2:]
+        pipeline = fourgp_degrade.DegradationPipeline(
+            stages=before + [fourgp_degrade.AddNoise(snr=50, random_seed=1)] + after)
+
+        steps = pipeline._plan(wavelengths=self._input_raster,
+                               raster_hash=fourgp_speclib.hash_numpy_array(self._input_raster))
+        self.assertEqual(len(steps), 3)
+        self.assertIsInstance(steps[1], fourgp_degrade.AddNoise)
+
+        wavelengths, values, value_errors = pipeline.apply_arrays(wavelengths=self._input_raster,
+                                                                  values=self._values,
+                                                                  value_errors=self._value_errors)
+
+        expected = (self._input_raster, self._values, self._value_errors)
+        for stages in (before, [fourgp_degrade.AddNoise(snr=50, random_seed=1)], after):
+            expected = fourgp_degrade.DegradationPipeline(stages=stages).apply_arrays(*expected)
+
+        self.assertTrue(np.array_equal(wavelengths, expected[0]))
+        self.assertTrue(np.allclose(values, expected[1], rtol=1e-10, atol=0))
+        self.assertTrue(np.allclose(value_errors, expected[2], rtol=1e-10, atol=0))
+
+        # The noise has changed the values, compared with the linear stages alone
+        linear = fourgp_degrade.DegradationPipeline(stages=before + after).apply_arrays(
+            wavelengths=self._input_raster, values=self._values, value_errors=self._value_errors)
+        self.assertFalse(np.allclose(values, linear[1], rtol=1e-4, atol=0))
+        self.assertTrue(np.all(value_errors > linear[2]))
+
+    def test_process_batches(self):
+        """
+        Check that spectra on a mixture of rasters are grouped into batches which each share a single raster, that
+        no batch is larger than the requested size, and that the spectra are returned in the order they were input.
+        """
+
+        other_raster = np.linspace(6000, 6200, 1501)
+        rasters = [self._input_raster, self._input_raster, other_raster, self._input_raster, self._input_raster,
+                   self._input_raster, self._input_raster, other_raster, other_raster]
+        random_generator = np.random.RandomState(1)
+        spectra = [fourgp_speclib.Spectrum(wavelengths=raster,
+                                           values=1 + 0.1 * random_generator.random_sample(raster.shape),
+                                           value_errors=np.full_like(raster, 0.01),
+                                           metadata={"index": index})
+                   for index, raster in enumerate(rasters)]
+
+        pipeline = fourgp_degrade.DegradationPipeline(stages=self._linear_stages)
+        batches = list(pipeline.process_batches(spectra=iter(spectra), batch_size=3))
+
+        self.assertEqual([len(batch.metadata_list) for batch in batches], [2, 1, 3, 1, 2])
+        self.assertEqual([metadata["index"] for batch in batches for metadata in batch.metadata_list],
+                         list(range(len(spectra))))
+
+        outputs = [batch.extract_item(index) for batch in batches for index in range(len(batch.metadata_list))]
+        for spectrum, output in zip(spectra, outputs):
+            expected = pipeline.apply(spectrum)
+            self.assertTrue(np.array_equal(output.wavelengths, expected.wavelengths))
+            self.assertTrue(np.allclose(output.values, expected.values, rtol=1e-10, atol=0))
+            self.assertTrue(np.allclose(output.value_errors, expected.value_errors, rtol=1e-10, atol=0))
+
+
+# Run tests if we are run from command line
+if __name__ == '__main__':
+    unittest.main()
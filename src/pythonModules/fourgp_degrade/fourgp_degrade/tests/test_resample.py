@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Unit tests for the ResamplingOperator class
+"""
+
+import unittest
+import numpy as np
+import fourgp_speclib
+import fourgp_degrade
+
+
+class TestResamplingOperator(unittest.TestCase):
+    def setUp(self):
+        """
+        Create some random spectra on a linear raster, and some output rasters which are coarser, finer and
+        overhanging the ends of the input raster.
+        """
+
+        random_generator = np.random.RandomState(0)
+        self._input_raster = np.linspace(6000, 7000, 2001)
+        self._values = 1 + 0.1 * random_generator.random_sample((4, self._input_raster.shape[0]))
+        self._value_errors = 0.01 + 0.01 * random_generator.random_sample((4, self._input_raster.shape[0]))
+        self._output_rasters = (np.geomspace(6100, 6900, 400),
+                                np.linspace(6500, 6510, 500),
+                                np.geomspace(5900, 7100, 800))
+
+    def test_matches_spectrum_resampler(self):
+        """
+        Check that the operator gives the same answer as the original cumulative-integral resampling code.
+        """
+
+        for output_raster in self._output_rasters:
+            operator = fourgp_degrade.ResamplingOperator.for_rasters(input_raster=self._input_raster,
+                                                                     output_raster=output_raster)
+            output = operator.resample_values(values=self._values)
+            for index in range(self._values.shape[0]):
+                expected = fourgp_degrade.SpectrumResampler._resample(x_new=output_raster,
+                                                                      x_in=self._input_raster,
+                                                                      y_in=self._values[index])
+                self.assertTrue(np.allclose(output[index], expected, rtol=1e-10, atol=1e-12))
+                self.assertTrue(np.allclose(operator.resample_values(values=self._values[index]), expected,
+                                            rtol=1e-10, atol=1e-12))
+
+    def test_error_propagation(self):
+        """
+        Check that errors are added in quadrature using the weights of each input pixel.
+        """
+
+        output_raster = self._output_rasters[0]
+        operator = fourgp_degrade.ResamplingOperator.for_rasters(input_raster=self._input_raster,
+                                                                 output_raster=output_raster)
+        weights = operator.matrix.toarray()
+        expected = np.sqrt(np.square(self._value_errors).dot(np.square(weights).T))
+
+        self.assertTrue(np.allclose(operator.resample_errors(value_errors=self._value_errors), expected,
+                                    rtol=1e-12, atol=0))
+
+    def test_apply_to_spectrum_array(self):
+        """
+        Check that resampling a SpectrumArray gives the same result as resampling each Spectrum in turn.
+        """
+
+        output_raster = self._output_rasters[0]
+        spectra = fourgp_speclib.SpectrumArray(wavelengths=self._input_raster,
+                                               values=self._values,
+                                               value_errors=self._value_errors,
+                                               metadata_list=[{} for index in range(self._values.shape[0])])
+        operator = fourgp_degrade.ResamplingOperator.for_rasters(input_raster=self._input_raster,
+                                                                 output_raster=output_raster)
+        output = operator.apply(spectra=spectra)
+
+        for index in range(self._values.shape[0]):
+            spectrum = operator.apply(spectra=spectra.extract_item(index), resample_mask=False)
+            self.assertTrue(np.allclose(output.values[index], spectrum.values, rtol=1e-14, atol=0))
+            self.assertTrue(np.allclose(output.value_errors[index], spectrum.value_errors, rtol=1e-14, atol=0))
+
+
+# Run tests if we are run from command line
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Unit tests for the SNRConverter class
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import fourgp_degrade
+
+
+class TestSNRConverter(unittest.TestCase):
+    def setUp(self):
+        """
+        Create a wavelength raster whose pixel spacing varies along its length, and save it to a text file in a
+        temporary directory.
+        """
+
+        self._raster = np.geomspace(5000, 7000, 3001)
+        self._directory = tempfile.mkdtemp()
+        self._filename = os.path.join(self._directory, "raster.txt")
+        np.savetxt(self._filename, np.transpose([self._raster, np.ones_like(self._raster)]))
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def _reference_pixels_per_angstrom(self, raster, snr_at_wavelength):
+        """
+        The number of pixels per A at a wavelength, measured from the first pixel gap beyond it, as in the original
+        version of <SNRConverter>.
+        """
+
+        return 1.0 / np.diff(raster[raster > float(snr_at_wavelength)])[0]
+
+    def test_raster_from_file(self):
+        """
+        Check that a converter can read its raster from a file, giving the same conversions as a converter passed
+        the raster directly, and that the file is read again if it is modified.
+        """
+
+        converter = fourgp_degrade.SNRConverter(raster_from_file=self._filename)
+        self.assertTrue(np.allclose(converter.raster, self._raster, rtol=1e-15, atol=0))
+        self.assertAlmostEqual(converter.pixels_per_angstrom,
+                               fourgp_degrade.SNRConverter(raster=self._raster).pixels_per_angstrom, places=6)
+
+        # Rewrite the file with a coarser raster, and a later modification time
+        new_raster = np.linspace(5000, 7000, 1001)
+        np.savetxt(self._filename, np.transpose([new_raster, np.ones_like(new_raster)]))
+        modification_time = os.path.getmtime(self._filename) + 10
+        os.utime(self._filename, (modification_time, modification_time))
+
+        converter = fourgp_degrade.SNRConverter(raster_from_file=self._filename)
+        self.assertTrue(np.allclose(converter.raster, new_raster, rtol=1e-15, atol=0))
+        self.assertAlmostEqual(converter.pixels_per_angstrom, 0.5, places=6)
+
+    def test_scalar_conversions(self):
+        """
+        Check the conversions between SNR/pixel and SNR/A at the wavelength passed to the constructor.
+        """
+
+        for snr_at_wavelength in (5000, 6100, 6543.21):
+            converter = fourgp_degrade.SNRConverter(raster=self._raster, snr_at_wavelength=snr_at_wavelength)
+            pixels_per_angstrom = self._reference_pixels_per_angstrom(raster=self._raster,
+                                                                      snr_at_wavelength=snr_at_wavelength)
+            self.assertAlmostEqual(converter.pixels_per_angstrom, pixels_per_angstrom, places=10)
+
+            snr = converter.per_pixel(50)
+            self.assertAlmostEqual(snr.per_pixel(), 50)
+            self.assertAlmostEqual(snr.per_a(), 50 * np.sqrt(pixels_per_angstrom), places=10)
+
+            snr = converter.per_a(50)
+            self.assertAlmostEqual(snr.per_a(), 50)
+            self.assertAlmostEqual(snr.per_pixel(), 50 / np.sqrt(pixels_per_angstrom), places=10)
+
+    def test_array_conversions(self):
+        """
+        Check that converting arrays of SNRs, defined either at the constructor's wavelength or at a wavelength for
+        each SNR, matches converting each of them in turn with a converter for that wavelength.
+        """
+
+        converter = fourgp_degrade.SNRConverter(raster=self._raster)
+        values = np.asarray([10., 20., 50., 100., 250.])
+        wavelengths = np.asarray([5000., 5500.5, 6100., 6600., 6999.])
+
+        self.assertTrue(np.allclose(converter.per_pixel_to_per_a(values),
+                                    [converter.per_pixel(value).per_a() for value in values], rtol=1e-12, atol=0))
+        self.assertTrue(np.allclose(converter.per_a_to_per_pixel(values),
+                                    [converter.per_a(value).per_pixel() for value in values], rtol=1e-12, atol=0))
+
+        expected_per_a = [fourgp_degrade.SNRConverter(raster=self._raster,
+                                                      snr_at_wavelength=wavelength).per_pixel(value).per_a()
+                          for value, wavelength in zip(values, wavelengths)]
+        per_a = converter.per_pixel_to_per_a(values, wavelengths=wavelengths)
+        self.assertTrue(np.allclose(per_a, expected_per_a, rtol=1e-12, atol=0))
+        self.assertTrue(np.allclose(converter.per_a_to_per_pixel(per_a, wavelengths=wavelengths), values,
+                                    rtol=1e-12, atol=0))
+
+
+# Run tests if we are run from command line
+if __name__ == '__main__':
+    unittest.main()
@@ -10,7 +10,7 @@ import numpy as np
 import astropy.io.fits as fits
 import logging
 
-from fourgp_speclib import Spectrum
+from fourgp_speclib import Spectrum, Photometer
 
 from . import config_files
 
@@ -81,6 +81,7 @@ class FourFS:
         self.magnitude = magnitude
         self.magnitude_unreddened = magnitude_unreddened
         self.photometric_band = photometric_band
+        self._photometer = None  # Loaded the first time we need to compute photometry
         self.snr_per_pixel = snr_per_pixel
         self.reference_magnitude = 15.0  # Give all spectra to 4FS normalised to this reference mag in SDSS_r
         self.template_counter = 0
@@ -220,7 +221,9 @@ class FourFS:
                                  metadata={})
 
         # Renormalise spectrum to a standard R-band magnitude
-        magnitude = fits_spectrum.photometry(self.photometric_band)
+        if self._photometer is None:
+            self._photometer = Photometer(bands=(self.photometric_band,))
+        magnitude = self._photometer.magnitude(spectrum=fits_spectrum, band=self.photometric_band)
 
         if self.magnitude_unreddened:
             magnitude -= input_spectrum.metadata["A_{}".format(self.photometric_band)]
@@ -6,8 +6,10 @@ from numpy import RankWarning
 from warnings import simplefilter
 
 from .rv_random import random_radial_velocity
-from .brani_code import RvInstanceBrani
+from .arm_resampling import ArmResamplingOperator
+from .brani_code import ConvolvedTemplateGrid, RvInstanceBrani
 from .cross_correlation import RvInstanceCrossCorrelation
+from .template_cache import TemplateBankCache
 
 __version__ = "20190301.1"
 
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+
+"""
+This module implements the linear operator which maps observed spectra onto the fixed logarithmic raster of a
+4MOST arm, optionally up-sampled, ready for cross-correlation against RV templates.
+
+Resampling onto the arm raster is a sparse linear operation, and so is interpolating the result with a cubic spline
+onto the up-sampled raster: the spline coefficients are the solution of a banded collocation system, whose inverse
+decays exponentially away from the diagonal. We compose the two into a single banded sparse matrix, which depends
+only on the observed raster, the arm raster and the up-sampling factor, and so is built once and cached.
+"""
+
+import logging
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import splu
+
+from fourgp_degrade.resample import ResamplingOperator
+from fourgp_speclib import raster_cache
+
+from .templates_resample import logarithmic_raster
+
+logger = logging.getLogger(__name__)
+
+
+class ArmResamplingOperator(object):
+    """
+    The mapping of observed spectra onto the (optionally up-sampled) fixed logarithmic raster of a 4MOST arm, as used
+    by <RvInstanceCrossCorrelation>. Spectra are resampled with flux conservation, interpolated onto the up-sampled
+    raster with a cubic spline, and renormalised so that the resampled pixels sum to one.
+
+    :ivar np.ndarray input_raster:
+        The wavelength raster of the observed spectra.
+
+    :ivar np.ndarray arm_raster:
+        The fixed logarithmic raster of the arm.
+
+    :ivar int upsampling:
+        The factor by which spectra are up-sampled after they are resampled onto the arm raster.
+
+    :ivar np.ndarray output_raster:
+        The raster of the output spectra; the arm raster, or the up-sampled arm raster.
+
+    :ivar scipy.sparse.csr_matrix matrix:
+        Sparse matrix with shape (n_output_pixels, n_input_pixels), which maps observed spectra onto the output
+        raster, before they are renormalised.
+
+    :ivar np.ndarray normalisation:
+        Vector whose dot product with an observed spectrum is the sum of the pixels of that spectrum once resampled
+        onto the arm raster.
+    """
+
+    # Elements of the inverse of the spline collocation matrix smaller than this are dropped
+    spline_tolerance = 1e-15
+
+    # Elements of the inverse of the spline collocation matrix further than this number of pixels from the diagonal
+    # are dropped. They decay by a factor of about 0.27 per pixel, so are far smaller than <spline_tolerance>.
+    spline_bandwidth = 64
+
+    def __init__(self, input_raster, arm_raster, upsampling=1, input_raster_hash=None):
+        """
+        Instantiate the operator mapping observed spectra onto an arm raster. The matrices are cached in the raster
+        cache, so they are only computed once for each combination of rasters.
+
+        :param input_raster:
+            The wavelength raster of the observed spectra.
+
+        :type input_raster:
+            np.ndarray
+
+        :param arm_raster:
+            The fixed logarithmic raster of the arm.
+
+        :type arm_raster:
+            np.ndarray
+
+        :param upsampling:
+            The integer factor by which to up-sample spectra after they are resampled onto the arm raster. A value
+            of 1 means we don't up sample.
+
+        :type upsampling:
+            int
+
+        :param input_raster_hash:
+            The hash of the input raster, if already known.
+
+        :type input_raster_hash:
+            str
+        """
+
+        self.input_raster = np.asarray(input_raster)
+        self.arm_raster = np.asarray(arm_raster)
+        self.upsampling = int(upsampling)
+
+        item = raster_cache.fetch("rv_arm_resampling_matrix", self.input_raster, raster_hash=input_raster_hash,
+                                  arm_raster=self.arm_raster, upsampling=self.upsampling)
+
+        self.output_raster = item["output_raster"]
+        self.normalisation = item["normalisation"]
+        self.matrix = sparse.csr_matrix((item["data"], item["indices"], item["indptr"]),
+                                        shape=(len(self.output_raster), len(self.input_raster)))
+
+    @staticmethod
+    def upsampled_raster(wavelengths, upsampling_factor):
+        """
+        Return the raster onto which spectra sampled with a fixed logarithmic stride are up-sampled.
+
+        :param wavelengths:
+            The raster with fixed logarithmic stride which we up-sample.
+        :param upsampling_factor:
+            The integer factor by which to up-sample the raster
+        :return:
+            np.ndarray
+        """
+
+        multiplicative_spacing_in = wavelengths[1] / wavelengths[0]
+        multiplicative_spacing_out = pow(multiplicative_spacing_in, 1. / upsampling_factor)
+
+        # We impose an explicit length on the output, because the arange() here is numerically unstable about whether
+        # it includes the final point or not
+        raster_in_length = len(wavelengths)
+        raster_out_length = (raster_in_length - 1) * upsampling_factor
+
+        return logarithmic_raster(lambda_min=wavelengths[0],
+                                  lambda_max=wavelengths[-1],
+                                  lambda_step=wavelengths[0] * (multiplicative_spacing_out - 1)
+                                  )[:raster_out_length]
+
+    @staticmethod
+    def bspline_basis_matrix(x, knots, order):
+        """
+        Evaluate every B-spline basis function on a knot vector at a set of points, using the Cox-de Boor recursion.
+        This is equivalent to <scipy.interpolate.BSpline.design_matrix> with extrapolate=True, which is not available
+        in older versions of scipy. Points beyond the ends of the knot vector are evaluated by extending the first or
+        last polynomial piece.
+
+        :param x:
+            The points at which to evaluate the basis functions.
+        :param knots:
+            The knot vector, which must be non-decreasing.
+        :param order:
+            The order of the spline; 3 for cubic splines.
+        :return:
+            scipy.sparse.csr_matrix with shape (n_points, n_basis_functions)
+        """
+
+        x = np.asarray(x, dtype=np.float64)
+        knots = np.asarray(knots, dtype=np.float64)
+        basis_count = len(knots) - order - 1
+
+        # The index of the knot interval containing each point, [knots[i], knots[i+1]), restricted to the intervals
+        # within the base of the spline
+        interval = np.searchsorted(knots, x, side='right') - 1
+        interval = np.clip(interval, order, basis_count - 1)
+
+        # Values of the order+1 basis functions which are non-zero on each interval, built up one order at a time
+        values = np.zeros((len(x), order + 1))
+        values[:, 0] = 1
+        left = np.zeros((len(x), order + 1))
+        right = np.zeros((len(x), order + 1))
+        for j in range(1, order + 1):
+            left[:, j] = x - knots[interval + 1 - j]
+            right[:, j] = knots[interval + j] - x
+            saved = np.zeros(len(x))
+            for r in range(j):
+                temp = values[:, r] / (right[:, r + 1] + left[:, j - r])
+                values[:, r] = saved + right[:, r + 1] * temp
+                saved = left[:, j - r] * temp
+            values[:, j] = saved
+
+        rows = np.repeat(np.arange(len(x)), order + 1)
+        columns = (interval[:, np.newaxis] - order + np.arange(order + 1)[np.newaxis, :]).flatten()
+
+        return sparse.csr_matrix((values.flatten(), (rows, columns)), shape=(len(x), basis_count))
+
+    @classmethod
+    def spline_matrix(cls, input_raster, output_raster):
+        """
+        Return the sparse matrix which evaluates the interpolating cubic spline through a spectrum at a new set of
+        wavelengths. This is the same spline as <scipy.interpolate.InterpolatedUnivariateSpline>, which uses the
+        not-a-knot end condition.
+
+        :param input_raster:
+            The wavelengths of the spectrum we interpolate.
+        :param output_raster:
+            The wavelengths at which we evaluate the spline.
+        :return:
+            scipy.sparse.csr_matrix with shape (n_output_pixels, n_input_pixels)
+        """
+
+        input_raster = np.asarray(input_raster, dtype=np.float64)
+        length = len(input_raster)
+        order = 3
+        assert length > order, "Cubic spline interpolation requires at least four points."
+
+        knots = np.concatenate([[input_raster[0]] * (order + 1),
+                                input_raster[2:-2],
+                                [input_raster[-1]] * (order + 1)])
+
+        # The spline coefficients are the solution of a banded collocation system
+        collocation = cls.bspline_basis_matrix(x=input_raster, knots=knots, order=order).tocsc()
+        factorisation = splu(collocation)
+
+        # Its inverse decays exponentially away from the diagonal, so columns of the inverse more than twice the
+        # bandwidth apart do not overlap, and can be computed together by solving for the sum of their unit vectors
+        spacing = 2 * cls.spline_bandwidth
+        unit_vectors = np.zeros((length, min(spacing, length)))
+        unit_vectors[np.arange(length), np.arange(length) % spacing] = 1
+        solutions = factorisation.solve(unit_vectors)
+
+        # Extract the band of each column around the diagonal
+        columns = np.repeat(np.arange(length)[:, np.newaxis], 2 * cls.spline_bandwidth + 1, axis=1)
+        rows = columns + np.arange(-cls.spline_bandwidth, cls.spline_bandwidth + 1)[np.newaxis, :]
+        valid = (rows >= 0) & (rows < length)
+        rows, columns = rows[valid], columns[valid]
+        values = solutions[rows, columns % spacing]
+        keep = np.abs(values) >= cls.spline_tolerance
+
+        inverse_collocation = sparse.csr_matrix((values[keep], (rows[keep], columns[keep])), shape=(length, length))
+
+        evaluation = cls.bspline_basis_matrix(x=output_raster, knots=knots, order=order)
+
+        return evaluation.dot(inverse_collocation).tocsr()
+
+    @classmethod
+    def _build_matrix(cls, wavelengths, arm_raster, upsampling):
+        """
+        Builder for the operator mapping observed spectra onto an arm raster, for use by the raster cache.
+
+        :param wavelengths:
+            The wavelength raster of the observed spectra.
+        :param arm_raster:
+            The fixed logarithmic raster of the arm.
+        :param upsampling:
+            The integer factor by which spectra are up-sampled.
+        :return:
+            Dictionary containing the output raster, the normalisation vector, and the data, indices and indptr
+            arrays of a CSR sparse matrix.
+        """
+
+        resampling = ResamplingOperator.for_rasters(input_raster=wavelengths, output_raster=arm_raster).matrix
+
+        matrix = resampling
+        output_raster = np.asarray(arm_raster, dtype=np.float64)
+        if upsampling > 1:
+            output_raster = cls.upsampled_raster(wavelengths=arm_raster, upsampling_factor=upsampling)
+            matrix = cls.spline_matrix(input_raster=arm_raster, output_raster=output_raster).dot(resampling)
+
+        matrix = sparse.csr_matrix(matrix)
+        matrix.sort_indices()
+
+        return {
+            "output_raster": output_raster,
+            "normalisation": np.asarray(resampling.sum(axis=0)).flatten(),
+            "data": matrix.data,
+            "indices": matrix.indices,
+            "indptr": matrix.indptr
+        }
+
+    def apply(self, values, normalise=True):
+        """
+        Map a 1D array of values, or a 2D array of many observed spectra, onto the output raster.
+
+        :param values:
+            Array with shape (n_input_pixels,) or (n_spectra, n_input_pixels).
+        :type values:
+            np.ndarray
+        :param normalise:
+            If true, renormalise each spectrum so that its pixels sum to one once resampled onto the arm raster, as in
+            <RvInstanceCrossCorrelation.resample_single_arm>.
+        :type normalise:
+            bool
+        :return:
+            Array with shape (n_output_pixels,) or (n_spectra, n_output_pixels).
+        """
+
+        values = np.asarray(values, dtype=np.float64)
+        assert values.shape[-1] == len(self.input_raster), \
+            "Spectra are not sampled on the input raster of this operator."
+
+        if values.ndim == 1:
+            output = self.matrix.dot(values)
+        else:
+            output = self.matrix.dot(values.T).T
+
+        if normalise:
+            output /= np.expand_dims(np.dot(values, self.normalisation), axis=-1)
+
+        return output
+
+
+raster_cache.register_builder(product="rv_arm_resampling_matrix", builder=ArmResamplingOperator._build_matrix)
@@ -2,13 +2,30 @@
 
 """
 This module implements a lightly cleaned up version of Branimir Sesar's RV code.
+
+The log-probabilities of all the MCMC walkers are evaluated together, with batched array operations, and the walkers
+are split between a pool of worker processes, which is started once and reused for every star we fit. The grid of
+template spectra is held in multiprocessing shared memory, which the workers attach to when the pool is started, so
+that it is never pickled and sent between processes.
+
+The model convolves each template with a Gaussian whose width is confined by the prior to a narrow range. The grid of
+templates is pre-convolved at a handful of widths within that range, and the likelihood interpolates linearly between
+them, rather than convolving templates each time it is evaluated.
+
+In fast mode, we first search for the maximum a posteriori model with an optimiser, and only run a short MCMC chain
+if the optimum is poorly constrained or fits the spectrum badly.
 """
 
 import numpy as np
-from scipy.stats import norm
+from ctypes import c_double
+from functools import partial
 from multiprocessing import cpu_count
+from multiprocessing.sharedctypes import RawArray
+from scipy.ndimage import gaussian_filter1d
+from scipy.optimize import minimize
 import logging
 import itertools
+import weakref
 import emcee
 from emcee.interruptible_pool import InterruptiblePool
 
@@ -17,6 +34,238 @@ import fourgp_degrade
 
 logger = logging.getLogger(__name__)
 
+# State of each worker process, set up by <_initialise_worker>
+_worker_state = {}
+
+
+def _initialise_worker(wavelengths_shared, values_shared, value_errors_shared, metadata_list, grid_axes,
+                       convolved_values_shared, convolved_sigmas):
+    """
+    Set up a worker process, with a SpectrumArray of template spectra and a ConvolvedTemplateGrid, which are views
+    into the shared memory allocated by the parent process.
+
+    :return:
+        None
+    """
+
+    wavelengths = np.frombuffer(wavelengths_shared)
+    spectrum_count = len(metadata_list)
+
+    _worker_state['template_library'] = fourgp_speclib.SpectrumArray(
+        wavelengths=wavelengths,
+        values=np.frombuffer(values_shared).reshape([spectrum_count, len(wavelengths)]),
+        value_errors=np.frombuffer(value_errors_shared).reshape([spectrum_count, len(wavelengths)]),
+        metadata_list=metadata_list,
+        shared_memory=True
+    )
+    _worker_state['convolved_grid'] = ConvolvedTemplateGrid(
+        sigmas=convolved_sigmas,
+        values_shared=convolved_values_shared,
+        template_count=spectrum_count,
+        pixel_count=len(wavelengths)
+    )
+    _worker_state['grid_axes'] = grid_axes
+
+
+def _worker_log_probability_batch(thetas, observed_spectrum):
+    """
+    Evaluate the log-probabilities of a batch of walker positions in a worker process, using the template spectra
+    attached by <_initialise_worker>. This is a module-level function so that it can be passed to a multiprocessing
+    pool.
+
+    :param thetas:
+        Array with shape (n_walkers, 8), containing floating point values for:
+        [velocity, t_eff, fe_h, log_g, sigma_gauss, c0, c1, c2]
+
+    :param observed_spectrum:
+        A Spectrum object containing the observing spectrum whose radial velocity we're trying to estimate.
+
+    :return:
+        Array of n_walkers log-probability values.
+    """
+
+    return RvInstanceBrani.log_probability_batch(thetas=thetas,
+                                                 template_library=_worker_state['template_library'],
+                                                 observed_spectrum=observed_spectrum,
+                                                 grid_axes=_worker_state['grid_axes'],
+                                                 convolved_grid=_worker_state['convolved_grid'])
+
+
+class ConvolvedTemplateGrid(object):
+    """
+    A grid of template spectra which has been convolved with Gaussians of a small set of widths, held in
+    multiprocessing shared memory. Templates convolved with intermediate widths are interpolated linearly between
+    the two nearest widths.
+
+    :ivar np.ndarray sigmas:
+        The widths, in pixels, of the Gaussians with which the templates have been convolved, in ascending order.
+
+    :ivar np.ndarray values:
+        Array with shape (n_sigmas, n_templates, n_pixels), containing the convolved templates.
+    """
+
+    def __init__(self, sigmas, values_shared, template_count, pixel_count):
+        """
+        Instantiate a grid of convolved templates, as a view into an existing block of shared memory. Normally new
+        grids should be created using <from_templates>.
+
+        :param sigmas:
+            The widths, in pixels, of the Gaussians with which the templates have been convolved, in ascending order.
+
+        :type sigmas:
+            np.ndarray
+
+        :param values_shared:
+            Shared memory array containing the convolved templates.
+
+        :type values_shared:
+            multiprocessing.sharedctypes.RawArray
+
+        :param template_count:
+            The number of template spectra in the grid.
+
+        :type template_count:
+            int
+
+        :param pixel_count:
+            The number of pixels in each template spectrum.
+
+        :type pixel_count:
+            int
+        """
+
+        self.sigmas = np.asarray(sigmas, dtype=np.float64)
+        assert self.sigmas.shape[0] > 1, "Need at least two Gaussian widths to interpolate between."
+        assert np.all(np.diff(self.sigmas) > 0), "Gaussian widths must be in ascending order."
+
+        self.values_shared = values_shared
+        self.values = np.frombuffer(values_shared).reshape([self.sigmas.shape[0], template_count, pixel_count])
+
+    @classmethod
+    def from_templates(cls, template_library, sigmas):
+        """
+        Convolve a grid of template spectra with Gaussians of each of a set of widths, and store the results in
+        shared memory.
+
+        :param template_library:
+            A SpectrumArray object containing the grid of template spectra.
+
+        :type template_library:
+            SpectrumArray
+
+        :param sigmas:
+            The widths, in pixels, of the Gaussians with which to convolve the templates, in ascending order.
+
+        :type sigmas:
+            np.ndarray
+
+        :return:
+            ConvolvedTemplateGrid
+        """
+
+        template_count, pixel_count = template_library.values.shape
+        sigmas = np.asarray(sigmas, dtype=np.float64)
+
+        values_shared = RawArray(c_double, sigmas.shape[0] * template_count * pixel_count)
+        grid = cls(sigmas=sigmas, values_shared=values_shared,
+                   template_count=template_count, pixel_count=pixel_count)
+
+        for sigma_no, sigma in enumerate(sigmas):
+            grid.values[sigma_no] = gaussian_filter1d(input=template_library.values, sigma=sigma, axis=-1)
+
+        return grid
+
+    def interpolate(self, template_numbers, sigmas):
+        """
+        Return templates convolved with Gaussians of arbitrary widths, interpolated linearly between the widths
+        sampled by this grid. Widths outside the sampled range are clipped to it.
+
+        :param template_numbers:
+            Integer array of the indices of the templates to return.
+
+        :param sigmas:
+            Array of the widths, in pixels, of the Gaussian with which each template should be convolved.
+
+        :return:
+            Array with shape (n_items, n_pixels).
+        """
+
+        position = np.interp(sigmas, self.sigmas, np.arange(self.sigmas.shape[0]))
+        lower = np.clip(np.floor(position).astype(int), 0, self.sigmas.shape[0] - 2)
+        weights = (position - lower)[:, np.newaxis]
+
+        return (self.values[lower, template_numbers] * (1 - weights) +
+                self.values[lower + 1, template_numbers] * weights)
+
+
+class _WalkerBatchMap(object):
+    """
+    Stand-in for the pool of workers passed to <emcee.EnsembleSampler>, which evaluates the log-probabilities of all
+    of the walkers with a single call to <RvInstanceBrani.log_probability_batch>, rather than calling the
+    log-probability function once per walker. If a pool of worker processes is supplied, the walkers are split into
+    one batch per worker.
+    """
+
+    def __init__(self, template_library, observed_spectrum, grid_axes, convolved_grid=None, pool=None,
+                 batch_count=1):
+        """
+        :param template_library:
+            A SpectrumArray object containing the grid of template spectra. Only used if no pool of workers is
+            supplied; otherwise the workers use the copy attached by <_initialise_worker>.
+
+        :param observed_spectrum:
+            A Spectrum object containing the observing spectrum whose radial velocity we're trying to estimate.
+
+        :param grid_axes:
+            A list of the stellar-parameter axes sampled by template_library.
+
+        :param convolved_grid:
+            A ConvolvedTemplateGrid of pre-convolved templates, or None to convolve templates on the fly. Only used if
+            no pool of workers is supplied.
+
+        :param pool:
+            A pool of worker processes set up by <_initialise_worker>, or None to evaluate walkers in this process.
+
+        :param batch_count:
+            The number of batches to split the walkers into, when using a pool of workers.
+        """
+
+        self._template_library = template_library
+        self._observed_spectrum = observed_spectrum
+        self._grid_axes = grid_axes
+        self._convolved_grid = convolved_grid
+        self._pool = pool
+        self._batch_count = batch_count
+
+    def map(self, function, positions):
+        """
+        Evaluate the log-probabilities of a list of walker positions. The function passed by emcee, which evaluates
+        a single walker, is not used.
+
+        :param function:
+            The per-walker log-probability function supplied by emcee; ignored.
+
+        :param positions:
+            List of walker position vectors.
+
+        :return:
+            List of log-probability values.
+        """
+
+        thetas = np.array(list(positions), dtype=np.float64)
+
+        if self._pool is None:
+            return list(RvInstanceBrani.log_probability_batch(thetas=thetas,
+                                                              template_library=self._template_library,
+                                                              observed_spectrum=self._observed_spectrum,
+                                                              grid_axes=self._grid_axes,
+                                                              convolved_grid=self._convolved_grid))
+
+        batches = np.array_split(thetas, min(self._batch_count, len(thetas)))
+        results = self._pool.map(partial(_worker_log_probability_batch, observed_spectrum=self._observed_spectrum),
+                                 batches)
+        return list(np.concatenate(results))
+
 
 class RvInstanceBrani(object):
     """
@@ -47,13 +296,32 @@ class RvInstanceBrani(object):
     # MCMC code requires a vector of parameters to explore. This is the ordering of parameters in the vector
     mcmc_parameter_order = ["velocity", "Teff", "Fe/H", "log_g", "sigma_gauss", "c0", "c1", "c2"]
 
+    # Widths, in pixels, of the Gaussians with which the grid of template spectra is pre-convolved. The prior confines
+    # sigma_gauss to the range 1 to 1.3, and interpolating between these widths is accurate to 2.5e-4 of the continuum,
+    # even for deep lines narrower than a pixel
+    grid_convolution_sigmas = np.linspace(1.0, 1.3, 7)
+
+    # Settings for fast mode. If no initial guess is supplied for the radial velocity, we scan velocities with this
+    # step (km/s) to find a starting point
+    fast_velocity_scan_step = 5
+
+    # Maximum number of times we alternate between picking the best template and optimising velocity and sigma_gauss
+    fast_iterations = 3
+
+    # Step (km/s) between the velocities used to measure the curvature of the posterior about its maximum
+    fast_curvature_step = 2
+
+    # We fall back to a short MCMC run if the radial velocity uncertainty (km/s) or reduced chi-squared exceed these
+    fast_maximum_velocity_error = 5
+    fast_maximum_reduced_chi_squared = 3
+
     # Define the mesh of parameter values sampled in grid of template spectra
     grid_axis_values = [np.arange(axis[1], axis[2], axis[3]) for axis in grid_axes]
 
     # Total number of template spectra
     expected_number_spectra = np.prod([i.shape[0] for i in grid_axis_values])
 
-    def __init__(self, spectrum_library, threads=None):
+    def __init__(self, spectrum_library, threads=None, fast_mode=False):
         """
         Instantiate the RV code, and read from disk the library of template spectra.
         
@@ -64,10 +332,19 @@ class RvInstanceBrani(object):
             SpectrumLibrary
 
         :param threads:
-            The number of concurrent CPU threads to use.
+            The number of concurrent CPU threads to use, by default the number of CPUs. If 1, walkers are evaluated
+            in this process without starting a pool of workers. Otherwise the pool is kept running between fits, so
+            call <close>, or use this instance as a context manager, when you have finished with it.
 
         :type threads:
             int
+
+        :param fast_mode:
+            If true, fit spectra by optimising the posterior, only running a short MCMC chain where the optimum is
+            poorly constrained. Otherwise, always run a full MCMC chain.
+
+        :type fast_mode:
+            bool
         """
 
         assert isinstance(spectrum_library, fourgp_speclib.SpectrumLibrary), \
@@ -103,8 +380,34 @@ class RvInstanceBrani(object):
             assert len(matches) == 1, "Could not find spectrum matching {}".format(search_criteria)
             grid_spectrum_ids.append(matches[0]['specId'])
 
-        # Load library of template spectra
-        self._template_spectra = self._spectrum_library.open(ids=grid_spectrum_ids, shared_memory=True)
+        # Load library of template spectra, and copy it into shared memory which we pass to the worker processes
+        template_spectra = self._spectrum_library.open(ids=grid_spectrum_ids)
+
+        self._shared_arrays = (RawArray(c_double, template_spectra.wavelengths.size),
+                               RawArray(c_double, template_spectra.values.size),
+                               RawArray(c_double, template_spectra.value_errors.size))
+
+        wavelengths, values, value_errors = [np.frombuffer(item) for item in self._shared_arrays]
+        wavelengths[:] = template_spectra.wavelengths
+        values[:] = template_spectra.values.flatten()
+        value_errors[:] = template_spectra.value_errors.flatten()
+
+        self._template_spectra = fourgp_speclib.SpectrumArray(
+            wavelengths=wavelengths,
+            values=values.reshape(template_spectra.values.shape),
+            value_errors=value_errors.reshape(template_spectra.value_errors.shape),
+            metadata_list=template_spectra.metadata_list,
+            shared_memory=True
+        )
+
+        # Pre-convolve the template spectra, also in shared memory
+        self._convolved_templates = ConvolvedTemplateGrid.from_templates(template_library=self._template_spectra,
+                                                                         sigmas=self.grid_convolution_sigmas)
+
+        # Pool of worker processes, which is started when we first fit a spectrum. The finalizer terminates it if
+        # this instance is garbage collected, or the interpreter exits, without <close> being called.
+        self._pool = None
+        self._pool_finalizer = None
 
         # Default parameters for MCMC
         self.n_dim = 8  # Number of parameters in the model
@@ -112,6 +415,61 @@ class RvInstanceBrani(object):
         self.n_burn = 1000  # Length of the "burn-in" period to let chains stabilize
         self.n_steps = 1300
 
+        # Parameters for the short MCMC chains used when fast mode cannot constrain the radial velocity
+        self.fast_mode = fast_mode
+        self.n_burn_fast = 100
+        self.n_steps_fast = 200
+
+    def _worker_pool(self):
+        """
+        Return the pool of worker processes used to evaluate the log-probabilities of the MCMC walkers, starting it if
+        it is not already running.
+
+        :return:
+            InterruptiblePool, or None if we are not using a pool of workers.
+        """
+
+        if self._threads <= 1:
+            return None
+
+        if self._pool is None:
+            self._pool = InterruptiblePool(processes=self._threads,
+                                           initializer=_initialise_worker,
+                                           initargs=self._shared_arrays + (self._template_spectra.metadata_list,
+                                                                           self.grid_axes,
+                                                                           self._convolved_templates.values_shared,
+                                                                           self._convolved_templates.sigmas))
+            self._pool_finalizer = weakref.finalize(self, self._pool.terminate)
+        return self._pool
+
+    def close(self):
+        """
+        Shut down the pool of worker processes, if it has been started. It is restarted if any more spectra are fit.
+
+        :return:
+            None
+        """
+
+        if self._pool is not None:
+            self._pool_finalizer.detach()
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            self._pool_finalizer = None
+
+    def __enter__(self):
+        """
+        Allow the RV code to be used as a context manager, which shuts down its pool of worker processes on exit.
+
+        :return:
+            RvInstanceBrani
+        """
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     @classmethod
     def from_spectrum_library_sqlite(cls, library_path, *args, **kwargs):
         """
@@ -166,15 +524,83 @@ class RvInstanceBrani(object):
             template_number += axis_position
         return template_library.extract_item(template_number)
 
+    @staticmethod
+    def template_numbers(grid_axes, axis_values):
+        """
+        Vectorised equivalent of <pick_template_spectrum>, which returns the indices within the template library of
+        the template spectra which most closely match many sets of stellar parameters.
+
+        :param grid_axes:
+            A list of the stellar parameters which are varied in the template library, as in
+            <pick_template_spectrum>.
+
+        :param axis_values:
+            Array with shape (n_items, n_axes), containing the values of each stellar parameter, in the same order as
+            grid_axes.
+
+        :return:
+            Integer array of n_items template indices.
+        """
+
+        axis_values = np.asarray(axis_values, dtype=np.float64)
+        template_numbers = np.zeros(axis_values.shape[0], dtype=int)
+        for axis_no, axis in enumerate(grid_axes):
+            axis_length = int(round((axis[2] - axis[1]) / axis[3]))
+            # Round in the same way as <pick_template_spectrum>
+            axis_position = np.trunc(np.round(axis_values[:, axis_no] - axis[1]) / axis[3]).astype(int)
+            axis_position = np.clip(axis_position, 0, axis_length - 1)
+            template_numbers = template_numbers * axis_length + axis_position
+        return template_numbers
+
+    @staticmethod
+    def gaussian_convolve_batch(values, sigmas, truncate=4.0):
+        """
+        Convolve each of a batch of spectra with a Gaussian of a different width, giving the same results as
+        <scipy.ndimage.gaussian_filter1d>, with the ends of each spectrum reflected. The kernels used by the Brani
+        model are only a few pixels wide, so we sum shifted copies of the spectra rather than using FFTs.
+
+        :param values:
+            Array with shape (n_spectra, n_pixels).
+
+        :param sigmas:
+            Array of n_spectra standard deviations, in pixels.
+
+        :param truncate:
+            The number of standard deviations at which each Gaussian kernel is truncated.
+
+        :return:
+            Array with shape (n_spectra, n_pixels).
+        """
+
+        sigmas = np.asarray(sigmas, dtype=np.float64)
+        radii = (truncate * sigmas + 0.5).astype(int)
+        max_radius = int(np.max(radii)) if radii.size else 0
+        offsets = np.arange(-max_radius, max_radius + 1)
+
+        # Normalised kernel for each spectrum, which is zero beyond that spectrum's own radius
+        kernels = np.exp(-0.5 * np.square(offsets[np.newaxis, :] / sigmas[:, np.newaxis]))
+        kernels[np.abs(offsets[np.newaxis, :]) > radii[:, np.newaxis]] = 0
+        kernels /= np.sum(kernels, axis=1)[:, np.newaxis]
+
+        length = values.shape[1]
+        padded = np.pad(values, pad_width=[(0, 0), (max_radius, max_radius)], mode='symmetric')
+        output = np.zeros_like(values, dtype=np.float64)
+        for offset_no in range(offsets.shape[0]):
+            output += kernels[:, offset_no, np.newaxis] * padded[:, offset_no:offset_no + length]
+        return output
+
     # This method has to be static because class instances cannot be passed between threads if using a multiprocessing
     # pool of workers
     @staticmethod
-    def log_probability(theta, template_library, observed_spectrum, grid_axes):
+    def log_probability_batch(thetas, template_library, observed_spectrum, grid_axes, convolved_grid=None):
         """
-        This is the log-probability function which we use an MCMC chain to sample.
+        Evaluate the log-probability function for many walkers at once. This gives the same results as
+        <log_probability>, but the templates for all of the walkers are picked, convolved, Doppler shifted and
+        interpolated with batched array operations, and the Gaussian log-likelihood is evaluated in closed form.
 
-        :param theta:
-            A vector containing floating point values for: [velocity, t_eff, fe_h, log_g, sigma_gauss, c0, c1, c2]
+        :param thetas:
+            Array with shape (n_walkers, 8), containing floating point values for:
+            [velocity, t_eff, fe_h, log_g, sigma_gauss, c0, c1, c2]
 
         :param template_library:
             A SpectrumArray object containing a grid of template continuum-normalised spectra at various stellar
@@ -186,66 +612,281 @@ class RvInstanceBrani(object):
         :param grid_axes:
             A list of the stellar-parameter axes sampled by template_library.
 
+        :param convolved_grid:
+            Optional ConvolvedTemplateGrid containing template_library pre-convolved with Gaussians of several widths.
+            If supplied, convolved templates are interpolated from it, instead of being convolved on the fly.
+
         :return:
-            A floating-point log-probability value.
+            Array of n_walkers log-probability values.
+        """
+
+        return RvInstanceBrani._evaluate_walkers(thetas=thetas, template_library=template_library,
+                                                 observed_spectrum=observed_spectrum, grid_axes=grid_axes,
+                                                 convolved_grid=convolved_grid)[0]
+
+    @staticmethod
+    def _evaluate_walkers(thetas, template_library, observed_spectrum, grid_axes, convolved_grid=None,
+                          fit_continuum=False):
         """
+        Evaluate the log-probability function for many walkers at once, as in <log_probability_batch>, optionally
+        replacing the continuum coefficients of each walker with their maximum-likelihood values. The model is linear
+        in the continuum coefficients, so these are found by weighted linear least squares.
+
+        :param thetas:
+            Array with shape (n_walkers, 8), containing floating point values for:
+            [velocity, t_eff, fe_h, log_g, sigma_gauss, c0, c1, c2]
+
+        :param fit_continuum:
+            If true, fit the continuum coefficients of each walker, rather than using the values in thetas.
 
-        # Unpack stellar parameters from vector passed by optimiser
+        :return:
+            Tuple of (array of n_walkers log-probabilities, copy of thetas with any fitted continuum coefficients,
+            array of n_walkers reduced chi-squared values).
+        """
+
+        thetas = np.array(np.atleast_2d(thetas), dtype=np.float64)
+        output = np.full(thetas.shape[0], -np.inf)
+        reduced_chi_squared = np.full(thetas.shape[0], np.nan)
+
+        # Unpack stellar parameters from the vectors passed by optimiser
         # This must match self.mcmc_parameter_order above
         # velocity has units of km/s
-        velocity, t_eff, fe_h, log_g, sigma_gauss, c0, c1, c2 = theta
+        velocity, t_eff, fe_h, log_g, sigma_gauss, c0, c1, c2 = thetas.T
+        stellar_parameters = thetas[:, 1:4]
 
         # Return a probability of minus infinity if we are outside bounds of valid parameter space
-        if (np.abs(velocity) > 500) or (sigma_gauss < 1) or (sigma_gauss > 1.3):
-            return -np.inf
+        valid = (np.abs(velocity) <= 500) & (sigma_gauss >= 1) & (sigma_gauss <= 1.3)
 
         # Check that stellar parameters are within the range of values spanned by template spectra
-        for axis_no, axis_value in enumerate([t_eff, fe_h, log_g]):
-            axis = grid_axes[axis_no]
-            if ((axis_value <= axis[1] - axis[3] / 2) or
-                    (axis_value >= axis[2] + axis[3] / 2)):
-                return -np.inf
-
-        # Pick a template
-        template_spectrum = RvInstanceBrani.pick_template_spectrum(template_library=template_library,
-                                                                   grid_axes=grid_axes,
-                                                                   axis_values={"Teff": t_eff, "Fe/H": fe_h, "log_g": log_g})
-
-        if any(np.isnan(template_spectrum.values)):
-            return -np.inf
-
-        # Convolve the template spectrum with a Gaussian
-        convolver = fourgp_degrade.SpectrumConvolver(template_spectrum)
-        template_convolved = convolver.gaussian_convolve(sigma_gauss)
-
-        # Shift in wavelength
-        template_observer_frame = template_convolved.apply_radial_velocity(velocity * 1000)  # Unit m/s
-
-        # Interpolate the convolved, Doppler-shifted template onto the observed spectrum's wavelength
-        interpolator = fourgp_degrade.SpectrumInterpolator(template_observer_frame)
-        template_resampled = interpolator.match_to_other_spectrum(other=observed_spectrum,
-                                                                  interpolate_errors=False, interpolate_mask=False)
-
-        # Multiply the template spectrum by the observed spectrum's continuum
-        template_continuum = fourgp_speclib.SpectrumPolynomial(wavelengths=template_resampled.wavelengths,
-                                                               terms=3,
-                                                               coefficients=(c0, c1, c2))
-        template_with_continuum = template_continuum * template_resampled
+        for axis_no, axis in enumerate(grid_axes):
+            valid &= ((stellar_parameters[:, axis_no] > axis[1] - axis[3] / 2) &
+                      (stellar_parameters[:, axis_no] < axis[2] + axis[3] / 2))
+
+        # Pick templates, and convolve them with Gaussians
+        walkers = np.flatnonzero(valid)
+        template_numbers = RvInstanceBrani.template_numbers(grid_axes=grid_axes,
+                                                            axis_values=stellar_parameters[walkers])
+        if convolved_grid is not None:
+            template_convolved = convolved_grid.interpolate(template_numbers=template_numbers,
+                                                            sigmas=sigma_gauss[walkers])
+        else:
+            template_values = template_library.values[template_numbers]
+            template_convolved = RvInstanceBrani.gaussian_convolve_batch(values=template_values,
+                                                                         sigmas=sigma_gauss[walkers])
+
+        # Reject walkers whose templates contain bad data, which spreads into the convolved templates
+        template_good = np.all(np.isfinite(template_convolved), axis=1)
+        walkers = walkers[template_good]
+        if walkers.shape[0] == 0:
+            return output, thetas, reduced_chi_squared
+        template_convolved = template_convolved[template_good]
+
+        # Shift in wavelength, and interpolate linearly onto the observed spectrum's wavelength raster. Instead of
+        # shifting the template raster, we shift the observed raster into each template's rest frame.
+        c = 299792458.0
+        v = velocity[walkers] * 1000  # Unit m/s
+        redshift = np.sqrt((1 + v / c) / (1 - v / c)) - 1
+        template_raster = template_library.wavelengths
+        rest_frame_raster = observed_spectrum.wavelengths[np.newaxis, :] / (1 + redshift[:, np.newaxis])
+
+        lower = np.searchsorted(template_raster, rest_frame_raster, side='right') - 1
+        lower = np.clip(lower, 0, template_raster.shape[0] - 2)
+        weights = np.clip((rest_frame_raster - template_raster[lower]) /
+                          (template_raster[lower + 1] - template_raster[lower]), 0, 1)
+        template_resampled = (np.take_along_axis(template_convolved, lower, axis=1) * (1 - weights) +
+                              np.take_along_axis(template_convolved, lower + 1, axis=1) * weights)
+
+        observed_values = observed_spectrum.values
+        observed_errors = observed_spectrum.value_errors
+        observed_good = observed_spectrum.mask * np.isfinite(observed_values) * (observed_errors > 0)
+
+        # Fit the continuum of each walker by weighted least squares
+        if fit_continuum:
+            thetas[walkers, 5:8] = RvInstanceBrani._fit_continuum_batch(
+                templates=template_resampled,
+                wavelengths=observed_spectrum.wavelengths,
+                values=np.where(observed_good, observed_values, 0),
+                weights=np.where(observed_good, 1 / np.square(np.where(observed_good, observed_errors, 1)), 0))
+            c0, c1, c2 = thetas[:, 5:8].T
+
+        # Multiply the template spectra by the observed spectrum's continuum
+        wavelengths = observed_spectrum.wavelengths[np.newaxis, :]
+        template_with_continuum = template_resampled * (c0[walkers, np.newaxis] +
+                                                        c1[walkers, np.newaxis] * wavelengths +
+                                                        c2[walkers, np.newaxis] * np.square(wavelengths))
 
         # Mask out bad data
-        mask = (observed_spectrum.mask * np.isfinite(observed_spectrum.values) * (observed_spectrum.value_errors > 0) *
-                np.isfinite(template_with_continuum.values))
+        mask = observed_good[np.newaxis, :] * np.isfinite(template_with_continuum)
+
+        # Gaussian log likelihood, evaluated in closed form
+        safe_errors = np.where(mask, observed_errors, 1)
+        chi_squared = np.square((np.where(mask, observed_values, 0) - np.where(mask, template_with_continuum, 0)) /
+                                safe_errors)
+        log_likelihood = -0.5 * np.sum(chi_squared, axis=1) - np.sum(np.log(safe_errors), axis=1) - \
+            0.5 * np.log(2 * np.pi) * np.sum(mask, axis=1)
+
+        # Priors on the width of the Gaussian, and the radial velocity
+        log_likelihood += RvInstanceBrani._gaussian_log_pdf(x=sigma_gauss[walkers], loc=1.15, scale=0.02)
+        log_likelihood += RvInstanceBrani._gaussian_log_pdf(x=velocity[walkers], loc=0, scale=150)
+
+        output[walkers] = log_likelihood - 100000
+        reduced_chi_squared[walkers] = np.sum(chi_squared, axis=1) / np.maximum(np.sum(mask, axis=1) - 5, 1)
+        return output, thetas, reduced_chi_squared
+
+    @staticmethod
+    def _fit_continuum_batch(templates, wavelengths, values, weights):
+        """
+        Find the coefficients of the quadratic continuum, c0 + c1 * lambda + c2 * lambda^2, by which each of a batch
+        of templates should be multiplied to best match an observed spectrum, by weighted linear least squares.
+
+        :param templates:
+            Array with shape (n_templates, n_pixels), containing the templates sampled on the observed raster.
+
+        :param wavelengths:
+            The wavelength raster of the observed spectrum.
+
+        :param values:
+            The values of the observed spectrum.
+
+        :param weights:
+            The weight of each pixel of the observed spectrum; the inverse variance, or zero for masked pixels.
+
+        :return:
+            Array with shape (n_templates, 3), containing the coefficients [c0, c1, c2] for each template.
+        """
+
+        # Solve in terms of a normalised wavelength, to keep the normal equations well conditioned
+        centre = (wavelengths[0] + wavelengths[-1]) / 2
+        scale = max((wavelengths[-1] - wavelengths[0]) / 2, 1e-10)
+        x = (wavelengths - centre) / scale
+
+        # Normal equations of each template, built from weighted moments of the normalised wavelength
+        moments = np.dot(weights[np.newaxis, :] * np.square(templates), np.vander(x, N=5, increasing=True))
+        matrices = moments[:, np.array([[0, 1, 2], [1, 2, 3], [2, 3, 4]])]
+        vectors = np.dot(weights[np.newaxis, :] * values[np.newaxis, :] * templates, np.vander(x, N=3, increasing=True))
+        a, b, d = np.einsum('nij,nj->ni', np.linalg.pinv(matrices), vectors).T
+
+        # Transform coefficients of the normalised wavelength back into coefficients of wavelength
+        return np.stack([a - b * centre / scale + d * centre ** 2 / scale ** 2,
+                         b / scale - 2 * d * centre / scale ** 2,
+                         d / scale ** 2], axis=1)
+
+    @staticmethod
+    def _gaussian_log_pdf(x, loc, scale):
+        """
+        The logarithm of the probability density function of a normal distribution.
+
+        :return:
+            Log-probability density, with the same shape as x.
+        """
+        return -0.5 * np.square((x - loc) / scale) - np.log(scale) - 0.5 * np.log(2 * np.pi)
 
-        # log likelihood
-        log_likelihood = np.sum(norm.logpdf(x=observed_spectrum.values[mask],
-                                            loc=template_with_continuum.values[mask],
-                                            scale=observed_spectrum.value_errors[mask]))
-        log_likelihood += norm.logpdf(x=sigma_gauss, loc=1.15, scale=0.02)
-        log_likelihood += norm.logpdf(x=velocity, loc=0, scale=150)
+    # This method has to be static because class instances cannot be passed between threads if using a multiprocessing
+    # pool of workers
+    @staticmethod
+    def log_probability(theta, template_library, observed_spectrum, grid_axes):
+        """
+        This is the log-probability function which we use an MCMC chain to sample.
 
-        return log_likelihood - 100000
+        :param theta:
+            A vector containing floating point values for: [velocity, t_eff, fe_h, log_g, sigma_gauss, c0, c1, c2]
 
-    def fit_rv(self, observed_spectrum, initial_guesses=None):
+        :param template_library:
+            A SpectrumArray object containing a grid of template continuum-normalised spectra at various stellar
+            parameter values.
+
+        :param observed_spectrum:
+            A Spectrum object containing the observing spectrum whose radial velocity we're trying to estimate.
+
+        :param grid_axes:
+            A list of the stellar-parameter axes sampled by template_library.
+
+        :return:
+            A floating-point log-probability value.
+        """
+
+        return RvInstanceBrani.log_probability_batch(thetas=np.atleast_2d(theta),
+                                                     template_library=template_library,
+                                                     observed_spectrum=observed_spectrum,
+                                                     grid_axes=grid_axes)[0]
+
+    def _run_mcmc(self, observed_spectrum, walker_positions, n_burn, n_steps):
+        """
+        Run an MCMC chain to sample the posterior of the model fitted to an observed spectrum. After the burn-in
+        period, walkers are restarted about the median position of the well-behaved chains.
+
+        :param observed_spectrum:
+            A Spectrum object containing the observed spectrum we are to fit, truncated to the range of the templates.
+
+        :param walker_positions:
+            Array with shape (n_walkers, n_dim), containing the starting position of each walker.
+
+        :param n_burn:
+            The number of steps in the burn-in period.
+
+        :param n_steps:
+            The number of steps to run after the burn-in period.
+
+        :return:
+            emcee.EnsembleSampler
+        """
+
+        # Clip the positions of the walkers to appropriate ranges
+        walker_positions = np.clip(a=walker_positions,
+                                   a_min=[self.grid_axes_min[x] for x in self.mcmc_parameter_order],
+                                   a_max=[self.grid_axes_max[x] for x in self.mcmc_parameter_order])
+
+        # Fetch pool of workers
+        pool = self._worker_pool()
+
+        # initialize the sampler. emcee evaluates the walkers by calling the map method of its pool, which we use to
+        # evaluate them all at once, in one batch per worker. The workers already hold the template spectra, so only
+        # the observed spectrum needs to be sent to them.
+        walker_map = _WalkerBatchMap(template_library=self._template_spectra,
+                                     observed_spectrum=observed_spectrum,
+                                     grid_axes=self.grid_axes,
+                                     convolved_grid=self._convolved_templates,
+                                     pool=pool,
+                                     batch_count=self._threads)
+
+        sampler = emcee.EnsembleSampler(nwalkers=self.n_walkers, dim=self.n_dim,
+                                        lnpostfn=RvInstanceBrani.log_probability,
+                                        pool=walker_map,
+                                        kwargs={"template_library": self._template_spectra,
+                                                "observed_spectrum": observed_spectrum,
+                                                "grid_axes": self.grid_axes})
+
+        # burn-in the chains
+        sampler.run_mcmc(pos0=walker_positions, N=n_burn)
+
+        med = np.median(a=sampler.lnprobability[:, -1])
+        rms = 0.741 * (np.percentile(a=sampler.lnprobability[:, -1], q=75) -
+                       np.percentile(a=sampler.lnprobability[:, -1], q=25))
+
+        # Determine the starting point after burn-in. Eliminate bad chains
+        good_chains = sampler.lnprobability[:, -1] > (med - 3 * rms)
+
+        median_params = np.median(a=sampler.chain[good_chains, -1, :], axis=0)
+        rms_params = 0.741 * (np.percentile(a=sampler.chain[good_chains, -1, :], q=75, axis=0) -
+                              np.percentile(a=sampler.chain[good_chains, -1, :], q=25, axis=0))
+        best = np.random.normal(loc=median_params,
+                                scale=rms_params,
+                                size=(self.n_walkers, self.n_dim))
+
+        # clip the guesses to appropriate ranges
+        best = np.clip(a=best,
+                       a_min=[self.grid_axes_min[x] for x in self.mcmc_parameter_order],
+                       a_max=[self.grid_axes_max[x] for x in self.mcmc_parameter_order])
+
+        # Reset the chains to remove the burn-in samples.
+        sampler.reset()
+
+        # Run the chains for real
+        sampler.run_mcmc(pos0=best, N=n_steps)
+
+        return sampler
+
+    def fit_rv(self, observed_spectrum, initial_guesses=None, fast_mode=None):
         """
         Estimate the radial velocity of the observed specrtrum <observed_spectrum>.
 
@@ -254,12 +895,22 @@ class RvInstanceBrani(object):
 
         :param initial_guesses:
             An optional dictionary of initial guesses for the stellar parameters of this spectrum. If it is not
-            supplied, default values are assumed.
+            supplied, default values are assumed. In fast mode, the optimiser only starts from a supplied radial
+            velocity if this dictionary has the key "velocity"; otherwise it starts from the best velocity on a coarse
+            scan. To seed it with the RV from <RvInstanceCrossCorrelation.estimate_rv>, which is in m/s, pass
+            {"velocity": rv / 1000}.
+
+        :param fast_mode:
+            If true, optimise the posterior rather than running a full MCMC chain; see <_fit_rv_fast>. If None, the
+            setting passed to the constructor is used.
 
         :return:
             A dictionary of stellar parameters, including a radial velocity with key "velocity" (units km/s).
         """
 
+        if fast_mode is None:
+            fast_mode = self.fast_mode
+
         # Initial guesses for stellar parameters
         stellar_labels = self.grid_axes_initial_guesses.copy()
 
@@ -306,61 +957,138 @@ class RvInstanceBrani(object):
         stellar_labels["c1"] = observed_continuum_fit.coefficients[1]
         stellar_labels["c2"] = observed_continuum_fit.coefficients[2]
 
+        if fast_mode:
+            return self._fit_rv_fast(observed_spectrum=observed_shared, stellar_labels=stellar_labels,
+                                     velocity_supplied=initial_guesses is not None and "velocity" in initial_guesses)
+
         # Initialise starting points for MCMC walkers
         theta0 = [stellar_labels[x] for x in self.mcmc_parameter_order]
         walker_positions = np.random.normal(loc=theta0,
                                             scale=[self.grid_axes_step_sizes[x] for x in self.mcmc_parameter_order],
                                             size=(self.n_walkers, self.n_dim))
 
-        # Clip the positions of the walkers to appropriate ranges
-        walker_positions = np.clip(a=walker_positions,
-                                   a_min=[self.grid_axes_min[x] for x in self.mcmc_parameter_order],
-                                   a_max=[self.grid_axes_max[x] for x in self.mcmc_parameter_order])
-        # print [RvInstance.log_probability(walker_positions[i], self._template_spectra, observed_shared, self.grid_axes) for i in range(self.n_walkers)]
-
-        # Start workers
-        pool = InterruptiblePool(processes=self._threads)
+        sampler = self._run_mcmc(observed_spectrum=observed_shared, walker_positions=walker_positions,
+                                 n_burn=self.n_burn, n_steps=self.n_steps)
 
-        # initialize the sampler
-        sampler = emcee.EnsembleSampler(nwalkers=self.n_walkers, dim=self.n_dim, lnpostfn=RvInstanceBrani.log_probability,
-                                        # pool=pool,
-                                        kwargs={"template_library": self._template_spectra,
-                                                "observed_spectrum": observed_shared,
-                                                "grid_axes": self.grid_axes})
+        max_prob = sampler.flatchain[np.argmax(sampler.flatlnprobability)]
+        output = {}
+        for i, par in enumerate(self.mcmc_parameter_order):
+            output[par] = max_prob[i]
 
-        # burn-in the chains
-        sampler.run_mcmc(pos0=walker_positions, N=self.n_burn)
+        return output
 
-        med = np.median(a=sampler.lnprobability[:, -1])
-        rms = 0.741 * (np.percentile(a=sampler.lnprobability[:, -1], q=75) -
-                       np.percentile(a=sampler.lnprobability[:, -1], q=25))
+    def _fit_rv_fast(self, observed_spectrum, stellar_labels, velocity_supplied):
+        """
+        Estimate the radial velocity of an observed spectrum by searching for the maximum a posteriori model, rather
+        than running a full MCMC chain. The continuum coefficients are always fitted by linear least squares. We
+        alternate between picking the best template on the grid, and optimising the velocity and sigma_gauss with a
+        Nelder-Mead simplex. The uncertainty in the velocity is estimated from the curvature of the posterior about
+        its maximum. If this uncertainty is too large, or the best model fits the spectrum badly, we fall back to a
+        short MCMC chain started from the optimum.
 
-        # Determine the starting point after burn-in. Eliminate bad chains
-        good_chains = sampler.lnprobability[:, -1] > (med - 3 * rms)
+        :param observed_spectrum:
+            A Spectrum object containing the observed spectrum we are to fit, truncated to the range of the templates.
 
-        median_params = np.median(a=sampler.chain[good_chains, -1, :], axis=0)
-        rms_params = 0.741 * (np.percentile(a=sampler.chain[good_chains, -1, :], q=75, axis=0) -
-                              np.percentile(a=sampler.chain[good_chains, -1, :], q=25, axis=0))
-        best = np.random.normal(loc=median_params,
-                                scale=rms_params,
-                                size=(self.n_walkers, self.n_dim))
+        :param stellar_labels:
+            Dictionary of initial guesses for each of the parameters in <mcmc_parameter_order>.
 
-        # clip the guesses to appropriate ranges
-        best = np.clip(a=best,
-                       a_min=[self.grid_axes_min[x] for x in self.mcmc_parameter_order],
-                       a_max=[self.grid_axes_max[x] for x in self.mcmc_parameter_order])
+        :param velocity_supplied:
+            If false, the initial guess for the radial velocity is ignored, and we start from the best velocity on a
+            coarse scan.
 
-        # Reset the chains to remove the burn-in samples.
-        sampler.reset()
+        :return:
+            A dictionary of stellar parameters, including a radial velocity with key "velocity" (units km/s), and
+            its uncertainty with key "velocity_error".
+        """
 
-        # Run the chains for real
-        sampler.run_mcmc(pos0=best, N=self.n_steps)
-        pool.terminate()
+        def evaluate(thetas):
+            return RvInstanceBrani._evaluate_walkers(thetas=thetas,
+                                                     template_library=self._template_spectra,
+                                                     observed_spectrum=observed_spectrum,
+                                                     grid_axes=self.grid_axes,
+                                                     convolved_grid=self._convolved_templates,
+                                                     fit_continuum=True)
+
+        theta = np.array([stellar_labels[x] for x in self.mcmc_parameter_order], dtype=np.float64)
+        theta[4] = np.clip(theta[4], self.grid_axes_min["sigma_gauss"], self.grid_axes_max["sigma_gauss"])
+
+        # Scan a coarse grid of velocities, using the initial template
+        if not velocity_supplied:
+            velocities = np.arange(self.grid_axes_min["velocity"], self.grid_axes_max["velocity"] + 1e-6,
+                                   self.fast_velocity_scan_step)
+            thetas = np.repeat(theta[np.newaxis, :], velocities.shape[0], axis=0)
+            thetas[:, 0] = velocities
+            log_probabilities, thetas, _ = evaluate(thetas)
+            theta = thetas[np.argmax(log_probabilities)]
+
+        # Each distinct template on the grid, represented by the stellar parameters of its grid point
+        grid_points = np.array(list(itertools.product(*self.grid_axis_values)), dtype=np.float64)
+        _, unique_points = np.unique(RvInstanceBrani.template_numbers(grid_axes=self.grid_axes,
+                                                                      axis_values=grid_points),
+                                     return_index=True)
+        grid_points = grid_points[unique_points]
+
+        for iteration in range(self.fast_iterations):
+            # Pick the best template at the current velocity and sigma_gauss
+            thetas = np.repeat(theta[np.newaxis, :], grid_points.shape[0], axis=0)
+            thetas[:, 1:4] = grid_points
+            log_probabilities, thetas, _ = evaluate(thetas)
+            template_changed = not np.array_equal(thetas[np.argmax(log_probabilities), 1:4], theta[1:4])
+            theta = thetas[np.argmax(log_probabilities)]
+
+            if iteration > 0 and not template_changed:
+                break
+
+            # Optimise the velocity and sigma_gauss for this template
+            def objective(parameters):
+                trial = theta.copy()
+                trial[[0, 4]] = parameters
+                log_probability = evaluate(trial)[0][0]
+                return -log_probability if np.isfinite(log_probability) else np.inf
+
+            start = theta[[0, 4]]
+            simplex = np.array([start,
+                                start + [self.fast_velocity_scan_step, 0],
+                                start + [0, self.grid_axes_step_sizes["sigma_gauss"]]])
+            result = minimize(objective, x0=start, method='Nelder-Mead',
+                              options={'initial_simplex': simplex, 'xatol': 1e-3, 'fatol': 1e-3})
+            theta[[0, 4]] = result.x
+            theta = evaluate(theta)[1][0]
+
+        # Estimate the velocity uncertainty from the curvature of the posterior, by fitting a parabola to its values
+        # at a few velocities about the optimum
+        offsets = self.fast_curvature_step * np.arange(-2, 3)
+        thetas = np.repeat(theta[np.newaxis, :], offsets.shape[0], axis=0)
+        thetas[:, 0] += offsets
+        log_probabilities, _, reduced_chi_squared = evaluate(thetas)
+
+        velocity_error = np.inf
+        if np.all(np.isfinite(log_probabilities)):
+            curvature = 2 * np.polyfit(offsets, log_probabilities - log_probabilities[2], deg=2)[0]
+            if curvature < 0:
+                velocity_error = 1 / np.sqrt(-curvature)
+
+        output = dict(zip(self.mcmc_parameter_order, theta))
+        output["velocity_error"] = velocity_error
+
+        if velocity_error <= self.fast_maximum_velocity_error and \
+                reduced_chi_squared[2] <= self.fast_maximum_reduced_chi_squared:
+            return output
+
+        logger.info("Optimum poorly constrained (velocity error {:.2f} km/s, reduced chi-squared {:.2f}); "
+                    "running short MCMC chain".format(velocity_error, reduced_chi_squared[2]))
+
+        # Start walkers in a small ball about the optimum
+        scales = np.array([self.grid_axes_step_sizes[x] for x in self.mcmc_parameter_order])
+        scales[0] = min(velocity_error, self.fast_maximum_velocity_error)
+        scales[5:8] = 1e-3 * np.abs(theta[5]) / np.power(np.mean(observed_spectrum.wavelengths), np.arange(3))
+        walker_positions = np.random.normal(loc=theta, scale=scales, size=(self.n_walkers, self.n_dim))
+
+        sampler = self._run_mcmc(observed_spectrum=observed_spectrum, walker_positions=walker_positions,
+                                 n_burn=self.n_burn_fast, n_steps=self.n_steps_fast)
 
         max_prob = sampler.flatchain[np.argmax(sampler.flatlnprobability)]
-        output = {}
-        for i, par in enumerate(self.mcmc_parameter_order):
-            output[par] = max_prob[i]
+        output = dict(zip(self.mcmc_parameter_order, max_prob))
+        output["velocity_error"] = np.std(sampler.flatchain[:, 0])
 
         return output
-
@@ -8,16 +8,19 @@ It is a heavily cleaned up version of Jane Lin's GUESS code, as used by GALAH. O
 """
 
 import logging
+from collections import OrderedDict
 from math import sqrt
 from operator import itemgetter
 
 import fourgp_speclib
 import numpy as np
 from fourgp_degrade.resample import SpectrumResampler
+from scipy import fft
+from scipy.cluster.vq import kmeans2
 from scipy.interpolate import InterpolatedUnivariateSpline
-from scipy.optimize import leastsq
 
-from .templates_resample import logarithmic_raster
+from .arm_resampling import ArmResamplingOperator
+from .template_cache import TemplateBankCache
 
 logger = logging.getLogger(__name__)
 
@@ -25,9 +28,17 @@ logger = logging.getLogger(__name__)
 class RvInstanceCrossCorrelation(object):
     """
     A class which is adapted from Jane Lin's GUESS code, as used by GALAH.
+
+    The input spectrum is cross-correlated against all of the templates for each arm at once, by multiplying its FFT
+    by the FFTs of the tapered templates, which are computed once when this class is instantiated.
     """
 
-    def __init__(self, spectrum_library, upsampling=1):
+    # The maximum number of elements in each block of template FFTs multiplied by input FFTs, to limit memory usage.
+    # Each element is a complex number, so this is 64 MB.
+    correlation_block_elements = 2 ** 22
+
+    def __init__(self, spectrum_library, upsampling=1, template_clusters=None, template_clusters_searched=3,
+                 cache_directory=None):
         """
         Instantiate the RV code, and read from disk the library of template spectra used for cross correlation.
 
@@ -36,8 +47,27 @@ class RvInstanceCrossCorrelation(object):
         :param upsampling:
             The factor by which to up-sample the spectrum before doing cross-correlation. A value of 1 means we don't
             up sample.
+        :param template_clusters:
+            If set, the templates for each arm are divided into this number of clusters of similar spectra, and each
+            input spectrum is first cross-correlated against one representative template from each cluster. It is
+            then cross-correlated against all the members of only the best-matching clusters, and any other templates
+            which could be among the best-fitting templates. If None, every input spectrum is cross-correlated
+            against every template.
+        :param template_clusters_searched:
+            The number of best-matching clusters whose members are all cross-correlated against each input
+            spectrum. Members of other clusters are also searched if they could be among the best-fitting templates.
+        :param cache_directory:
+            If set, the prepared template bank -- the up-sampled, tapered and normalised templates and their FFTs --
+            is saved in this directory, and opened from there as a memory map by later instances using the same
+            template library and settings, rather than being prepared again.
         :type spectrum_library:
             SpectrumLibrary
+        :type template_clusters:
+            int
+        :type template_clusters_searched:
+            int
+        :type cache_directory:
+            str
         """
 
         assert isinstance(spectrum_library, fourgp_speclib.SpectrumLibrary), \
@@ -45,9 +75,15 @@ class RvInstanceCrossCorrelation(object):
 
         self._spectrum_library = spectrum_library
         self.upsampling = upsampling
+        self.template_clusters_searched = template_clusters_searched
+
+        # Operators mapping observed spectra onto each arm raster, indexed by (raster hash, arm name)
+        self._arm_operators = {}
 
         # Load template spectra
         spectrum_list = self._spectrum_library.search(continuum_normalised=1)
+        template_ids = [i["specId"] for i in spectrum_list]
+        metadata_list = self._spectrum_library.get_metadata(ids=template_ids) if template_ids else []
 
         # Make a list of templates by 4MOST wavelength arm
         self.templates_by_arm = {}
@@ -56,8 +92,7 @@ class RvInstanceCrossCorrelation(object):
         self.window_functions = {}
 
         # Sort template spectra by the arm they are sampled on
-        for template_id in [i["specId"] for i in spectrum_list]:
-            template_metadata = self._spectrum_library.get_metadata(ids=(template_id,))[0]
+        for template_id, template_metadata in zip(template_ids, metadata_list):
             mode = template_metadata['mode']
             arm_name = template_metadata['arm_name']
 
@@ -77,53 +112,130 @@ class RvInstanceCrossCorrelation(object):
                     'lambda_step': template_metadata['lambda_step'],
                 }
 
-        # Load library of template spectra for each arm
-        self.template_spectra_raw = {}
+        # Look for a copy of the prepared template bank in the cache
+        template_bank = None
+        if cache_directory is not None:
+            template_cache = TemplateBankCache(cache_directory=cache_directory)
+            cache_key = template_cache.bank_key(spectrum_library=self._spectrum_library,
+                                                template_list=spectrum_list,
+                                                metadata_list=metadata_list,
+                                                upsampling=self.upsampling)
+            template_bank = template_cache.load(key=cache_key)
+
+        if template_bank is not None:
+            manifest, arrays = template_bank
+            metadata_by_id = dict(zip(template_ids, metadata_list))
+            self._open_template_bank(arm_names=manifest['arms'], arrays=arrays, metadata_by_id=metadata_by_id)
+        else:
+            self._prepare_template_bank()
+            if cache_directory is not None:
+                arm_names = sorted(self.template_spectra_tapered)
+                template_cache.save(key=cache_key,
+                                    manifest={"arms": arm_names, "upsampling": self.upsampling},
+                                    arrays=self._template_bank_arrays(arm_names=arm_names))
+
+        self.template_parameters = {}
+
+        for arm_name, templates in self.template_spectra_tapered.items():
+            # Stellar parameters of each template, as a list of (Teff, logg, [Fe/H])
+            self.template_parameters[arm_name] = [(metadata['Teff'], metadata['logg'], metadata['[Fe/H]'])
+                                                  for metadata in templates.metadata_list]
+
+        # Divide the templates for each arm into clusters, if we are doing a coarse-to-fine template search
+        self.template_clusters = {}
+        self.cluster_representatives = {}
+        self._template_cluster_labels = {}
+        self._template_cluster_distances = {}
+
+        if template_clusters is not None:
+            for arm_name in self.template_spectra_tapered:
+                self.cluster_templates(arm_name=arm_name, cluster_count=template_clusters)
+
+    def _arm_template_ids(self):
+        """
+        Return the ids of the templates used for each arm. If an arm appears in more than one mode, the templates
+        listed for the last mode are used.
+
+        :return:
+            Dictionary of lists of template ids, indexed by arm name.
+        """
 
+        arm_template_ids = {}
         for mode in self.templates_by_arm:
             for arm_name in self.templates_by_arm[mode]:
-                self.template_spectra_raw[arm_name] = self._spectrum_library.open(
-                    ids=self.templates_by_arm[mode][arm_name],
-                    shared_memory=True
-                )
+                arm_template_ids[arm_name] = self.templates_by_arm[mode][arm_name]
+        return arm_template_ids
 
-                self.arm_rasters[arm_name] = self.template_spectra_raw[arm_name].wavelengths
+    def _fetch_window_function(self, arm_name):
+        """
+        Fetch the window function used to taper the spectra for an arm from the raster cache.
 
-                self.arm_properties[arm_name]['multiplicative_step'] = (self.arm_rasters[arm_name][1] /
-                                                                        self.arm_rasters[arm_name][0])
+        :param arm_name:
+            The name of the arm within this 4MOST mode
+        :return:
+            None
+        """
 
-                window_function_length = len(self.arm_rasters[arm_name])
-                if self.upsampling > 1:
-                    window_function_length = (len(self.arm_rasters[arm_name]) - 1) * upsampling
+        window_function_length = len(self.arm_rasters[arm_name])
+        if self.upsampling > 1:
+            window_function_length = (len(self.arm_rasters[arm_name]) - 1) * self.upsampling
 
-                self.window_functions[arm_name] = self.window_function(
-                    template_length=window_function_length
-                )
+        self.window_functions[arm_name] = fourgp_speclib.raster_cache.fetch(
+            "rv_window_function", self.arm_rasters[arm_name],
+            template_length=window_function_length
+        )["window_function"]
 
-        # Multiply template spectra by window function and normalise
-        self.template_spectra_tapered = {}
+    def _prepare_template_bank(self):
+        """
+        Load the template spectra for each arm from the spectrum library, up-sample, taper and normalise them, and
+        take their FFTs.
+
+        :return:
+            None
+        """
 
-        for arm_name in self.template_spectra_raw:
-            new_template_list = []
+        # Load library of template spectra for each arm. The raw templates are not kept once they have been prepared,
+        # since they are not available when the prepared templates are opened from the cache.
+        template_spectra_raw = {}
 
-            for index in range(len(self.template_spectra_raw[arm_name])):
-                template_spectrum = self.template_spectra_raw[arm_name].extract_item(index=index)
+        for arm_name, template_ids in self._arm_template_ids().items():
+            template_spectra_raw[arm_name] = self._spectrum_library.open(
+                ids=template_ids,
+                shared_memory=True
+            )
 
-                if self.upsampling > 1:
-                    template_spectrum = self.upsample_spectrum(
-                        input=template_spectrum,
-                        upsampling_factor=self.upsampling)
+            self.arm_rasters[arm_name] = template_spectra_raw[arm_name].wavelengths
 
-                # Multiply template by window function
-                template_spectrum.values *= self.window_functions[arm_name]
+            self.arm_properties[arm_name]['multiplicative_step'] = (self.arm_rasters[arm_name][1] /
+                                                                    self.arm_rasters[arm_name][0])
 
-                # Ensure correct normalisation to return the Pearson correlation coefficient
-                # This is a zero-normalised cross-correlation (ZNCC)
-                template_spectrum.values = template_spectrum.values - np.mean(template_spectrum.values)
-                template_spectrum.values = template_spectrum.values / np.std(template_spectrum.values)
+            self._fetch_window_function(arm_name=arm_name)
 
-                # Add modified template to list of updated templates for this arm
-                new_template_list.append(template_spectrum)
+        # Multiply template spectra by window function and normalise
+        self.template_spectra_tapered = {}
+
+        for arm_name, templates in template_spectra_raw.items():
+            wavelengths = templates.wavelengths
+            values = templates.values
+            value_errors = templates.value_errors
+
+            # Up-sample all of the templates for this arm at once
+            if self.upsampling > 1:
+                operator = self.arm_resampling_operator(input_raster=templates.wavelengths,
+                                                        arm_name=arm_name,
+                                                        raster_hash=templates.raster_hash)
+                wavelengths = operator.output_raster
+                values = operator.apply(values=values, normalise=False)
+                value_errors = np.zeros_like(values)
+
+            # Multiply templates by window function, and normalise
+            tapered_values = self.taper_and_normalise(values=values, arm_name=arm_name)
+
+            new_template_list = [fourgp_speclib.Spectrum(wavelengths=wavelengths,
+                                                         values=tapered_values[index],
+                                                         value_errors=value_errors[index],
+                                                         metadata=templates.get_metadata(index=index))
+                                 for index in range(len(templates))]
 
             # Create new spectrum array of modified template spectra
             self.template_spectra_tapered[arm_name] = fourgp_speclib.SpectrumArray.from_spectra(
@@ -131,6 +243,344 @@ class RvInstanceCrossCorrelation(object):
                 shared_memory=True
             )
 
+        # Take the FFTs of the tapered templates, which we multiply by the FFT of each input spectrum to compute the
+        # cross-correlation functions. These are zero-padded to avoid wrapping around at the ends of the spectrum.
+        self.template_ffts = {}
+        self._correlation_lengths = {}
+
+        for arm_name, templates in self.template_spectra_tapered.items():
+            template_length = templates.values.shape[1]
+            fft_length = fft.next_fast_len(2 * template_length - 1, real=True)
+
+            self._correlation_lengths[arm_name] = fft_length
+            self.template_ffts[arm_name] = fft.rfft(templates.values, n=fft_length, axis=1)
+
+    def _template_bank_arrays(self, arm_names):
+        """
+        Collect the arrays which make up the prepared template bank, so that they can be saved to the cache.
+
+        :param arm_names:
+            List of the names of the arms, in the order they are listed in the cache manifest.
+        :return:
+            Dictionary of numpy arrays.
+        """
+
+        arrays = {}
+        for index, arm_name in enumerate(arm_names):
+            templates = self.template_spectra_tapered[arm_name]
+            arrays["arm{:d}_raster".format(index)] = self.arm_rasters[arm_name]
+            arrays["arm{:d}_wavelengths".format(index)] = templates.wavelengths
+            arrays["arm{:d}_values".format(index)] = templates.values
+            arrays["arm{:d}_value_errors".format(index)] = templates.value_errors
+            arrays["arm{:d}_ffts".format(index)] = self.template_ffts[arm_name]
+        return arrays
+
+    def _open_template_bank(self, arm_names, arrays, metadata_by_id):
+        """
+        Set up the template spectra for each arm from a prepared template bank, read from the cache. The templates
+        are not copied into memory, but remain memory-mapped, so their pages are shared by all processes using them.
+
+        :param arm_names:
+            List of the names of the arms, in the order they are listed in the cache manifest.
+        :param arrays:
+            Dictionary of (memory-mapped) numpy arrays, as returned by <TemplateBankCache.load>.
+        :param metadata_by_id:
+            Dictionary of the metadata of each template, indexed by template id.
+        :return:
+            None
+        """
+
+        arm_template_ids = self._arm_template_ids()
+
+        self.template_spectra_tapered = {}
+        self.template_ffts = {}
+        self._correlation_lengths = {}
+
+        for index, arm_name in enumerate(arm_names):
+            self.arm_rasters[arm_name] = np.asarray(arrays["arm{:d}_raster".format(index)])
+
+            self.arm_properties[arm_name]['multiplicative_step'] = (self.arm_rasters[arm_name][1] /
+                                                                    self.arm_rasters[arm_name][0])
+
+            self._fetch_window_function(arm_name=arm_name)
+
+            self.template_spectra_tapered[arm_name] = fourgp_speclib.SpectrumArray(
+                wavelengths=np.asarray(arrays["arm{:d}_wavelengths".format(index)]),
+                values=arrays["arm{:d}_values".format(index)],
+                value_errors=arrays["arm{:d}_value_errors".format(index)],
+                metadata_list=[metadata_by_id[template_id] for template_id in arm_template_ids[arm_name]]
+            )
+
+            template_length = self.template_spectra_tapered[arm_name].values.shape[1]
+            self._correlation_lengths[arm_name] = fft.next_fast_len(2 * template_length - 1, real=True)
+            self.template_ffts[arm_name] = arrays["arm{:d}_ffts".format(index)]
+
+    def cluster_templates(self, arm_name, cluster_count, random_seed=0):
+        """
+        Divide the templates for an arm into clusters of similar spectra using k-means clustering, and choose the
+        template closest to the centre of each cluster as its representative. Since the tapered templates have zero
+        mean and unit variance, the Euclidean distance between two templates is a monotonic function of their
+        correlation coefficient.
+
+        :param arm_name:
+            The name of the arm within this 4MOST mode
+        :param cluster_count:
+            The number of clusters to divide the templates into.
+        :param random_seed:
+            The random seed used to initialise the k-means clustering, so that the clusters are reproducible.
+        :return:
+            None
+        """
+
+        templates = self.template_spectra_tapered[arm_name].values
+        cluster_count = min(int(cluster_count), templates.shape[0])
+        assert cluster_count > 0, "Templates must be divided into at least one cluster."
+
+        centroids, labels = kmeans2(data=templates, k=cluster_count, minit='++', seed=random_seed)
+
+        clusters = []
+        representatives = []
+
+        for cluster_index in range(cluster_count):
+            members = np.flatnonzero(labels == cluster_index)
+
+            # k-means may leave clusters with no members
+            if len(members) == 0:
+                continue
+
+            distances = np.sum(np.square(templates[members] - centroids[cluster_index]), axis=1)
+            clusters.append(members)
+            representatives.append(members[np.argmin(distances)])
+
+        self.set_template_clusters(arm_name=arm_name, clusters=clusters, representatives=representatives)
+
+        logger.info("Divided {:d} templates for arm <{}> into {:d} clusters".format(
+            templates.shape[0], arm_name, len(representatives)))
+
+    def set_template_clusters(self, arm_name, clusters, representatives):
+        """
+        Set the clusters into which the templates for an arm are divided, for the coarse-to-fine template search.
+
+        For each template, we record its distance from its cluster's representative, which bounds how different
+        their correlations with any input spectrum can be. If t and r are two tapered templates of length N, with
+        zero mean and unit variance, and x is any input spectrum normalised in the same way, then by the
+        Cauchy-Schwarz inequality their correlation coefficients with x at any lag differ by at most
+        |t - r| / sqrt(N).
+
+        :param arm_name:
+            The name of the arm within this 4MOST mode
+        :param clusters:
+            List of arrays of the indices of the templates in each cluster. Every template must be in exactly one
+            cluster.
+        :param representatives:
+            List of the index of the template which represents each cluster.
+        :return:
+            None
+        """
+
+        templates = self.template_spectra_tapered[arm_name].values
+        labels = np.full(templates.shape[0], -1)
+        distances = np.zeros(templates.shape[0])
+
+        for cluster_index, (members, representative) in enumerate(zip(clusters, representatives)):
+            assert representative in members, "The representative of each cluster must be one of its members."
+            labels[members] = cluster_index
+            distances[members] = np.sqrt(np.sum(np.square(templates[members] - templates[representative]), axis=1) /
+                                         templates.shape[1])
+
+        assert np.all(labels >= 0), "Every template must be assigned to a cluster."
+
+        self.template_clusters[arm_name] = [np.asarray(members) for members in clusters]
+        self.cluster_representatives[arm_name] = np.asarray(representatives)
+        self._template_cluster_labels[arm_name] = labels
+        self._template_cluster_distances[arm_name] = distances
+
+    def search_templates(self, input_array, arm_name, minimum_template_count=0,
+                         minimum_allowed_correlation_coefficient=0.7):
+        """
+        Choose which templates an input spectrum should be cross-correlated against. If the templates for this arm
+        have been clustered, this correlates the input spectrum against the representative of each cluster, and
+        returns the members of the best-matching clusters, together with any other templates which could be among
+        the best-fitting templates. Otherwise it returns every template.
+
+        :param input_array:
+            The tapered, zero-mean, unit-variance input spectrum, sampled on the same raster as the templates.
+        :param arm_name:
+            The name of the arm within this 4MOST mode
+        :param minimum_template_count:
+            The number of best-fitting templates whose results are used. The search is widened to include every
+            template which could be among them.
+        :param minimum_allowed_correlation_coefficient:
+            Templates with correlation coefficients worse than this are rejected, so need not be searched.
+        :return:
+            Sorted array of the indices of the templates to use, or None to use all templates.
+        """
+
+        return self.search_templates_batch(
+            input_arrays=np.asarray(input_array)[np.newaxis, :], arm_name=arm_name,
+            minimum_template_count=minimum_template_count,
+            minimum_allowed_correlation_coefficient=minimum_allowed_correlation_coefficient
+        )[0]
+
+    def search_templates_batch(self, input_arrays, arm_name, minimum_template_count=0,
+                               minimum_allowed_correlation_coefficient=0.7):
+        """
+        Choose which templates each of a block of input spectra should be cross-correlated against, as in
+        <search_templates>. The input spectra are cross-correlated against the cluster representatives in blocks,
+        as large as our memory budget allows.
+
+        The representatives only give an approximate ranking of the clusters, so we widen the search to make sure it
+        finds the same best-fitting templates as a search of every template. The peak correlation of each template
+        differs from that of its representative by at most its distance from it (see <set_template_clusters>),
+        which gives upper and lower bounds on the peak correlation of every template. We add any template whose upper
+        bound exceeds both <minimum_allowed_correlation_coefficient> and the minimum_template_count-th largest lower
+        bound, since it could be among the best-fitting templates. If any representative cannot be correlated against
+        a spectrum, we fall back to using all of the templates.
+
+        :param input_arrays:
+            The tapered, zero-mean, unit-variance input spectra, with shape (n_spectra, n_pixels), sampled on the
+            same raster as the templates.
+        :param arm_name:
+            The name of the arm within this 4MOST mode
+        :param minimum_template_count:
+            The number of best-fitting templates whose results are used. The search is widened to include every
+            template which could be among them.
+        :param minimum_allowed_correlation_coefficient:
+            Templates with correlation coefficients worse than this are rejected, so need not be searched.
+        :return:
+            List of sorted arrays of the indices of the templates to use for each spectrum, or None to use all
+            templates.
+        """
+
+        if arm_name not in self.template_clusters:
+            return [None] * len(input_arrays)
+
+        representatives = self.cluster_representatives[arm_name]
+        labels = self._template_cluster_labels[arm_name]
+        distances = self._template_cluster_distances[arm_name]
+        template_count = labels.shape[0]
+        input_length = np.asarray(input_arrays).shape[1]
+
+        block_size = max(1, self.correlation_block_elements //
+                         (len(representatives) * self.template_ffts[arm_name].shape[1]))
+
+        # The peak correlation coefficient of each spectrum with each cluster's representative
+        peak_correlations = np.empty((len(input_arrays), len(representatives)))
+        for start in range(0, len(input_arrays), block_size):
+            peak_correlations[start:start + block_size] = np.max(
+                self.cross_correlate(input_array=input_arrays[start:start + block_size], arm_name=arm_name,
+                                     template_indices=representatives), axis=2) / input_length
+
+        # Bounds on the peak correlation coefficient of each spectrum with every template
+        template_upper_bounds = peak_correlations[:, labels] + distances
+        template_lower_bounds = peak_correlations[:, labels] - distances
+
+        # Any template whose upper bound is at least this threshold could be among the best-fitting templates. We
+        # allow a little slack for rounding errors.
+        thresholds = np.full(len(input_arrays), float(minimum_allowed_correlation_coefficient))
+        if 0 < minimum_template_count <= template_count:
+            kth_lower_bounds = -np.partition(-template_lower_bounds, minimum_template_count - 1,
+                                             axis=1)[:, minimum_template_count - 1]
+            thresholds = np.maximum(thresholds, kth_lower_bounds)
+        thresholds -= 1e-9
+
+        output = []
+        for index, spectrum_peak_correlations in enumerate(peak_correlations):
+            if not np.all(np.isfinite(spectrum_peak_correlations)):
+                output.append(None)
+                continue
+
+            # Rank the clusters by the peak correlation of their representatives, and take the best ones
+            cluster_order = np.argsort(-spectrum_peak_correlations, kind='stable')
+            selected = [self.template_clusters[arm_name][cluster_index]
+                        for cluster_index in cluster_order[:self.template_clusters_searched]]
+
+            # Widen the search to include any other templates which could be among the best-fitting ones
+            selected.append(np.flatnonzero(template_upper_bounds[index] >= thresholds[index]))
+
+            output.append(np.unique(np.concatenate(selected)))
+
+        return output
+
+    def cross_correlate(self, input_array, arm_name, template_indices=None):
+        """
+        Cross-correlate a tapered and normalised input spectrum, or a block of input spectra, against all of the
+        templates for a wavelength arm, or a subset of them.
+
+        This returns the same values as np.correlate(a=template, v=input_array, mode='same') for each template, so
+        that element i of each cross-correlation function corresponds to a shift of i - n_pixels // 2 pixels.
+
+        :param input_array:
+            The tapered, zero-mean, unit-variance input spectrum, sampled on the same raster as the templates. This
+            may either have shape (n_pixels,), or (n_spectra, n_pixels) to correlate many spectra at once.
+        :param arm_name:
+            The name of the arm within this 4MOST mode
+        :param template_indices:
+            The indices of the templates to cross-correlate against, or None to use all the templates.
+        :return:
+            Array of cross-correlation functions, with shape (n_templates, n_pixels), or
+            (n_spectra, n_templates, n_pixels) if a block of input spectra was supplied.
+        """
+
+        template_ffts = self.template_ffts[arm_name]
+        if template_indices is None:
+            template_indices = np.arange(template_ffts.shape[0])
+        fft_length = self._correlation_lengths[arm_name]
+        input_array = np.asarray(input_array)
+        input_length = input_array.shape[-1]
+
+        assert template_ffts.shape[1] == fft_length // 2 + 1 and input_length * 2 - 1 <= fft_length, \
+            "Input spectrum is not sampled on the same raster as the templates."
+
+        input_ffts = np.conj(fft.rfft(np.atleast_2d(input_array), n=fft_length, axis=-1))
+
+        # Indices within the circular cross-correlation of each shift between -N//2 and N - 1 - N//2
+        indices = (np.arange(input_length) - input_length // 2) % fft_length
+
+        # Multiply blocks of input FFTs by blocks of template FFTs with broadcasting. If the whole product does not fit
+        # within our memory budget, we take as many templates as possible in each block, then as many inputs as fit.
+        template_count = len(template_indices)
+        pairs_per_block = max(1, self.correlation_block_elements // template_ffts.shape[1])
+        template_block = max(1, min(template_count, pairs_per_block))
+        input_block = max(1, pairs_per_block // template_block)
+
+        cross_correlation = np.empty((input_ffts.shape[0], template_count, input_length))
+        for input_start in range(0, input_ffts.shape[0], input_block):
+            input_end = input_start + input_block
+            for start in range(0, template_count, template_block):
+                end = start + template_block
+                products = input_ffts[input_start:input_end, np.newaxis, :] * \
+                    template_ffts[np.newaxis, template_indices[start:end]]
+                circular = fft.irfft(products, n=fft_length, axis=-1)
+                cross_correlation[input_start:input_end, start:end] = circular[:, :, indices]
+
+        if input_array.ndim == 1:
+            return cross_correlation[0]
+        return cross_correlation
+
+    def taper_and_normalise(self, values, arm_name):
+        """
+        Multiply input spectra by the window function for an arm, and normalise them to zero mean and unit variance,
+        so that their cross-correlations with the templates are Pearson correlation coefficients.
+
+        :param values:
+            Array of input spectra, with shape (n_pixels,) or (n_spectra, n_pixels), sampled on the same raster as
+            the tapered templates.
+        :param arm_name:
+            The name of the arm within this 4MOST mode
+        :return:
+            Array with the same shape as the input.
+        """
+
+        input_array = values * self.window_functions[arm_name]
+
+        # Ensure correct normalisation to return the Pearson correlation coefficient
+        # This is a zero-normalised cross-correlation (ZNCC)
+        input_array = input_array - np.mean(input_array, axis=-1, keepdims=True)
+        input_array = input_array / np.std(input_array, axis=-1, keepdims=True)
+
+        return input_array
+
     @staticmethod
     def window_function(template_length):
         """
@@ -159,6 +609,20 @@ class RvInstanceCrossCorrelation(object):
 
         return window_function
 
+    @staticmethod
+    def _build_window_function(wavelengths, template_length):
+        """
+        Builder for the window function of a wavelength arm, for use by the raster cache.
+
+        :param wavelengths:
+            The wavelength raster of the arm.
+        :param template_length:
+            The number of pixels in the template spectrum we want to create a window function for.
+        :return:
+            Dictionary containing the window function
+        """
+        return {"window_function": RvInstanceCrossCorrelation.window_function(template_length=template_length)}
+
     def resample_single_arm(self, input_spectrum, arm_name):
         """
         Resample an input spectrum onto a raster with fixed logarithmic stride, representing a single 4MOST arm. We
@@ -188,6 +652,32 @@ class RvInstanceCrossCorrelation(object):
 
         return resampled_spectrum
 
+    def arm_resampling_operator(self, input_raster, arm_name, raster_hash=None):
+        """
+        Return the operator which maps spectra sampled on some raster onto the fixed logarithmic raster of an arm,
+        and up-samples them if required, ready for cross-correlation against the templates.
+
+        :param input_raster:
+            The wavelength raster of the spectra to be mapped onto the arm raster.
+        :param arm_name:
+            The name of the arm within this 4MOST mode
+        :param raster_hash:
+            The hash of the input raster, if already known.
+        :return:
+            ArmResamplingOperator
+        """
+
+        if raster_hash is None:
+            raster_hash = fourgp_speclib.hash_numpy_array(np.ascontiguousarray(input_raster))
+
+        key = (raster_hash, arm_name)
+        if key not in self._arm_operators:
+            self._arm_operators[key] = ArmResamplingOperator(input_raster=input_raster,
+                                                             arm_raster=self.arm_rasters[arm_name],
+                                                             upsampling=self.upsampling,
+                                                             input_raster_hash=raster_hash)
+        return self._arm_operators[key]
+
     def estimate_rv_from_single_arm(self, input_spectrum, mode, arm_name, interpolation_scheme="quadratic",
                                     interpolation_pixels=3,
                                     limit_to_best=30,
@@ -218,93 +708,215 @@ class RvInstanceCrossCorrelation(object):
 
         assert interpolation_scheme in self.supported_interpolation_schemes()
 
-        rv_fits = []
+        values = input_spectrum.values
+
+        # Up-sample the input spectrum, unless it has already been up-sampled
+        if self.upsampling > 1 and len(values) != len(self.window_functions[arm_name]):
+            operator = self.arm_resampling_operator(input_raster=input_spectrum.wavelengths,
+                                                    arm_name=arm_name,
+                                                    raster_hash=input_spectrum.raster_hash)
+            values = operator.apply(values=values, normalise=False)
+
+        return self._estimate_rv_from_values(
+            values=values,
+            mode=mode,
+            arm_name=arm_name,
+            interpolation_scheme=interpolation_scheme,
+            interpolation_pixels=interpolation_pixels,
+            limit_to_best=limit_to_best,
+            minimum_allowed_correlation_coefficient=minimum_allowed_correlation_coefficient
+        )
+
+    def _estimate_rv_from_values(self, values, mode, arm_name, interpolation_scheme="quadratic",
+                                 interpolation_pixels=3,
+                                 limit_to_best=30,
+                                 minimum_allowed_correlation_coefficient=0.7):
+        """
+        Estimate the RV of a spectrum on the basis of data from a single arm, which has already been mapped onto the
+        (up-sampled) raster of the templates. Parameters as for <estimate_rv_from_single_arm>.
 
-        if self.upsampling > 1:
-            input_spectrum = self.upsample_spectrum(input=input_spectrum, upsampling_factor=self.upsampling)
+        :return:
+            List of [RV value, weight]
+        """
+
+        input_array = self.taper_and_normalise(values=values, arm_name=arm_name)
+
+        # Choose which templates to use, and cross-correlate against all of them at once
+        template_indices = self.search_templates(
+            input_array=input_array, arm_name=arm_name,
+            minimum_template_count=limit_to_best or 0,
+            minimum_allowed_correlation_coefficient=minimum_allowed_correlation_coefficient
+        )
+
+        cross_correlations = self.cross_correlate(input_array=input_array, arm_name=arm_name,
+                                                  template_indices=template_indices)
+
+        return self.rv_fits_from_cross_correlations(
+            cross_correlations=cross_correlations,
+            mode=mode,
+            arm_name=arm_name,
+            template_indices=template_indices,
+            interpolation_scheme=interpolation_scheme,
+            interpolation_pixels=interpolation_pixels,
+            limit_to_best=limit_to_best,
+            minimum_allowed_correlation_coefficient=minimum_allowed_correlation_coefficient
+        )
+
+    def rv_fits_from_cross_correlations(self, cross_correlations, mode, arm_name, template_indices=None,
+                                        interpolation_scheme="quadratic",
+                                        interpolation_pixels=3,
+                                        limit_to_best=30,
+                                        minimum_allowed_correlation_coefficient=0.7):
+        """
+        Measure the RV implied by the peak of the cross-correlation function of an input spectrum with each of the
+        template spectra for a single arm.
+
+        :param cross_correlations:
+            Array of the cross-correlation functions of the input spectrum with each template, with shape
+            (n_templates, n_pixels), as returned by <cross_correlate>.
+        :param mode:
+            The name of the 4MOST mode this arm is part of -- either LRS or HRS
+        :param arm_name:
+            The name of the arm within this 4MOST mode
+        :param template_indices:
+            The indices of the templates which were cross-correlated against, or None if all the templates were used.
+        :param interpolation_scheme:
+            The type of function to use to interpolate the CCF to measure sub-pixel RVs.
+        :param interpolation_pixels:
+            The number of pixels around the peak of the CCF to use when interpolating to measure sub-pixel RVs.
+        :param limit_to_best:
+            Use the results from only the N best fitting templates.
+        :param minimum_allowed_correlation_coefficient:
+            Reject any templates which have correlation coefficients worse than this
+        :return:
+            List of [RV value, weight]
+        """
+
+        if template_indices is None:
+            template_indices = np.arange(len(self.templates_by_arm[mode][arm_name]))
+        assert cross_correlations.shape[0] == len(template_indices)
 
-        # Loop over all template spectra
-        for template_index, template_id in enumerate(self.templates_by_arm[mode][arm_name]):
-            template_spectrum = self.template_spectra_tapered[arm_name].extract_item(index=template_index)
+        velocities, weights = self.measure_ccf_peaks(cross_correlations=cross_correlations,
+                                                     arm_name=arm_name,
+                                                     template_indices=template_indices,
+                                                     interpolation_scheme=interpolation_scheme,
+                                                     interpolation_pixels=interpolation_pixels)
 
-            # Look up stellar parameters of this template
+        return self._select_rv_fits(velocities=velocities, weights=weights, arm_name=arm_name,
+                                    template_indices=template_indices,
+                                    limit_to_best=limit_to_best,
+                                    minimum_allowed_correlation_coefficient=minimum_allowed_correlation_coefficient)
+
+    def measure_ccf_peaks(self, cross_correlations, arm_name, template_indices=None, interpolation_scheme="quadratic",
+                          interpolation_pixels=3):
+        """
+        Measure the RV, and the correlation coefficient, implied by the peak of each of any number of
+        cross-correlation functions for a single arm. The peaks of all the CCFs are found and interpolated with
+        batched array operations.
+
+        :param cross_correlations:
+            Array of cross-correlation functions, with shape (n_templates, n_pixels), or
+            (n_spectra, n_templates, n_pixels), as returned by <cross_correlate>.
+        :param arm_name:
+            The name of the arm within this 4MOST mode
+        :param template_indices:
+            The indices of the templates which were cross-correlated against, used to report failed
+            cross-correlations, or None if all the templates were used.
+        :param interpolation_scheme:
+            The type of function to use to interpolate the CCF to measure sub-pixel RVs.
+        :param interpolation_pixels:
+            The number of pixels around the peak of the CCF to use when interpolating to measure sub-pixel RVs.
+        :return:
+            [array of RVs, array of correlation coefficients], each with the shape of cross_correlations without its
+            last axis. The RVs of failed cross-correlations, or of peaks which could not be interpolated, are NaN.
+        """
+
+        input_length = cross_correlations.shape[-1]
+        template_count = cross_correlations.shape[-2]
+        if template_indices is None:
+            template_indices = np.arange(template_count)
+
+        # Find the index of the maximum of each cross correlation function
+        finite = np.all(np.isfinite(cross_correlations), axis=-1)
+        max_positions = np.argmax(cross_correlations, axis=-1)
+        max_values = np.take_along_axis(cross_correlations, max_positions[..., np.newaxis], axis=-1)[..., 0]
+
+        failed_templates = np.flatnonzero(np.any(~finite.reshape(-1, template_count), axis=0))
+        for template_index in np.asarray(template_indices)[failed_templates]:
             template_metadata = self.template_spectra_tapered[arm_name].get_metadata(index=template_index)
-            teff = template_metadata['Teff']
-            logg = template_metadata['logg']
-            fe_h = template_metadata['[Fe/H]']
-
-            input_array = input_spectrum.values * self.window_functions[arm_name]
-
-            # Ensure correct normalisation to return the Pearson correlation coefficient
-            # This is a zero-normalised cross-correlation (ZNCC)
-            input_array = input_array - np.mean(input_array)
-            input_array = input_array / np.std(input_array)
-
-            cross_correlation = np.correlate(a=template_spectrum.values,
-                                             v=input_array,
-                                             mode='same')
-
-            # Find the index of the maximum of cross correlation function
-            try:
-                max_position = np.where(cross_correlation == max(cross_correlation))[0][0]
-            except IndexError:
-                print("Warning: Cross-correlation with {} failed".format(template_metadata['Starname']))
-                max_position = np.nan
-
-            if np.isfinite(max_position):
-                # Make sure we don't go off the end of the array
-                if max_position < (interpolation_pixels // 2):
-                    max_position = (interpolation_pixels // 2)
-                if max_position > len(input_array) - 1 - (interpolation_pixels // 2):
-                    max_position = len(input_array) - 1 - (interpolation_pixels // 2)
-
-                # Now make three points which straddle the maximum
-                x_min = max_position - interpolation_pixels // 2
-                x_max = x_min + interpolation_pixels - 1
-                x_vals = np.array(range(x_min, x_max + 1))
-                y_vals = cross_correlation[x_vals]
-
-                # Put peak close to zero for numerical stability
-                x_vals = x_vals - max_position
-                y_peak = y_vals[1]
-                y_vals = y_vals - y_peak
-
-                # Do interpolation
-                if interpolation_scheme == "quadratic":
-                    if len(x_vals) == 3:
-                        if template_index == 0:
-                            logger.info("Using analytic quadratic interpolation")
-                        peak_x = self.interpolation_quadratic_dcf(x_vals=x_vals, y_vals=y_vals)
-                    else:
-                        if template_index == 0:
-                            logger.info("Using numerical quadratic interpolation")
-                        peak_x = self.interpolation_quadratic_galah(x_vals=x_vals, y_vals=y_vals)
-                else:
-                    if template_index == 0:
-                        logger.info("Using spline interpolation")
-                    peak_x = self.interpolation_spline(x_vals=x_vals, y_vals=y_vals)
+            logger.warning("Cross-correlation with {} failed".format(template_metadata['Starname']))
+
+        # Make sure we don't go off the end of the array
+        max_positions = np.clip(max_positions, interpolation_pixels // 2,
+                                input_length - 1 - (interpolation_pixels // 2))
+
+        # Now extract the points which straddle the maximum, with x positions relative to the peak pixel
+        x_vals = np.arange(interpolation_pixels) - interpolation_pixels // 2
+        y_vals = np.take_along_axis(cross_correlations, max_positions[..., np.newaxis] + x_vals, axis=-1)
+        y_vals = y_vals.reshape(-1, interpolation_pixels)
+
+        # Do interpolation
+        if interpolation_scheme == "quadratic":
+            if interpolation_pixels == 3:
+                logger.info("Using analytic quadratic interpolation")
             else:
-                peak_x = np.nan
+                logger.info("Using least-squares quadratic interpolation")
+            peak_x = self.interpolation_quadratic_vectorised(x_vals=x_vals, y_vals=y_vals)
+        elif interpolation_scheme == "gaussian":
+            logger.info("Using Gaussian interpolation")
+            peak_x = self.interpolation_gaussian_vectorised(x_vals=x_vals, y_vals=y_vals)
+        else:
+            logger.info("Using spline interpolation")
+            peak_x = np.array([self.interpolation_spline(x_vals=x_vals, y_vals=item - item[1]) for item in y_vals])
+
+        peak_x = peak_x.reshape(max_positions.shape)
+        peak_x[~finite] = np.nan
+
+        # Shift peak back from zero to original position
+        peak_x = peak_x + max_positions
 
-            # Shift peak back from zero to original position
-            peak_x = peak_x + max_position
+        # Convert position of peak of correlation function into a shift in pixels
+        pixel_shift = peak_x - input_length // 2
 
-            # Convert position of peak of correlation function into a shift in pixels
-            pixel_shift = peak_x - len(input_array) // 2
+        # Convert pixel shift into multiplicative change in wavelength, based on fixed logarithmic stride
+        multiplicative_shift = np.power(self.arm_properties[arm_name]['multiplicative_step'],
+                                        pixel_shift / self.upsampling)
 
-            # Convert pixel shift into multiplicative change in wavelength, based on fixed logarithmic stride
-            multiplicative_shift = pow(self.arm_properties[arm_name]['multiplicative_step'],
-                                       pixel_shift / self.upsampling)
+        # Convert multiplicative wavelength shift into a radial velocity
+        c = 299792458.0
+        velocities = -c * (np.square(multiplicative_shift) - 1) / (np.square(multiplicative_shift) + 1)
+        weights = max_values / input_length  # This should be between -1 and 1
 
-            # Convert multiplicative wavelength shift into a radial velocity
-            c = 299792458.0
-            velocity = -c * (pow(multiplicative_shift, 2) - 1) / (pow(multiplicative_shift, 2) + 1)
-            weight = max(cross_correlation) / len(input_spectrum)  # This should be between -1 and 1
+        return velocities, weights
+
+    def _select_rv_fits(self, velocities, weights, arm_name, template_indices, limit_to_best=30,
+                        minimum_allowed_correlation_coefficient=0.7):
+        """
+        Turn the RVs and correlation coefficients measured from the CCFs of an input spectrum with each template
+        into a list of RV estimates, keeping only the best-fitting templates.
+
+        :param velocities:
+            Array of the RVs measured with each template, as returned by <measure_ccf_peaks>.
+        :param weights:
+            Array of the correlation coefficients of each template, as returned by <measure_ccf_peaks>.
+        :param arm_name:
+            The name of the arm within this 4MOST mode
+        :param template_indices:
+            The indices of the templates which were cross-correlated against.
+        :param limit_to_best:
+            Use the results from only the N best fitting templates.
+        :param minimum_allowed_correlation_coefficient:
+            Reject any templates which have correlation coefficients worse than this
+        :return:
+            List of [RV value, weight, stellar parameters of template], sorted in order of decreasing weight.
+        """
 
-            if weight > minimum_allowed_correlation_coefficient:
-                rv_fits.append(
-                    (velocity, weight, (teff, logg, fe_h))
-                )
+        # Reject templates which correlate poorly, or whose peaks could not be interpolated
+        with np.errstate(invalid='ignore'):
+            accepted = np.flatnonzero((weights > minimum_allowed_correlation_coefficient) & np.isfinite(velocities))
+
+        rv_fits = [(velocities[index], weights[index], self.template_parameters[arm_name][template_indices[index]])
+                   for index in accepted]
 
         # Sort the RV fits in order of how well the templates fit
         rv_fits.sort(key=itemgetter(1))
@@ -314,74 +926,62 @@ class RvInstanceCrossCorrelation(object):
         if limit_to_best is not None:
             rv_fits = rv_fits[:limit_to_best]
 
-        # for item in rv_fits:
-        #     print("{} {}".format(arm_name, item))
-
         return rv_fits
 
     @staticmethod
-    def interpolation_quadratic_galah(x_vals, y_vals):
+    def interpolation_quadratic_vectorised(x_vals, y_vals):
         """
-        Use quadratic interpolation to find the sub-pixel position of the peak of the CCF. This is the GALAH way
-        of doing it, which uses numerical fitting rather than an analytic solution
+        Use quadratic interpolation to find the sub-pixel positions of the peaks of many CCFs at once. With three
+        points the quadratic passes exactly through them; with more points it is a least-squares fit, as done by
+        GALAH. Either way, the coefficients are computed using the pseudo-inverse of the design matrix, which is the
+        same for every CCF.
 
         :param x_vals:
-            If the CCF is y(x), this is the array of the x values of the data points supplied to interpolate.
+            If the CCF is y(x), this is the array of the x values of the data points supplied to interpolate, which
+            are the same for every CCF.
         :param y_vals:
-            If the CCF is y(x), this is the array of the y values of the data points supplied to interpolate.
+            If the CCF is y(x), this is the array of the y values of the data points supplied to interpolate, with
+            shape (n_ccfs, len(x_vals)).
         :return:
-            Our best estimate of the position of the peak.
+            Array of our best estimates of the position of each peak.
         """
 
-        # Fit a quadratic curve through three points
-        def quadratic_curve(p, x):
-            return p[0] * x ** 2 + p[1] * x + p[2]
-
-        def quadratic_peak_x(p):
-            return -p[1] / (2 * p[0])
+        x_vals = np.asarray(x_vals, dtype=np.float64)
+        y_vals = np.atleast_2d(y_vals)
+        assert len(x_vals) >= 3, "Quadratic interpolation requires at least three points."
 
-        def quadratic_mismatch(p, x, y):
-            return quadratic_curve(p, x) - y
+        design_matrix = np.stack([np.square(x_vals), x_vals, np.ones_like(x_vals)], axis=1)
+        p0, p1, p2 = np.dot(y_vals, np.linalg.pinv(design_matrix).T).T
 
-        p0, p1, p2 = leastsq(func=quadratic_mismatch,
-                             x0=np.array([0, 0, 0]),
-                             args=(x_vals, y_vals),
-                             maxfev=10000
-                             )[0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            peak_x = -p1 / (2 * p0)
 
-        peak_x = quadratic_peak_x(p=(p0, p1, p2))
         return peak_x
 
     @staticmethod
-    def interpolation_quadratic_dcf(x_vals, y_vals):
+    def interpolation_gaussian_vectorised(x_vals, y_vals):
         """
-        Use quadratic interpolation to find the sub-pixel position of the peak of the CCF. This is Dominic's version
-        which uses analytic solution
+        Find the sub-pixel positions of the peaks of many CCFs at once, by fitting a Gaussian to the points
+        around each peak. This is a quadratic fit to the logarithm of the CCF, which is less biased than a
+        quadratic fit when the CCF peak is close to Gaussian. CCFs with non-positive values around their peaks
+        return NaN.
 
         :param x_vals:
-            If the CCF is y(x), this is the array of the x values of the data points supplied to interpolate.
+            If the CCF is y(x), this is the array of the x values of the data points supplied to interpolate, which
+            are the same for every CCF.
         :param y_vals:
-            If the CCF is y(x), this is the array of the y values of the data points supplied to interpolate.
+            If the CCF is y(x), this is the array of the y values of the data points supplied to interpolate, with
+            shape (n_ccfs, len(x_vals)).
         :return:
-            Our best estimate of the position of the peak.
+            Array of our best estimates of the position of each peak.
         """
 
-        assert len(x_vals) == 3  # This analytic solution only works with three input points
-        assert x_vals[1] == 0  # Three points must be centred around x==0
-        assert x_vals[2] == - x_vals[0]
-
-        def quadratic_peak_x(p):
-            return -p[1] / (2 * p[0])
-
-        p2 = y_vals[1]
-
-        p0 = (y_vals[0] + y_vals[2]) / (2 * x_vals[0] ** 2)
+        y_vals = np.atleast_2d(y_vals)
 
-        p1 = (y_vals[0] - y_vals[2]) / (2 * x_vals[0])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_y_vals = np.where(y_vals > 0, np.log(np.where(y_vals > 0, y_vals, 1)), np.nan)
 
-        peak_x = quadratic_peak_x(p=(p0, p1, p2))
-
-        return peak_x
+        return RvInstanceCrossCorrelation.interpolation_quadratic_vectorised(x_vals=x_vals, y_vals=log_y_vals)
 
     @staticmethod
     def interpolation_spline(x_vals, y_vals):
@@ -416,7 +1016,7 @@ class RvInstanceCrossCorrelation(object):
 
     @staticmethod
     def supported_interpolation_schemes():
-        return "quadratic", "spline"
+        return "quadratic", "gaussian", "spline"
 
     def upsample_spectrum(self, input, upsampling_factor):
         """
@@ -430,18 +1030,8 @@ class RvInstanceCrossCorrelation(object):
             An up-sampled Spectrum object
         """
 
-        multiplicative_spacing_in = input.wavelengths[1] / input.wavelengths[0]
-        multiplicative_spacing_out = pow(multiplicative_spacing_in, 1. / upsampling_factor)
-
-        # We impose an explicit length on the output, because the arange() here is numerically unstable about whether
-        # it includes the final point or not
-        raster_in_length = len(input.wavelengths)
-        raster_out_length = (raster_in_length - 1) * upsampling_factor
-
-        raster_out = logarithmic_raster(lambda_min=input.wavelengths[0],
-                                        lambda_max=input.wavelengths[-1],
-                                        lambda_step=input.wavelengths[0] * (multiplicative_spacing_out - 1)
-                                        )[:raster_out_length]
+        raster_out = ArmResamplingOperator.upsampled_raster(wavelengths=input.wavelengths,
+                                                            upsampling_factor=upsampling_factor)
 
         f = InterpolatedUnivariateSpline(x=input.wavelengths, y=input.values)
 
@@ -479,8 +1069,11 @@ class RvInstanceCrossCorrelation(object):
 
         # Compile a list of all the RV estimates, from all the arms and all the templates
         for arm_name in arm_names:
-            new_rv_estimates = self.estimate_rv_from_single_arm(
-                input_spectrum=self.resample_single_arm(input_spectrum=input_spectrum, arm_name=arm_name),
+            operator = self.arm_resampling_operator(input_raster=input_spectrum.wavelengths,
+                                                    arm_name=arm_name,
+                                                    raster_hash=input_spectrum.raster_hash)
+            new_rv_estimates = self._estimate_rv_from_values(
+                values=operator.apply(values=input_spectrum.values),
                 mode=mode,
                 arm_name=arm_name,
                 interpolation_scheme=interpolation_scheme,
@@ -488,6 +1081,21 @@ class RvInstanceCrossCorrelation(object):
             )
             rv_estimates.extend(new_rv_estimates)
 
+        return self.combine_rv_estimates(rv_estimates=rv_estimates)
+
+    @staticmethod
+    def combine_rv_estimates(rv_estimates):
+        """
+        Combine the RV estimates from cross-correlation with every template, in every arm, into a single RV.
+
+        :param rv_estimates:
+            List of [RV value, weight, stellar parameters of template]
+        :return:
+            [RV, error in RV, stellar parameters of best-fitting template, RV estimates sorted by weight]
+        """
+
+        rv_estimates = list(rv_estimates)
+
         if len(rv_estimates) == 0:
             rv_estimates = [
                 (np.nan, np.nan, (np.nan, np.nan, np.nan))
@@ -516,3 +1124,118 @@ class RvInstanceCrossCorrelation(object):
         rv_std_dev = sqrt(rv_variance)
 
         return rv_mean, rv_std_dev, stellar_parameters, rv_estimates_by_weight
+
+    def resample_arm_batch(self, input_spectra, arm_name):
+        """
+        Resample every spectrum in a SpectrumArray onto the fixed logarithmic raster of a single 4MOST arm, and
+        up-sample them if required, ready for cross-correlation. This is equivalent to calling
+        <resample_single_arm> and <upsample_spectrum> on each spectrum in turn, but maps them all onto the arm with a
+        single sparse matrix product.
+
+        :param input_spectra:
+            A SpectrumArray object, containing observed spectra
+        :param arm_name:
+            The name of the arm within this 4MOST mode
+        :return:
+            Array of shape (n_spectra, n_pixels), sampled on the same raster as the tapered templates.
+        """
+
+        operator = self.arm_resampling_operator(input_raster=input_spectra.wavelengths,
+                                                arm_name=arm_name,
+                                                raster_hash=input_spectra.raster_hash)
+
+        return operator.apply(values=input_spectra.values)
+
+    def estimate_rv_batch(self, input_spectra, mode, arm_names=None, interpolation_scheme="quadratic",
+                          interpolation_pixels=3, limit_to_best=30):
+        """
+        Estimate the RVs of many spectra at once, on the basis of all of the 4MOST arms of either HRS or LRS. This
+        returns the same values as calling <estimate_rv> on each spectrum in turn, but resamples all the spectra onto
+        each arm at once, and cross-correlates them against the templates in blocks.
+
+        :param input_spectra:
+            A SpectrumArray object, containing observed spectra
+        :param mode:
+            The name of the 4MOST mode this arm is part of -- either LRS or HRS
+        :param arm_names:
+            A list of the 4MOST arms to use, or None to use all possible arms.
+        :param interpolation_scheme:
+            The type of function to use to interpolate the CCF to measure sub-pixel RVs.
+        :param interpolation_pixels:
+            The number of pixels around the peak of the CCF to use when interpolating to measure sub-pixel RVs.
+        :param limit_to_best:
+            Use the results from only the N best fitting templates in each arm.
+        :return:
+            [array of RVs, array of errors in RVs, array of the stellar parameters of the best-fitting template for
+            each spectrum, with shape (n_spectra, 3)]
+        """
+
+        assert isinstance(input_spectra, fourgp_speclib.SpectrumArray), \
+            "Argument to estimate_rv_batch should be a SpectrumArray."
+        assert interpolation_scheme in self.supported_interpolation_schemes()
+
+        spectrum_count = len(input_spectra)
+        rv_estimates = [[] for i in range(spectrum_count)]
+
+        if arm_names is None:
+            arm_names = self.templates_by_arm[mode].keys()
+
+        # Compile lists of all the RV estimates for each spectrum, from all the arms and all the templates
+        for arm_name in arm_names:
+            input_arrays = self.taper_and_normalise(values=self.resample_arm_batch(input_spectra=input_spectra,
+                                                                                   arm_name=arm_name),
+                                                    arm_name=arm_name)
+
+            # If the templates are clustered, each spectrum is cross-correlated against its own subset of them. We
+            # group together the spectra which use the same subset, and cross-correlate each group in blocks.
+            template_selections = self.search_templates_batch(input_arrays=input_arrays, arm_name=arm_name,
+                                                              minimum_template_count=limit_to_best or 0)
+            spectrum_groups = OrderedDict()
+            for index, template_indices in enumerate(template_selections):
+                group_key = None if template_indices is None else tuple(template_indices)
+                spectrum_groups.setdefault(group_key, []).append(index)
+
+            for group_key, spectrum_indices in spectrum_groups.items():
+                template_indices = None if group_key is None else np.array(group_key)
+                template_count = self.template_ffts[arm_name].shape[0] if group_key is None else len(group_key)
+                fit_template_indices = np.arange(template_count) if template_indices is None else template_indices
+
+                # Limit the number of cross-correlation functions held in memory
+                block_size = max(1, self.correlation_block_elements //
+                                 (template_count * self.template_ffts[arm_name].shape[1]))
+
+                for start in range(0, len(spectrum_indices), block_size):
+                    block = spectrum_indices[start:start + block_size]
+                    cross_correlations = self.cross_correlate(input_array=input_arrays[block], arm_name=arm_name,
+                                                              template_indices=template_indices)
+
+                    # Find and interpolate the peaks of all the CCFs in this block at once
+                    velocities, weights = self.measure_ccf_peaks(cross_correlations=cross_correlations,
+                                                                 arm_name=arm_name,
+                                                                 template_indices=template_indices,
+                                                                 interpolation_scheme=interpolation_scheme,
+                                                                 interpolation_pixels=interpolation_pixels)
+
+                    for block_index, index in enumerate(block):
+                        rv_estimates[index].extend(self._select_rv_fits(
+                            velocities=velocities[block_index],
+                            weights=weights[block_index],
+                            arm_name=arm_name,
+                            template_indices=fit_template_indices,
+                            limit_to_best=limit_to_best
+                        ))
+
+        rv_mean = np.zeros(spectrum_count)
+        rv_std_dev = np.zeros(spectrum_count)
+        stellar_parameters = np.zeros((spectrum_count, 3))
+
+        for index in range(spectrum_count):
+            rv_mean[index], rv_std_dev[index], stellar_parameters[index], _ = self.combine_rv_estimates(
+                rv_estimates=rv_estimates[index]
+            )
+
+        return rv_mean, rv_std_dev, stellar_parameters
+
+
+fourgp_speclib.raster_cache.register_builder(product="rv_window_function",
+                                             builder=RvInstanceCrossCorrelation._build_window_function)
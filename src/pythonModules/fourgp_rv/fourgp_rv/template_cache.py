@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+"""
+This module implements a disk cache of the template spectra used for cross-correlation RVs, after they have been
+up-sampled, tapered and normalised, together with their FFTs.
+
+Preparing the template bank is expensive, and is otherwise repeated every time a new process instantiates
+<RvInstanceCrossCorrelation>, for example in each pipeline worker. Each prepared bank is saved as a directory of .npy
+files, described by a JSON manifest, which later processes open as read-only memory maps. The name of the directory
+is a hash of the contents of the template library and of the settings used to prepare the templates, so a bank is
+automatically rebuilt whenever either changes.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+from os import path as os_path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class TemplateBankCache(object):
+    """
+    A directory of prepared RV template banks, indexed by a hash of the template library and preparation settings.
+
+    :ivar str cache_directory:
+        The directory in which template banks are saved.
+    """
+
+    # Increment this whenever the way templates are prepared changes, to invalidate existing cached banks
+    version = 1
+
+    def __init__(self, cache_directory):
+        """
+        Instantiate a cache of prepared template banks.
+
+        :param cache_directory:
+            The directory in which template banks are saved. This is created if it does not already exist.
+
+        :type cache_directory:
+            str
+        """
+
+        if not os_path.exists(cache_directory):
+            os.makedirs(cache_directory)
+
+        self.cache_directory = cache_directory
+
+    @classmethod
+    def bank_key(cls, spectrum_library, template_list, metadata_list, **settings):
+        """
+        Produce a string hash identifying a prepared template bank. This depends on the ids and metadata of all of
+        the templates, the sizes and modification times of the files they are stored in, and the settings used to
+        prepare them, so it changes if any templates are added, removed or overwritten.
+
+        :param spectrum_library:
+            The SpectrumLibrary containing the template spectra.
+        :param template_list:
+            List of the template spectra within the library, as returned by <SpectrumLibrary.search>.
+        :param metadata_list:
+            List of the metadata dictionaries of each template.
+        :param settings:
+            Any settings used to prepare the templates, such as the up-sampling factor.
+        :return:
+            String hash
+        """
+
+        # Spectrum files are stored within the library's directory, if it has one
+        library_path = getattr(spectrum_library, "_path", None)
+
+        files = []
+        for item in template_list:
+            filename = item.get("filename", None)
+            if library_path is not None and filename is not None:
+                try:
+                    status = os.stat(os_path.join(library_path, str(filename)))
+                    files.append((status.st_size, status.st_mtime_ns))
+                    continue
+                except OSError:
+                    pass
+            files.append(None)
+
+        items = [cls.version,
+                 os_path.abspath(library_path) if library_path is not None else None,
+                 sorted(settings.items()),
+                 [(item["specId"], sorted((key, str(value)) for key, value in metadata.items()), file_status)
+                  for item, metadata, file_status in zip(template_list, metadata_list, files)]
+                 ]
+
+        return hashlib.sha1(repr(items).encode('utf-8')).hexdigest()
+
+    def load(self, key):
+        """
+        Open a prepared template bank from the cache.
+
+        :param key:
+            The hash identifying the template bank, as returned by <bank_key>.
+        :type key:
+            str
+        :return:
+            Tuple of (manifest dictionary, dictionary of read-only memory-mapped arrays), or None if this bank is not
+            in the cache.
+        """
+
+        directory = os_path.join(self.cache_directory, key)
+        manifest_filename = os_path.join(directory, "manifest.json")
+
+        if not os_path.exists(manifest_filename):
+            return None
+
+        try:
+            with open(manifest_filename) as f:
+                manifest = json.load(f)
+
+            if manifest.get("version") != self.version:
+                return None
+
+            arrays = {}
+            for name in manifest["arrays"]:
+                arrays[name] = np.load(os_path.join(directory, "{}.npy".format(name)), mmap_mode='r')
+        except (IOError, OSError, ValueError, KeyError, AttributeError, TypeError):
+            # Banks are only ever renamed into place once they are complete, so this one is corrupt. Delete it, so
+            # that it is replaced when the bank is saved again.
+            logger.warning("Could not read cached template bank <{}>; rebuilding it".format(directory))
+            shutil.rmtree(directory, ignore_errors=True)
+            return None
+
+        logger.info("Opened cached template bank <{}>".format(directory))
+        return manifest, arrays
+
+    def save(self, key, manifest, arrays):
+        """
+        Save a prepared template bank to the cache. We write it to a temporary directory first, so that other
+        processes never see a partially written bank.
+
+        :param key:
+            The hash identifying the template bank, as returned by <bank_key>.
+        :type key:
+            str
+        :param manifest:
+            Dictionary describing the template bank, which must be serialisable as JSON.
+        :type manifest:
+            dict
+        :param arrays:
+            Dictionary of the numpy arrays which make up the template bank.
+        :type arrays:
+            dict
+        :return:
+            None
+        """
+
+        directory = os_path.join(self.cache_directory, key)
+        temporary_directory = "{}.{}.tmp".format(directory, os.getpid())
+
+        manifest = dict(manifest)
+        manifest["version"] = self.version
+        manifest["arrays"] = sorted(arrays)
+
+        try:
+            os.makedirs(temporary_directory)
+            for name, value in arrays.items():
+                np.save(os_path.join(temporary_directory, "{}.npy".format(name)), np.ascontiguousarray(value))
+            with open(os_path.join(temporary_directory, "manifest.json"), "w") as f:
+                json.dump(manifest, f)
+            os.rename(temporary_directory, directory)
+        except (IOError, OSError):
+            # Another process may have saved the same bank while we were writing ours
+            if not os_path.exists(os_path.join(directory, "manifest.json")):
+                logger.warning("Could not write cached template bank <{}>".format(directory))
+        finally:
+            shutil.rmtree(temporary_directory, ignore_errors=True)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Unit tests for the ArmResamplingOperator class
+"""
+
+import unittest
+import numpy as np
+from scipy.interpolate import BSpline
+import fourgp_speclib
+import fourgp_rv
+from fourgp_rv.templates_resample import logarithmic_raster
+
+
+class TestArmResamplingOperator(unittest.TestCase):
+    def setUp(self):
+        """
+        Create a random observed spectrum, and a small arm raster with fixed logarithmic stride.
+        """
+
+        random_generator = np.random.RandomState(0)
+        raster = np.linspace(4800, 5200, 1201)
+        self._spectrum = fourgp_speclib.Spectrum(wavelengths=raster,
+                                                 values=1 + 0.1 * random_generator.random_sample(raster.shape),
+                                                 value_errors=np.zeros_like(raster))
+        self._arm_raster = logarithmic_raster(lambda_min=4850, lambda_max=5150, lambda_step=0.5)
+
+        # The reference implementation uses only the arm rasters of the RV code, so we don't need to load templates
+        self._rv_code = fourgp_rv.RvInstanceCrossCorrelation.__new__(fourgp_rv.RvInstanceCrossCorrelation)
+        self._rv_code.arm_rasters = {"test": self._arm_raster}
+
+    def test_resampling(self):
+        """
+        Check that the operator matches <resample_single_arm> when we do not up-sample.
+        """
+
+        operator = fourgp_rv.ArmResamplingOperator(input_raster=self._spectrum.wavelengths,
+                                                   arm_raster=self._arm_raster)
+        expected = self._rv_code.resample_single_arm(input_spectrum=self._spectrum, arm_name="test")
+
+        self.assertTrue(np.allclose(operator.output_raster, expected.wavelengths, rtol=0, atol=1e-10))
+        self.assertTrue(np.allclose(operator.apply(values=self._spectrum.values), expected.values,
+                                    rtol=1e-12, atol=0))
+
+    def test_upsampling(self):
+        """
+        Check that the operator matches <resample_single_arm> followed by <upsample_spectrum>.
+        """
+
+        for upsampling in (2, 3):
+            operator = fourgp_rv.ArmResamplingOperator(input_raster=self._spectrum.wavelengths,
+                                                       arm_raster=self._arm_raster,
+                                                       upsampling=upsampling)
+            resampled = self._rv_code.resample_single_arm(input_spectrum=self._spectrum, arm_name="test")
+            expected = self._rv_code.upsample_spectrum(input=resampled, upsampling_factor=upsampling)
+
+            self.assertTrue(np.allclose(operator.output_raster, expected.wavelengths, rtol=0, atol=1e-10))
+            self.assertTrue(np.allclose(operator.apply(values=self._spectrum.values), expected.values,
+                                        rtol=1e-12, atol=0))
+
+    def test_batch(self):
+        """
+        Check that a batch of spectra gives the same result as each spectrum in turn.
+        """
+
+        operator = fourgp_rv.ArmResamplingOperator(input_raster=self._spectrum.wavelengths,
+                                                   arm_raster=self._arm_raster,
+                                                   upsampling=2)
+        values = np.vstack([self._spectrum.values, 2 * self._spectrum.values[::-1]])
+        output = operator.apply(values=values)
+        for index in range(2):
+            self.assertTrue(np.allclose(output[index], operator.apply(values=values[index]), rtol=1e-14, atol=0))
+
+    def test_bspline_basis_matrix(self):
+        """
+        Check that our B-spline basis functions match scipy's, including beyond the ends of the knot vector.
+        """
+
+        if not hasattr(BSpline, "design_matrix"):
+            self.skipTest("This version of scipy does not provide BSpline.design_matrix")
+
+        x = self._arm_raster
+        knots = np.concatenate([[x[0]] * 4, x[2:-2], [x[-1]] * 4])
+        points = np.linspace(x[0] - 1, x[-1] + 1, 2001)
+
+        ours = fourgp_rv.ArmResamplingOperator.bspline_basis_matrix(x=points, knots=knots, order=3).toarray()
+        try:
+            theirs = BSpline.design_matrix(points, knots, 3, extrapolate=True).toarray()
+        except TypeError:
+            self.skipTest("This version of scipy does not support extrapolation in BSpline.design_matrix")
+
+        self.assertTrue(np.allclose(ours, theirs, rtol=0, atol=1e-13))
+
+
+# Run tests if we are run from command line
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Unit tests for the batched log-probability function of the RvInstanceBrani class
+"""
+
+import unittest
+from unittest import mock
+import numpy as np
+from scipy.ndimage import gaussian_filter1d
+from scipy.stats import norm
+import fourgp_speclib
+import fourgp_degrade
+import fourgp_rv
+
+
+class TestLogProbabilityBatch(unittest.TestCase):
+    # A small grid of 2 x 2 x 2 template spectra
+    grid_axes = [["Teff", 5000, 6000, 500],
+                 ["Fe/H", 0.5, 1.5, 0.5],
+                 ["log_g", 4.0, 5.0, 0.5]
+                 ]
+
+    def setUp(self):
+        """
+        Create a grid of template spectra containing random absorption lines, and an observed spectrum made from one
+        of them.
+        """
+
+        random_generator = np.random.RandomState(0)
+        raster = np.linspace(5000, 5100, 1001)
+        values = np.ones((8, raster.shape[0]))
+        for template in values:
+            centres = random_generator.uniform(5000, 5100, (15, 1))
+            template *= np.prod(1 - 0.5 * np.exp(-0.5 * np.square((raster - centres) / 0.2)), axis=0)
+
+        # One template contains bad data, which walkers should reject
+        values[3, 500] = np.nan
+
+        self._template_library = fourgp_speclib.SpectrumArray(wavelengths=raster,
+                                                              values=values,
+                                                              value_errors=np.zeros_like(values),
+                                                              metadata_list=[{} for index in range(values.shape[0])])
+
+        observed_raster = np.linspace(5010, 5090, 600)
+        observed_values = 2 * np.interp(observed_raster, raster, values[5]) + \
+            0.01 * random_generator.standard_normal(observed_raster.shape)
+        self._observed_spectrum = fourgp_speclib.Spectrum(wavelengths=observed_raster,
+                                                          values=observed_values,
+                                                          value_errors=np.full_like(observed_raster, 0.01))
+        self._observed_spectrum.mask[:10] = False
+
+        # Walkers scattered about the parameter space, including some beyond its limits
+        walker_count = 40
+        self._thetas = np.stack([random_generator.uniform(-600, 600, walker_count),
+                                 random_generator.uniform(4700, 6300, walker_count),
+                                 random_generator.uniform(0.2, 1.8, walker_count),
+                                 random_generator.uniform(3.7, 5.3, walker_count),
+                                 random_generator.uniform(0.95, 1.35, walker_count),
+                                 random_generator.uniform(1.5, 2.5, walker_count),
+                                 random_generator.uniform(-1e-4, 1e-4, walker_count),
+                                 random_generator.uniform(-1e-8, 1e-8, walker_count)], axis=1)
+
+    def _reference_log_probability(self, theta):
+        """
+        The log-probability of a single walker, evaluated one step at a time with the spectrum classes, as in the
+        original version of <RvInstanceBrani.log_probability>.
+        """
+
+        velocity, t_eff, fe_h, log_g, sigma_gauss, c0, c1, c2 = theta
+
+        if (np.abs(velocity) > 500) or (sigma_gauss < 1) or (sigma_gauss > 1.3):
+            return -np.inf
+
+        for axis_no, axis_value in enumerate([t_eff, fe_h, log_g]):
+            axis = self.grid_axes[axis_no]
+            if (axis_value <= axis[1] - axis[3] / 2) or (axis_value >= axis[2] + axis[3] / 2):
+                return -np.inf
+
+        template_spectrum = fourgp_rv.RvInstanceBrani.pick_template_spectrum(
+            template_library=self._template_library,
+            grid_axes=self.grid_axes,
+            axis_values={"Teff": t_eff, "Fe/H": fe_h, "log_g": log_g})
+
+        if any(np.isnan(template_spectrum.values)):
+            return -np.inf
+
+        template_convolved = fourgp_degrade.SpectrumConvolver(template_spectrum).gaussian_convolve(sigma_gauss)
+        template_observer_frame = template_convolved.apply_radial_velocity(velocity * 1000)
+        interpolator = fourgp_degrade.SpectrumInterpolator(template_observer_frame)
+        template_resampled = interpolator.match_to_other_spectrum(other=self._observed_spectrum,
+                                                                  interpolate_errors=False, interpolate_mask=False)
+        template_continuum = fourgp_speclib.SpectrumPolynomial(wavelengths=template_resampled.wavelengths,
+                                                               terms=3,
+                                                               coefficients=(c0, c1, c2))
+        template_with_continuum = template_continuum * template_resampled
+
+        observed = self._observed_spectrum
+        mask = (observed.mask * np.isfinite(observed.values) * (observed.value_errors > 0) *
+                np.isfinite(template_with_continuum.values))
+
+        log_likelihood = np.sum(norm.logpdf(x=observed.values[mask],
+                                            loc=template_with_continuum.values[mask],
+                                            scale=observed.value_errors[mask]))
+        log_likelihood += norm.logpdf(x=sigma_gauss, loc=1.15, scale=0.02)
+        log_likelihood += norm.logpdf(x=velocity, loc=0, scale=150)
+
+        return log_likelihood - 100000
+
+    def test_matches_single_walker(self):
+        """
+        Check that the batched log-probability matches the log-probability of each walker evaluated in turn.
+        """
+
+        output = fourgp_rv.RvInstanceBrani.log_probability_batch(thetas=self._thetas,
+                                                                 template_library=self._template_library,
+                                                                 observed_spectrum=self._observed_spectrum,
+                                                                 grid_axes=self.grid_axes)
+        expected = np.array([self._reference_log_probability(theta) for theta in self._thetas])
+
+        # Make sure the test exercises both accepted and rejected walkers
+        self.assertTrue(np.any(np.isfinite(expected)))
+        self.assertTrue(np.any(~np.isfinite(expected)))
+
+        self.assertTrue(np.array_equal(np.isfinite(output), np.isfinite(expected)))
+        finite = np.isfinite(expected)
+        self.assertTrue(np.allclose(output[finite], expected[finite], rtol=1e-10, atol=1e-6))
+
+    def test_convolved_grid(self):
+        """
+        Check that interpolating pre-convolved templates gives the same result as convolving them on the fly, when
+        the Gaussian widths lie exactly on the grid of widths.
+        """
+
+        sigmas = fourgp_rv.RvInstanceBrani.grid_convolution_sigmas
+        convolved_grid = fourgp_rv.ConvolvedTemplateGrid.from_templates(template_library=self._template_library,
+                                                                        sigmas=sigmas)
+        thetas = self._thetas.copy()
+        thetas[:, 4] = sigmas[np.arange(thetas.shape[0]) % sigmas.shape[0]]
+
+        output = fourgp_rv.RvInstanceBrani.log_probability_batch(thetas=thetas,
+                                                                 template_library=self._template_library,
+                                                                 observed_spectrum=self._observed_spectrum,
+                                                                 grid_axes=self.grid_axes,
+                                                                 convolved_grid=convolved_grid)
+        expected = fourgp_rv.RvInstanceBrani.log_probability_batch(thetas=thetas,
+                                                                   template_library=self._template_library,
+                                                                   observed_spectrum=self._observed_spectrum,
+                                                                   grid_axes=self.grid_axes)
+
+        self.assertTrue(np.array_equal(np.isfinite(output), np.isfinite(expected)))
+        finite = np.isfinite(expected)
+        self.assertTrue(np.allclose(output[finite], expected[finite], rtol=1e-10, atol=1e-6))
+
+    def test_convolved_grid_interpolation(self):
+        """
+        Check that templates interpolated between the widths of the pre-convolved grid match templates convolved
+        directly to within 2.5e-4 of the continuum, for the whole range of widths allowed by the prior, and for deep
+        absorption lines from a little narrower than a pixel to a few pixels wide.
+        """
+
+        raster = self._template_library.wavelengths
+        random_generator = np.random.RandomState(1)
+        values = np.ones((3, raster.shape[0]))
+        for template, line_width in zip(values, (0.05, 0.1, 0.2)):
+            centres = random_generator.uniform(5000, 5100, (15, 1))
+            template *= np.prod(1 - 0.9 * np.exp(-0.5 * np.square((raster - centres) / line_width)), axis=0)
+        templates = fourgp_speclib.SpectrumArray(wavelengths=raster, values=values, value_errors=np.zeros_like(values),
+                                                 metadata_list=[{} for index in range(values.shape[0])])
+
+        sigmas = fourgp_rv.RvInstanceBrani.grid_convolution_sigmas
+        convolved_grid = fourgp_rv.ConvolvedTemplateGrid.from_templates(template_library=templates, sigmas=sigmas)
+
+        # Widths between the nodes of the grid, including the midpoints, where interpolation is least accurate
+        test_sigmas = np.linspace(sigmas[0], sigmas[-1], 6 * (sigmas.shape[0] - 1) + 1)
+        self.assertTrue(np.any(np.min(np.abs(test_sigmas[:, np.newaxis] - sigmas[np.newaxis, :]), axis=1) > 0.02))
+
+        for template_number in range(values.shape[0]):
+            output = convolved_grid.interpolate(template_numbers=np.full(test_sigmas.shape, template_number),
+                                                sigmas=test_sigmas)
+            expected = np.array([gaussian_filter1d(input=values[template_number], sigma=sigma)
+                                 for sigma in test_sigmas])
+            self.assertLess(np.max(np.abs(output - expected)), 2.5e-4)
+
+
+class _StubSampler(object):
+    """
+    Stand-in for <emcee.EnsembleSampler>, which leaves its walkers where they start, but evaluates their
+    log-probabilities through the pool passed to it, in the same way as the real sampler.
+    """
+
+    instances = []
+
+    def __init__(self, nwalkers, dim, lnpostfn, pool, kwargs):
+        self.nwalkers = nwalkers
+        self.dim = dim
+        self.pool = pool
+        self.steps_run = []
+        self.reset()
+        _StubSampler.instances.append(self)
+
+    def reset(self):
+        self.chain = np.zeros((self.nwalkers, 0, self.dim))
+        self.lnprobability = np.zeros((self.nwalkers, 0))
+
+    def run_mcmc(self, pos0, N):
+        assert pos0.shape == (self.nwalkers, self.dim)
+        log_probabilities = np.array(self.pool.map(None, list(pos0)))
+        self.chain = np.concatenate([self.chain, np.repeat(pos0[:, np.newaxis, :], N, axis=1)], axis=1)
+        self.lnprobability = np.concatenate([self.lnprobability,
+                                             np.repeat(log_probabilities[:, np.newaxis], N, axis=1)], axis=1)
+        self.steps_run.append(N)
+
+    @property
+    def flatchain(self):
+        return self.chain.reshape((-1, self.dim))
+
+    @property
+    def flatlnprobability(self):
+        return self.lnprobability.flatten()
+
+
+class TestFitRvFast(unittest.TestCase):
+    # A small grid of 2 x 2 x 2 template spectra
+    grid_axes = [["Teff", 5000, 6000, 500],
+                 ["Fe/H", 0.5, 1.5, 0.5],
+                 ["log_g", 4.0, 5.0, 0.5]
+                 ]
+
+    # The parameters of the template from which we make the observed spectra
+    true_labels = {"velocity": 37.3, "Teff": 5500, "Fe/H": 0.5, "log_g": 4.5, "sigma_gauss": 1.12}
+
+    def setUp(self):
+        """
+        Create an instance of the RV code using a small grid of template spectra, without needing a SpectrumLibrary
+        of the full grid of templates. As in real templates, all of the grid points share the same absorption lines,
+        but their strengths vary from one grid point to the next.
+        """
+
+        random_generator = np.random.RandomState(0)
+        raster = np.linspace(5000, 5100, 1001)
+        centres = random_generator.uniform(5000, 5100, (40, 1))
+        values = np.ones((8, raster.shape[0]))
+        for template in values:
+            depths = random_generator.uniform(0.2, 0.6, (40, 1))
+            template *= np.prod(1 - depths * np.exp(-0.5 * np.square((raster - centres) / 0.2)), axis=0)
+
+        self._template_library = fourgp_speclib.SpectrumArray(wavelengths=raster,
+                                                              values=values,
+                                                              value_errors=np.zeros_like(values),
+                                                              metadata_list=[{} for index in range(values.shape[0])])
+
+        rv_code = fourgp_rv.RvInstanceBrani.__new__(fourgp_rv.RvInstanceBrani)
+        rv_code.grid_axes = self.grid_axes
+        rv_code.grid_axis_values = [np.arange(axis[1], axis[2], axis[3]) for axis in self.grid_axes]
+        rv_code.grid_axes_min = fourgp_rv.RvInstanceBrani.grid_axes_min.copy()
+        rv_code.grid_axes_max = fourgp_rv.RvInstanceBrani.grid_axes_max.copy()
+        for axis in self.grid_axes:
+            rv_code.grid_axes_min[axis[0]] = axis[1] - axis[3] / 2
+            rv_code.grid_axes_max[axis[0]] = axis[2] + axis[3] / 2
+        rv_code._template_spectra = self._template_library
+        rv_code._convolved_templates = fourgp_rv.ConvolvedTemplateGrid.from_templates(
+            template_library=self._template_library, sigmas=rv_code.grid_convolution_sigmas)
+        rv_code._threads = 1
+        rv_code._pool = None
+        rv_code.n_dim = 8
+        rv_code.n_walkers = 40
+        rv_code.n_burn_fast = 10
+        rv_code.n_steps_fast = 20
+        self._rv_code = rv_code
+
+        # Starting guesses, which are a poor match to the observed spectra
+        self._initial_labels = fourgp_rv.RvInstanceBrani.grid_axes_initial_guesses.copy()
+        self._initial_labels.update({"Teff": 5000, "Fe/H": 1.0, "log_g": 4.0})
+
+        self._template_number = self._output_template_number(self.true_labels)
+
+    def _observed_spectrum(self, random_generator, noise, claimed_noise):
+        """
+        Make an observed spectrum from one of the templates, convolved, Doppler shifted, multiplied by a sloping
+        continuum, and with Gaussian noise added.
+        """
+
+        c = 299792458.0
+        v = self.true_labels["velocity"] * 1000
+        raster = self._template_library.wavelengths
+        template = gaussian_filter1d(input=self._template_library.values[self._template_number],
+                                     sigma=self.true_labels["sigma_gauss"])
+        observed_raster = np.linspace(5010, 5090, 800)
+        continuum = 2 + 0.01 * (observed_raster - 5050)
+        observed_values = continuum * np.interp(observed_raster / np.sqrt((1 + v / c) / (1 - v / c)), raster, template)
+        observed_values += noise * random_generator.standard_normal(observed_raster.shape)
+        return fourgp_speclib.Spectrum(wavelengths=observed_raster,
+                                       values=observed_values,
+                                       value_errors=np.full_like(observed_raster, claimed_noise))
+
+    def _output_template_number(self, output):
+        """
+        The number of the template picked by the stellar parameters in the output of the RV code.
+        """
+
+        return fourgp_rv.RvInstanceBrani.template_numbers(
+            grid_axes=self.grid_axes,
+            axis_values=np.array([[output[x] for x in ("Teff", "Fe/H", "log_g")]]))[0]
+
+    def test_recovers_velocity(self):
+        """
+        Check that fast mode recovers an injected radial velocity and template, without running an MCMC chain, and
+        that the uncertainty it quotes matches the scatter of the velocities it measures from independent noise
+        realisations.
+        """
+
+        random_generator = np.random.RandomState(1)
+        velocities = []
+        velocity_errors = []
+        with mock.patch.object(fourgp_rv.brani_code, "emcee") as emcee:
+            for realisation in range(50):
+                output = self._rv_code._fit_rv_fast(
+                    observed_spectrum=self._observed_spectrum(random_generator, noise=0.02, claimed_noise=0.02),
+                    stellar_labels=self._initial_labels,
+                    velocity_supplied=False)
+                self.assertEqual(self._output_template_number(output), self._template_number)
+                velocities.append(output["velocity"])
+                velocity_errors.append(output["velocity_error"])
+        emcee.EnsembleSampler.assert_not_called()
+
+        velocities = np.array(velocities)
+        velocity_errors = np.array(velocity_errors)
+        self.assertTrue(np.all(velocity_errors > 0))
+        self.assertTrue(np.all(velocity_errors < self._rv_code.fast_maximum_velocity_error))
+        self.assertLess(np.max(np.abs(velocities - self.true_labels["velocity"]) / velocity_errors), 4)
+
+        # The quoted uncertainty should match the scatter of the measured velocities, to within the sampling error
+        # of a standard deviation estimated from 50 values
+        scatter = np.std(velocities)
+        self.assertGreater(scatter, 0.7 * np.median(velocity_errors))
+        self.assertLess(scatter, 1.4 * np.median(velocity_errors))
+
+    def test_velocity_supplied(self):
+        """
+        Check that fast mode starts from a supplied radial velocity, rather than scanning over velocity.
+        """
+
+        random_generator = np.random.RandomState(2)
+        observed = self._observed_spectrum(random_generator, noise=0.02, claimed_noise=0.02)
+        stellar_labels = self._initial_labels.copy()
+        stellar_labels["velocity"] = self.true_labels["velocity"] + 3
+
+        with mock.patch.object(fourgp_rv.brani_code.RvInstanceBrani, "_evaluate_walkers",
+                               wraps=fourgp_rv.RvInstanceBrani._evaluate_walkers) as evaluate_walkers:
+            output = self._rv_code._fit_rv_fast(observed_spectrum=observed, stellar_labels=stellar_labels,
+                                                velocity_supplied=True)
+
+        # No batch of walkers is as large as the scan over velocity
+        scan_length = (self._rv_code.grid_axes_max["velocity"] - self._rv_code.grid_axes_min["velocity"]) / \
+            self._rv_code.fast_velocity_scan_step
+        self.assertTrue(all(np.atleast_2d(call[1]["thetas"]).shape[0] < scan_length
+                            for call in evaluate_walkers.call_args_list))
+        self.assertLess(abs(output["velocity"] - self.true_labels["velocity"]), 4 * output["velocity_error"])
+
+    def test_mcmc_fallback(self):
+        """
+        Check that fast mode falls back to a short MCMC chain, started close to the optimum, when the observed
+        spectrum is much noisier than its quoted uncertainties, so that the best model fits it badly.
+        """
+
+        np.random.seed(3)
+        random_generator = np.random.RandomState(3)
+        observed = self._observed_spectrum(random_generator, noise=0.05, claimed_noise=0.01)
+
+        _StubSampler.instances = []
+        with mock.patch.object(fourgp_rv.brani_code, "emcee", mock.Mock(EnsembleSampler=_StubSampler)):
+            output = self._rv_code._fit_rv_fast(observed_spectrum=observed, stellar_labels=self._initial_labels,
+                                                velocity_supplied=False)
+
+        # A single sampler was used, for a burn-in period and a main run of the lengths set for fast mode
+        self.assertEqual(len(_StubSampler.instances), 1)
+        sampler = _StubSampler.instances[0]
+        self.assertEqual(sampler.nwalkers, self._rv_code.n_walkers)
+        self.assertEqual(sampler.steps_run, [self._rv_code.n_burn_fast, self._rv_code.n_steps_fast])
+
+        # The walkers were started close to the optimum, so the best of them is close to the injected velocity
+        self.assertEqual(self._output_template_number(output), self._template_number)
+        self.assertLess(abs(output["velocity"] - self.true_labels["velocity"]), 1)
+        self.assertTrue(0 < output["velocity_error"] <= self._rv_code.fast_maximum_velocity_error)
+
+
+# Run tests if we are run from command line
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Unit tests for the cross-correlation of spectra against templates by the RvInstanceCrossCorrelation class
+"""
+
+from os import path as os_path
+import uuid
+import unittest
+import numpy as np
+from scipy import fft
+from scipy.optimize import leastsq
+import fourgp_speclib
+import fourgp_rv
+from fourgp_rv.templates_resample import logarithmic_raster
+
+
+class TestCrossCorrelate(unittest.TestCase):
+    def setUp(self):
+        """
+        Create some random templates and input spectra, and an RV code instance holding the FFTs of the templates.
+        """
+
+        random_generator = np.random.RandomState(0)
+        self._templates = random_generator.standard_normal((7, 301))
+        self._inputs = random_generator.standard_normal((5, 301))
+
+        # <cross_correlate> only uses the template FFTs, so we don't need to load a library of templates
+        fft_length = fft.next_fast_len(2 * self._templates.shape[1] - 1, real=True)
+        self._rv_code = fourgp_rv.RvInstanceCrossCorrelation.__new__(fourgp_rv.RvInstanceCrossCorrelation)
+        self._rv_code.template_ffts = {"test": fft.rfft(self._templates, n=fft_length, axis=1)}
+        self._rv_code._correlation_lengths = {"test": fft_length}
+
+    def _expected(self, template_indices):
+        return np.array([[np.correlate(a=self._templates[template_index], v=input_array, mode='same')
+                          for template_index in template_indices]
+                         for input_array in self._inputs])
+
+    def test_single_spectrum(self):
+        """
+        Check that correlating a single spectrum matches np.correlate.
+        """
+
+        output = self._rv_code.cross_correlate(input_array=self._inputs[0], arm_name="test")
+        expected = self._expected(template_indices=range(self._templates.shape[0]))[0]
+
+        self.assertEqual(output.shape, expected.shape)
+        self.assertTrue(np.allclose(output, expected, rtol=0, atol=1e-10))
+
+    def test_blocks(self):
+        """
+        Check that correlating a block of spectra matches np.correlate, whether or not the product of the input and
+        template FFTs has to be split up to fit within the memory budget.
+        """
+
+        template_indices = np.array([0, 2, 3, 6])
+        expected = self._expected(template_indices=template_indices)
+        bin_count = self._rv_code.template_ffts["test"].shape[1]
+
+        for block_elements in (None, 1, 3 * bin_count, 6 * bin_count):
+            if block_elements is not None:
+                self._rv_code.correlation_block_elements = block_elements
+            output = self._rv_code.cross_correlate(input_array=self._inputs, arm_name="test",
+                                                   template_indices=template_indices)
+            self.assertEqual(output.shape, expected.shape)
+            self.assertTrue(np.allclose(output, expected, rtol=0, atol=1e-10))
+
+
+class TestPeakInterpolation(unittest.TestCase):
+    def setUp(self):
+        """
+        Create some random peaked CCFs, sampled at points around their maxima.
+        """
+
+        random_generator = np.random.RandomState(0)
+        self._peaks = random_generator.uniform(-0.5, 0.5, 20)
+        self._widths = random_generator.uniform(1.5, 4, 20)
+
+    def _y_vals(self, x_vals):
+        return np.exp(-0.5 * np.square((x_vals[np.newaxis, :] - self._peaks[:, np.newaxis]) /
+                                       self._widths[:, np.newaxis]))
+
+    @staticmethod
+    def _quadratic_peak_three_points(x_vals, y_vals):
+        """
+        The analytic position of the peak of a quadratic through three points, as previously used for single CCFs.
+        The CCF was shifted so that its central point was zero, as the analytic solution requires.
+        """
+
+        y_vals = y_vals - y_vals[1]
+        p0 = (y_vals[0] + y_vals[2]) / (2 * x_vals[0] ** 2)
+        p1 = (y_vals[0] - y_vals[2]) / (2 * x_vals[0])
+        return -p1 / (2 * p0)
+
+    @staticmethod
+    def _quadratic_peak_least_squares(x_vals, y_vals):
+        """
+        The position of the peak of a quadratic fitted numerically to any number of points, as done by GALAH.
+        """
+
+        def quadratic_mismatch(p, x, y):
+            return p[0] * x ** 2 + p[1] * x + p[2] - y
+
+        p0, p1, p2 = leastsq(func=quadratic_mismatch, x0=np.array([0, 0, 0]), args=(x_vals, y_vals),
+                             maxfev=10000)[0]
+        return -p1 / (2 * p0)
+
+    def test_quadratic_three_points(self):
+        """
+        Check that vectorised quadratic interpolation through three points matches the analytic solution.
+        """
+
+        x_vals = np.arange(3) - 1
+        y_vals = self._y_vals(x_vals)
+        output = fourgp_rv.RvInstanceCrossCorrelation.interpolation_quadratic_vectorised(x_vals=x_vals,
+                                                                                        y_vals=y_vals)
+        expected = [self._quadratic_peak_three_points(x_vals, item) for item in y_vals]
+
+        self.assertTrue(np.allclose(output, expected, rtol=0, atol=1e-12))
+
+    def test_quadratic_least_squares(self):
+        """
+        Check that vectorised least-squares quadratic interpolation matches a numerical fit to each CCF.
+        """
+
+        x_vals = np.arange(5) - 2
+        y_vals = self._y_vals(x_vals)
+        output = fourgp_rv.RvInstanceCrossCorrelation.interpolation_quadratic_vectorised(x_vals=x_vals,
+                                                                                        y_vals=y_vals)
+        expected = [self._quadratic_peak_least_squares(x_vals, item) for item in y_vals]
+
+        self.assertTrue(np.allclose(output, expected, rtol=0, atol=1e-6))
+
+    def test_gaussian(self):
+        """
+        Check that Gaussian interpolation recovers the peaks of Gaussian CCFs exactly, and returns NaN where the
+        CCF is not positive.
+        """
+
+        x_vals = np.arange(3) - 1
+        y_vals = self._y_vals(x_vals)
+        y_vals[0, 0] = -0.1
+        output = fourgp_rv.RvInstanceCrossCorrelation.interpolation_gaussian_vectorised(x_vals=x_vals,
+                                                                                       y_vals=y_vals)
+
+        self.assertTrue(np.isnan(output[0]))
+        self.assertTrue(np.allclose(output[1:], self._peaks[1:], rtol=0, atol=1e-10))
+
+
+class TestRvFits(unittest.TestCase):
+    def setUp(self):
+        """
+        Create an RV code instance with the minimal state needed to turn CCFs into RV estimates for one arm.
+        """
+
+        self._rv_code = fourgp_rv.RvInstanceCrossCorrelation.__new__(fourgp_rv.RvInstanceCrossCorrelation)
+        self._rv_code.upsampling = 1
+        self._rv_code.arm_properties = {"test": {"multiplicative_step": 1.0001}}
+        self._rv_code.templates_by_arm = {"LRS": {"test": [1, 2, 3]}}
+        self._rv_code.template_parameters = {"test": [(5000, 4.0, 0.0), (5500, 4.5, 0.0), (6000, 4.0, -1.0)]}
+
+    def test_reject_failed_interpolation(self):
+        """
+        Check that templates which correlate well, but whose peaks cannot be interpolated, are rejected.
+        """
+
+        # Template 1 has a spike at its peak, with negative values either side, which a Gaussian cannot fit
+        input_length = 101
+        positions = np.arange(input_length) - input_length // 2
+        cross_correlations = np.array([0.9 * np.exp(-0.5 * np.square((positions - 2.3) / 3)),
+                                       np.where(positions == 0, 0.95, -0.1),
+                                       0.8 * np.exp(-0.5 * np.square((positions + 1.2) / 3))]) * input_length
+
+        rv_fits = self._rv_code.rv_fits_from_cross_correlations(cross_correlations=cross_correlations,
+                                                                mode="LRS", arm_name="test",
+                                                                interpolation_scheme="gaussian")
+
+        self.assertEqual([item[2] for item in rv_fits], [(5000, 4.0, 0.0), (6000, 4.0, -1.0)])
+        self.assertTrue(all(np.isfinite(item[0]) for item in rv_fits))
+
+        rv_mean, rv_std_dev, stellar_parameters, _ = self._rv_code.combine_rv_estimates(rv_estimates=rv_fits)
+        self.assertTrue(np.isfinite(rv_mean))
+        self.assertEqual(stellar_parameters, (5000, 4.0, 0.0))
+
+
+class TestEstimateRv(unittest.TestCase):
+    # The wavelength arms of our mock template library, as [arm name, lambda_min, lambda_max, lambda_step]
+    arms = [["BLUE", 5000, 5200, 0.1],
+            ["RED", 6000, 6200, 0.1]]
+
+    def setUp(self):
+        """
+        Create a library of template spectra on two arms, divided into four families of similar spectra, and some
+        noisy observations of Doppler-shifted templates.
+        """
+
+        random_generator = np.random.RandomState(0)
+        self._libraries = []
+        self._template_library = self._create_library()
+
+        # Each family of templates shares a list of absorption lines, whose depths vary between its members
+        self._line_lists = []
+        for family in range(4):
+            centres = np.concatenate([random_generator.uniform(arm[1], arm[2], 300) for arm in self.arms])
+            depths = random_generator.uniform(0.2, 0.8, centres.shape[0])
+            for member in range(6):
+                self._line_lists.append((centres, depths * random_generator.uniform(0.8, 1.2, centres.shape[0])))
+
+        for template_index, lines in enumerate(self._line_lists):
+            for arm_name, lambda_min, lambda_max, lambda_step in self.arms:
+                raster = logarithmic_raster(lambda_min=lambda_min, lambda_max=lambda_max, lambda_step=lambda_step)
+                metadata = {"Starname": "template{:d}".format(template_index), "continuum_normalised": 1,
+                            "mode": "LRS", "arm_name": arm_name,
+                            "lambda_min": lambda_min, "lambda_max": lambda_max, "lambda_step": lambda_step,
+                            "Teff": 4000 + 100 * template_index, "logg": 4.5, "[Fe/H]": 0}
+                spectrum = fourgp_speclib.Spectrum(wavelengths=raster, values=self._model(raster, lines),
+                                                   value_errors=np.zeros_like(raster), metadata=metadata)
+                self._template_library.insert(spectrum, "template{:d}_{}".format(template_index, arm_name))
+
+        # Noisy observations of Doppler-shifted templates
+        self._observed_raster = np.concatenate([np.linspace(4990, 5210, 3000), np.linspace(5990, 6210, 3000)])
+        self._true_templates = [1, 8, 14, 23, 3]
+        self._true_velocities = [-60e3, 25e3, 0, 71.5e3, 5.2e3]
+
+        c = 299792458.0
+        spectra = []
+        for template_index, velocity in zip(self._true_templates, self._true_velocities):
+            rest_frame_raster = self._observed_raster / np.sqrt((1 + velocity / c) / (1 - velocity / c))
+            values = self._model(rest_frame_raster, self._line_lists[template_index]) + \
+                0.01 * random_generator.standard_normal(self._observed_raster.shape)
+            spectra.append(fourgp_speclib.Spectrum(wavelengths=self._observed_raster, values=values,
+                                                   value_errors=np.full_like(values, 0.01)))
+        self._observed_spectra = fourgp_speclib.SpectrumArray.from_spectra(spectra=spectra)
+
+    def tearDown(self):
+        for library in self._libraries:
+            library.purge()
+
+    def _create_library(self):
+        unique_filename = uuid.uuid4()
+        db_path = os_path.join("/tmp", "speclib_test_{}".format(unique_filename))
+        library = fourgp_speclib.SpectrumLibrarySqlite(path=db_path, create=True)
+        self._libraries.append(library)
+        return library
+
+    @staticmethod
+    def _model(wavelengths, lines):
+        centres, depths = lines
+        return np.prod(1 - depths[:, np.newaxis] *
+                       np.exp(-0.5 * np.square((wavelengths - centres[:, np.newaxis]) / 0.15)), axis=0)
+
+    def test_batch_matches_single_spectra(self):
+        """
+        Check that <estimate_rv_batch> returns the same RVs, errors and template parameters as calling
+        <estimate_rv> on each spectrum in turn, and that it recovers the injected RVs.
+        """
+
+        for upsampling in (1, 2):
+            rv_code = fourgp_rv.RvInstanceCrossCorrelation(spectrum_library=self._template_library,
+                                                           upsampling=upsampling)
+
+            for interpolation_scheme in ("quadratic", "gaussian"):
+                rv_mean, rv_std_dev, stellar_parameters = rv_code.estimate_rv_batch(
+                    input_spectra=self._observed_spectra, mode="LRS", interpolation_scheme=interpolation_scheme)
+
+                for index in range(len(self._observed_spectra)):
+                    expected = rv_code.estimate_rv(input_spectrum=self._observed_spectra.extract_item(index),
+                                                   mode="LRS", interpolation_scheme=interpolation_scheme)
+
+                    self.assertAlmostEqual(rv_mean[index], expected[0], delta=1e-6)
+                    self.assertAlmostEqual(rv_std_dev[index], expected[1], delta=1e-6)
+                    self.assertEqual(tuple(stellar_parameters[index]), tuple(expected[2]))
+
+                # The RVs should be accurate to a small fraction of a pixel, which is about 6 km/s, and the best-fitting
+                # template should be the one we observed
+                self.assertTrue(np.all(np.abs(rv_mean - self._true_velocities) < 1e3))
+                self.assertEqual(list(stellar_parameters[:, 0]), [4000 + 100 * index for index in self._true_templates])
+
+    def _assert_same_results(self, rv_code, reference_code):
+        """
+        Check that two RV codes give the same RVs, errors and best-fitting templates for all of our spectra, both
+        from <estimate_rv> and <estimate_rv_batch>.
+        """
+
+        batch_output = rv_code.estimate_rv_batch(input_spectra=self._observed_spectra, mode="LRS")
+        expected_output = reference_code.estimate_rv_batch(input_spectra=self._observed_spectra, mode="LRS")
+
+        for index in range(len(self._observed_spectra)):
+            spectrum = self._observed_spectra.extract_item(index)
+            output = rv_code.estimate_rv(input_spectrum=spectrum, mode="LRS")
+            expected = reference_code.estimate_rv(input_spectrum=spectrum, mode="LRS")
+
+            for item in (output, [batch_output[0][index], batch_output[1][index], tuple(batch_output[2][index])]):
+                self.assertAlmostEqual(item[0], expected[0], delta=1e-6)
+                self.assertAlmostEqual(item[1], expected[1], delta=1e-6)
+                self.assertEqual(tuple(item[2]), tuple(expected[2]))
+                self.assertAlmostEqual(expected[0], expected_output[0][index], delta=1e-6)
+
+    def test_clustered_search(self):
+        """
+        Check that the coarse-to-fine search of a clustered template bank returns the same RVs, to within 1e-6 m/s,
+        and the same best-fitting templates as a search of every template, while cross-correlating each spectrum
+        against only a fraction of the templates.
+        """
+
+        reference_code = fourgp_rv.RvInstanceCrossCorrelation(spectrum_library=self._template_library)
+        rv_code = fourgp_rv.RvInstanceCrossCorrelation(spectrum_library=self._template_library,
+                                                       template_clusters=4, template_clusters_searched=1)
+
+        self._assert_same_results(rv_code=rv_code, reference_code=reference_code)
+
+        for arm_name, lambda_min, lambda_max, lambda_step in self.arms:
+            input_arrays = rv_code.taper_and_normalise(
+                values=rv_code.resample_arm_batch(input_spectra=self._observed_spectra, arm_name=arm_name),
+                arm_name=arm_name)
+            for template_indices in rv_code.search_templates_batch(input_arrays=input_arrays, arm_name=arm_name,
+                                                                   minimum_template_count=30):
+                self.assertLess(len(template_indices), len(self._line_lists))
+
+    def test_clustered_search_widens(self):
+        """
+        Check that the coarse-to-fine search still finds the same RVs and best-fitting templates as a search of
+        every template if the templates are divided into clusters which bear no relation to their similarity.
+        """
+
+        reference_code = fourgp_rv.RvInstanceCrossCorrelation(spectrum_library=self._template_library)
+        rv_code = fourgp_rv.RvInstanceCrossCorrelation(spectrum_library=self._template_library,
+                                                       template_clusters_searched=1)
+
+        random_generator = np.random.RandomState(1)
+        for arm_name, lambda_min, lambda_max, lambda_step in self.arms:
+            clusters = np.array_split(random_generator.permutation(len(self._line_lists)), 4)
+            rv_code.set_template_clusters(arm_name=arm_name, clusters=clusters,
+                                          representatives=[members[0] for members in clusters])
+
+        self._assert_same_results(rv_code=rv_code, reference_code=reference_code)
+
+
+# Run tests if we are run from command line
+if __name__ == '__main__':
+    unittest.main()
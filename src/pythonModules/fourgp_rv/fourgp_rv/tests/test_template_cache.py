@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Unit tests for the TemplateBankCache class
+"""
+
+import os
+from os import path as os_path
+import shutil
+import tempfile
+import uuid
+import unittest
+from unittest import mock
+import numpy as np
+import fourgp_speclib
+import fourgp_rv
+from fourgp_rv.templates_resample import logarithmic_raster
+
+
+class TestTemplateBankCache(unittest.TestCase):
+    def setUp(self):
+        """
+        Create a small library of template spectra for a single arm, some noisy observations of them, and an empty
+        cache directory.
+        """
+
+        random_generator = np.random.RandomState(0)
+        unique_filename = uuid.uuid4()
+        self._template_library = fourgp_speclib.SpectrumLibrarySqlite(
+            path=os_path.join("/tmp", "speclib_test_{}".format(unique_filename)), create=True)
+        self._cache_directory = tempfile.mkdtemp()
+
+        raster = logarithmic_raster(lambda_min=5000, lambda_max=5200, lambda_step=0.1)
+        observed_raster = np.linspace(4990, 5210, 3000)
+        spectra = []
+        for template_index in range(4):
+            centres = random_generator.uniform(5000, 5200, (300, 1))
+            depths = random_generator.uniform(0.2, 0.8, (300, 1))
+            metadata = {"Starname": "template{:d}".format(template_index), "continuum_normalised": 1,
+                        "mode": "LRS", "arm_name": "BLUE", "lambda_min": 5000, "lambda_max": 5200, "lambda_step": 0.1,
+                        "Teff": 4000 + 100 * template_index, "logg": 4.5, "[Fe/H]": 0}
+            spectrum = fourgp_speclib.Spectrum(wavelengths=raster, values=self._model(raster, centres, depths),
+                                               value_errors=np.zeros_like(raster), metadata=metadata)
+            self._template_library.insert(spectrum, "template{:d}".format(template_index))
+
+            values = self._model(observed_raster * (1 - 1e-4 * template_index), centres, depths) + \
+                0.01 * random_generator.standard_normal(observed_raster.shape)
+            spectra.append(fourgp_speclib.Spectrum(wavelengths=observed_raster, values=values,
+                                                   value_errors=np.full_like(values, 0.01)))
+
+        self._observed_spectra = fourgp_speclib.SpectrumArray.from_spectra(spectra=spectra)
+
+    def tearDown(self):
+        self._template_library.purge()
+        shutil.rmtree(self._cache_directory)
+
+    @staticmethod
+    def _model(wavelengths, centres, depths):
+        return np.prod(1 - depths * np.exp(-0.5 * np.square((wavelengths - centres) / 0.15)), axis=0)
+
+    def _bank_key(self, upsampling=1):
+        """
+        Return the cache key of the template bank prepared from our template library.
+        """
+
+        template_list = self._template_library.search(continuum_normalised=1)
+        metadata_list = self._template_library.get_metadata(ids=[item["specId"] for item in template_list])
+        return fourgp_rv.TemplateBankCache.bank_key(spectrum_library=self._template_library,
+                                                    template_list=template_list,
+                                                    metadata_list=metadata_list,
+                                                    upsampling=upsampling)
+
+    def _rv_code(self, upsampling=1):
+        return fourgp_rv.RvInstanceCrossCorrelation(spectrum_library=self._template_library, upsampling=upsampling,
+                                                    cache_directory=self._cache_directory)
+
+    def test_miss_then_hit(self):
+        """
+        Check that a template bank is saved to the cache when it is first prepared, and is opened from the cache as
+        a memory map by later instances, giving the same RVs.
+        """
+
+        cache = fourgp_rv.TemplateBankCache(cache_directory=self._cache_directory)
+        key = self._bank_key()
+        self.assertIsNone(cache.load(key=key))
+
+        fresh_code = self._rv_code()
+        self.assertIsNotNone(cache.load(key=key))
+
+        with mock.patch.object(fourgp_rv.RvInstanceCrossCorrelation, "_prepare_template_bank") as prepare:
+            cached_code = self._rv_code()
+            prepare.assert_not_called()
+
+        self.assertIsInstance(cached_code.template_ffts["BLUE"], np.memmap)
+        self.assertTrue(np.array_equal(cached_code.template_ffts["BLUE"], fresh_code.template_ffts["BLUE"]))
+        self.assertTrue(np.array_equal(cached_code.template_spectra_tapered["BLUE"].values,
+                                       fresh_code.template_spectra_tapered["BLUE"].values))
+
+        fresh_output = fresh_code.estimate_rv_batch(input_spectra=self._observed_spectra, mode="LRS")
+        cached_output = cached_code.estimate_rv_batch(input_spectra=self._observed_spectra, mode="LRS")
+        for fresh_item, cached_item in zip(fresh_output, cached_output):
+            self.assertTrue(np.array_equal(fresh_item, cached_item))
+
+    def test_invalidation(self):
+        """
+        Check that the cache key changes if the metadata or files of the templates change, or if they are prepared
+        with different settings or by a different version of the code.
+        """
+
+        key = self._bank_key()
+        self.assertEqual(self._bank_key(), key)
+        self.assertNotEqual(self._bank_key(upsampling=2), key)
+
+        with mock.patch.object(fourgp_rv.TemplateBankCache, "version", fourgp_rv.TemplateBankCache.version + 1):
+            self.assertNotEqual(self._bank_key(), key)
+
+        # Change the modification time of one of the template files
+        template = self._template_library.search(continuum_normalised=1)[0]
+        filename = os_path.join(self._template_library._path, template["filename"])
+        status = os.stat(filename)
+        os.utime(filename, ns=(status.st_atime_ns, status.st_mtime_ns + 10 ** 9))
+        mtime_key = self._bank_key()
+        self.assertNotEqual(mtime_key, key)
+
+        # Change the metadata of one of the templates
+        self._template_library.set_metadata(ids=[template["specId"]], metadata={"Teff": 9000})
+        self.assertNotEqual(self._bank_key(), mtime_key)
+
+    def test_corrupt_manifest(self):
+        """
+        Check that a template bank with a corrupt manifest is ignored, and replaced when the bank is prepared again.
+        """
+
+        self._rv_code()
+        cache = fourgp_rv.TemplateBankCache(cache_directory=self._cache_directory)
+        key = self._bank_key()
+
+        with open(os_path.join(self._cache_directory, key, "manifest.json"), "w") as f:
+            f.write('{"arms": ["BLUE"], "arr')
+        self.assertIsNone(cache.load(key=key))
+
+        self._rv_code()
+        self.assertIsNotNone(cache.load(key=key))
+
+
+# Run tests if we are run from command line
+if __name__ == '__main__':
+    unittest.main()
@@ -14,6 +14,8 @@ from .spectrum_library import SpectrumLibrary
 from .spectrum_array import SpectrumArray
 from .spectrum import Spectrum, spectrum_splice, hash_numpy_array
 from .spectrum_smooth import SpectrumSmoothFactory, SpectrumSmooth, SpectrumPolynomial
+from .photometry import Passband, Photometer
+from .raster_cache import RasterCache, raster_cache
 
 # Allow MySQL binding to silently fail if system doesn't have MySQLdb package installed
 try:
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+
+"""
+This module provides a class for computing synthetic photometry of spectra.
+
+Photometric passbands are loaded once per process, and are then pre-interpolated onto each distinct wavelength raster
+they are used with. Integrating a spectrum through a passband is then a single dot product, and the magnitudes of a
+whole SpectrumArray can be computed with a single matrix product.
+"""
+
+import logging
+import numpy as np
+
+from .raster_cache import raster_cache
+from .spectrum import Spectrum, hash_numpy_array
+from .spectrum_array import SpectrumArray
+
+logger = logging.getLogger(__name__)
+
+
+class Passband(object):
+    """
+    An object representing the transmission curve of a single photometric passband.
+
+    :ivar str name:
+        The name of this passband.
+
+    :ivar np.ndarray wavelengths:
+        A 1D array listing the wavelengths (in A) at which the transmission curve is sampled.
+
+    :ivar np.ndarray transmission:
+        A 1D array listing the transmission of the passband at each wavelength.
+
+    :ivar bool photon_counting:
+        Boolean flag indicating whether this passband describes a photon-counting detector (True) or an
+        energy-counting detector (False).
+
+    :ivar float ab_zero_mag:
+        The magnitude offset which converts -2.5 log10(mean flux) into an AB magnitude in this passband.
+    """
+
+    def __init__(self, name, wavelengths, transmission, photon_counting=True, ab_zero_mag=None):
+        """
+        Instantiate a new Passband object.
+
+        :param name:
+            The name of this passband.
+
+        :type name:
+            str
+
+        :param wavelengths:
+            A 1D array listing the wavelengths (in A) at which the transmission curve is sampled.
+
+        :type wavelengths:
+            np.ndarray
+
+        :param transmission:
+            A 1D array listing the transmission of the passband at each wavelength.
+
+        :type transmission:
+            np.ndarray
+
+        :param photon_counting:
+            Boolean flag indicating whether this passband describes a photon-counting detector.
+
+        :type photon_counting:
+            bool
+
+        :param ab_zero_mag:
+            The magnitude offset of the AB system in this passband. If None, it is computed from the AB reference
+            spectrum of 3631 Jy.
+
+        :type ab_zero_mag:
+            float
+        """
+
+        self.name = name
+        self.wavelengths = np.asarray(wavelengths, dtype=np.float64)
+        self.transmission = np.asarray(transmission, dtype=np.float64)
+        self.photon_counting = photon_counting
+
+        assert self.wavelengths.shape == self.transmission.shape, \
+            "Wavelength and transmission arrays of passband <{}> have different lengths.".format(name)
+
+        if ab_zero_mag is None:
+            # Flux density of a source of 3631 Jy, in erg/s/cm^2/A
+            c = 2.99792458e18  # A/s
+            ab_flux_density = 3631e-23 * c / (self.wavelengths * self.wavelengths)
+            ab_zero_flux = np.dot(self.weights(raster=self.wavelengths), ab_flux_density)
+            ab_zero_mag = -2.5 * np.log10(ab_zero_flux)
+        self.ab_zero_mag = ab_zero_mag
+
+    def weights(self, raster, raster_hash=None):
+        """
+        Compute the weight of each pixel of a wavelength raster in the mean flux through this passband. The mean flux
+        of a spectrum sampled on this raster is the dot product of its values with these weights. Weights are held in
+        the raster cache, and must not be modified.
+
+        Integrals are evaluated using the trapezium rule on the supplied raster, as in pyphot.
+
+        :param raster:
+            The wavelength raster (in A) to compute weights for.
+
+        :type raster:
+            np.ndarray
+
+        :param raster_hash:
+            The hash of the wavelength raster, if already known.
+
+        :type raster_hash:
+            str
+
+        :return:
+            np.ndarray
+        """
+
+        return raster_cache.fetch("passband_weights", raster, raster_hash=raster_hash,
+                                  passband_wavelengths=self.wavelengths, transmission=self.transmission,
+                                  photon_counting=bool(self.photon_counting), name=self.name)["weights"]
+
+
+class Photometer(object):
+    """
+    A class for computing AB magnitudes of spectra in a list of photometric passbands.
+
+    Passbands are shared between all Photometer instances, and each passband is only loaded from the pyphot library
+    once per process. The weights of each pixel in each passband are held in the raster cache, which discards the
+    least recently used rasters, so processes which see many different rasters do not accumulate them without limit.
+    """
+
+    # Passbands which have already been loaded, indexed by name
+    _passbands = {}
+
+    # The pyphot filter library, which is loaded the first time it is needed
+    _pyphot_library = None
+
+    def __init__(self, bands):
+        """
+        Instantiate a photometer which computes magnitudes in a list of photometric bands.
+
+        :param bands:
+            List of the names of the photometric bands, as recognised by pyphot or registered using
+            <register_passband>. See <http://mfouesneau.github.io/docs/pyphot/libcontent.html> for a list of bands
+            recognised by pyphot.
+
+        :type bands:
+            list or tuple of str
+        """
+
+        if isinstance(bands, str):
+            bands = (bands,)
+        self.bands = tuple(bands)
+        self.passbands = [self.passband(band) for band in self.bands]
+
+        # Matrix of pixel weights for all of our bands, for the raster we were most recently used with
+        self._weights_matrix_hash = None
+        self._weights_matrix = None
+
+    @classmethod
+    def register_passband(cls, passband):
+        """
+        Register a passband, so that it can be used by name without consulting the pyphot library.
+
+        :param passband:
+            The passband to register.
+
+        :type passband:
+            Passband
+
+        :return:
+            None
+        """
+
+        assert isinstance(passband, Passband), "Can only register Passband objects."
+        cls._passbands[passband.name] = passband
+
+    @classmethod
+    def passband(cls, band):
+        """
+        Look up a photometric passband by name, loading it from the pyphot library if we have not already done so.
+
+        :param band:
+            Name of the photometric band.
+
+        :type band:
+            str
+
+        :return:
+            Passband
+        """
+
+        if band not in cls._passbands:
+            import pyphot, tables
+
+            if cls._pyphot_library is None:
+                cls._pyphot_library = pyphot.get_library()
+
+            try:
+                photometer = cls._pyphot_library[band]
+            except tables.exceptions.NoSuchNodeError:
+                logger.error("Could not find photometric band <{}>".format(band))
+                raise
+
+            cls._passbands[band] = Passband(name=band,
+                                            wavelengths=photometer.wavelength.to('AA').magnitude,
+                                            transmission=photometer.transmit,
+                                            photon_counting='photon' in photometer.dtype,
+                                            ab_zero_mag=photometer.AB_zero_mag)
+
+        return cls._passbands[band]
+
+    def weights_matrix(self, wavelengths, raster_hash=None):
+        """
+        Return a matrix of the weight of each pixel of a wavelength raster in each of our photometric bands.
+
+        :param wavelengths:
+            The wavelength raster (in A).
+
+        :type wavelengths:
+            np.ndarray
+
+        :param raster_hash:
+            The hash of the wavelength raster, if already known.
+
+        :type raster_hash:
+            str
+
+        :return:
+            2D array with shape (n_pixels, n_bands)
+        """
+
+        if raster_hash is None:
+            raster_hash = hash_numpy_array(wavelengths)
+
+        if raster_hash != self._weights_matrix_hash:
+            self._weights_matrix = np.transpose([passband.weights(raster=wavelengths, raster_hash=raster_hash)
+                                                 for passband in self.passbands])
+            self._weights_matrix_hash = raster_hash
+
+        return self._weights_matrix
+
+    def magnitudes(self, spectra):
+        """
+        Compute the AB magnitudes of a Spectrum, or of every spectrum in a SpectrumArray, in each of our bands. Fluxes
+        should be in erg/s/cm^2/A.
+
+        :param spectra:
+            The spectra whose magnitudes we should compute.
+
+        :type spectra:
+            Spectrum or SpectrumArray
+
+        :return:
+            Array of AB magnitudes, with shape (n_bands,) for a Spectrum or (n_spectra, n_bands) for a SpectrumArray.
+        """
+
+        assert isinstance(spectra, (Spectrum, SpectrumArray)), \
+            "Can only compute photometry of Spectrum or SpectrumArray objects."
+
+        weights = self.weights_matrix(wavelengths=spectra.wavelengths, raster_hash=spectra.raster_hash)
+        fluxes = np.dot(spectra.values, weights)
+
+        ab_zero_mags = np.asarray([passband.ab_zero_mag for passband in self.passbands])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return -2.5 * np.log10(fluxes) - ab_zero_mags
+
+    def magnitude(self, spectrum, band):
+        """
+        Compute the AB magnitude of a Spectrum in a single one of our bands.
+
+        :param spectrum:
+            The spectrum whose magnitude we should compute.
+
+        :type spectrum:
+            Spectrum
+
+        :param band:
+            Name of photometric band.
+
+        :type band:
+            str
+
+        :return:
+            float AB magnitude
+        """
+
+        assert band in self.bands, "Photometer was not set up to compute photometry in band <{}>".format(band)
+        return float(self.magnitudes(spectrum)[self.bands.index(band)])
+
+
+def _build_passband_weights(wavelengths, passband_wavelengths, transmission, photon_counting, name):
+    """
+    Builder for the weight of each pixel of a wavelength raster in a photometric passband, for use by the raster
+    cache.
+
+    :return:
+        Dictionary containing the pixel weights
+    """
+
+    # Weight of each pixel under the trapezium rule
+    pixel_widths = np.zeros_like(wavelengths, dtype=np.float64)
+    pixel_widths[1:] += np.diff(wavelengths) / 2
+    pixel_widths[:-1] += np.diff(wavelengths) / 2
+
+    transmission_on_raster = np.interp(x=wavelengths, xp=passband_wavelengths, fp=transmission, left=0., right=0.)
+
+    weights = pixel_widths * transmission_on_raster
+    if photon_counting:
+        weights *= wavelengths
+
+    normalisation = np.sum(weights)
+    if normalisation <= 0:
+        logger.warning("Passband <{}> does not overlap with wavelength raster".format(name))
+        return {"weights": np.zeros_like(weights) * np.nan}
+
+    return {"weights": weights / normalisation}
+
+
+# Passband weights are cheap to compute, so we don't save them
+raster_cache.register_builder(product="passband_weights", builder=_build_passband_weights, persist=False)
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+"""
+This module provides a cache of products derived from wavelength rasters, such as pixel edges, the break points
+between wavelength arms, or the basis functions of smooth spectra.
+
+Many spectra are sampled on the same small number of wavelength rasters, so each product only needs to be computed
+once per raster. Each consumer registers a builder function for the products it needs, and then fetches them from the
+cache by raster. Products are held in memory, and can optionally be saved to disk so that new processes working with
+a known raster do not need to recompute them.
+"""
+
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from os import path as os_path
+
+import numpy as np
+
+from .spectrum import hash_numpy_array
+
+logger = logging.getLogger(__name__)
+
+
+class RasterCache(object):
+    """
+    A cache of arrays derived from wavelength rasters, indexed by raster hash.
+
+    :ivar str cache_directory:
+        The directory in which products are saved to disk, or None to keep them only in memory.
+
+    :ivar int max_items:
+        The maximum number of products to keep in memory. The least recently used products are discarded first.
+    """
+
+    def __init__(self, cache_directory=None, max_items=256):
+        """
+        Instantiate a new cache of raster-derived products.
+
+        :param cache_directory:
+            The directory in which products are saved to disk, or None to keep them only in memory.
+
+        :type cache_directory:
+            str
+
+        :param max_items:
+            The maximum number of products to keep in memory.
+
+        :type max_items:
+            int
+        """
+
+        self.cache_directory = cache_directory
+        self.max_items = max_items
+        self._builders = {}
+        self._items = OrderedDict()
+
+    def set_cache_directory(self, cache_directory):
+        """
+        Set the directory in which products are saved to disk. This is created if it does not already exist.
+
+        :param cache_directory:
+            The directory in which products are saved to disk, or None to keep them only in memory.
+
+        :type cache_directory:
+            str
+
+        :return:
+            None
+        """
+
+        if cache_directory is not None and not os_path.exists(cache_directory):
+            os.makedirs(cache_directory)
+        self.cache_directory = cache_directory
+
+    def register_builder(self, product, builder, version=1, persist=True):
+        """
+        Register a function which builds a named product from a wavelength raster.
+
+        :param product:
+            The name of the product.
+
+        :type product:
+            str
+
+        :param builder:
+            A function which is called as builder(wavelengths, **parameters), and returns a dictionary of numpy arrays.
+
+        :type builder:
+            callable
+
+        :param version:
+            The version number of the builder. This should be incremented whenever the builder changes, so that
+            products saved to disk by older versions are not reused.
+
+        :type version:
+            int
+
+        :param persist:
+            Boolean flag indicating whether this product should be saved to disk, if a cache directory is set.
+            Products which are cheap to compute, or which are computed for many throwaway rasters, should not be.
+
+        :type persist:
+            bool
+
+        :return:
+            None
+        """
+
+        self._builders[product] = {
+            "builder": builder,
+            "version": version,
+            "persist": persist
+        }
+
+    @staticmethod
+    def _parameters_hash(product, version, parameters):
+        """
+        Produce a string hash of the parameters passed to a builder. Numpy arrays are represented by their hashes.
+
+        :return:
+            String hash
+        """
+
+        items = []
+        for key in sorted(parameters):
+            value = parameters[key]
+            if isinstance(value, np.ndarray):
+                value = (value.shape, str(value.dtype), hash_numpy_array(np.ascontiguousarray(value)))
+            items.append((key, value))
+
+        return hashlib.sha1(repr((product, version, items)).encode('utf-8')).hexdigest()
+
+    def fetch(self, product, wavelengths, raster_hash=None, **parameters):
+        """
+        Fetch a product derived from a wavelength raster, building it if it is not already in the cache.
+
+        :param product:
+            The name of the product, which must have been registered with <register_builder>.
+
+        :type product:
+            str
+
+        :param wavelengths:
+            The wavelength raster.
+
+        :type wavelengths:
+            np.ndarray
+
+        :param raster_hash:
+            The hash of the wavelength raster, if already known.
+
+        :type raster_hash:
+            str
+
+        :param parameters:
+            Any additional parameters to pass to the builder. Products built with different parameters are cached
+            separately.
+
+        :return:
+            Dictionary of read-only numpy arrays
+        """
+
+        assert product in self._builders, "No builder registered for product <{}>".format(product)
+        builder = self._builders[product]
+
+        if raster_hash is None:
+            raster_hash = hash_numpy_array(np.ascontiguousarray(wavelengths))
+
+        key = (product, raster_hash, self._parameters_hash(product, builder['version'], parameters))
+
+        # Look for the product in memory
+        item = self._items.pop(key, None)
+
+        # Look for the product on disk
+        filename = None
+        if item is None and builder['persist'] and self.cache_directory is not None:
+            filename = os_path.join(self.cache_directory, "{}_{}_{}.npz".format(*key))
+            if os_path.exists(filename):
+                try:
+                    with np.load(filename) as f:
+                        item = dict(f)
+                except (IOError, ValueError):
+                    logger.warning("Could not read cached product <{}>; rebuilding it".format(filename))
+
+        # Build the product
+        if item is None:
+            item = builder['builder'](wavelengths, **parameters)
+
+            if filename is not None:
+                self._write(filename=filename, item=item)
+
+        for value in item.values():
+            value.flags.writeable = False
+
+        # Keep the most recently used products at the end of the cache, and discard the oldest ones
+        self._items[key] = item
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+        return item
+
+    @staticmethod
+    def _write(filename, item):
+        """
+        Save a product to disk. We write to a temporary file first, so that other processes never see a partially
+        written product.
+
+        :return:
+            None
+        """
+
+        temporary_filename = "{}.{}.tmp".format(filename, os.getpid())
+        try:
+            with open(temporary_filename, "wb") as f:
+                np.savez(f, **item)
+            os.replace(temporary_filename, filename)
+        except (IOError, OSError):
+            logger.warning("Could not write cached product <{}>".format(filename))
+
+    def clear(self):
+        """
+        Discard all products held in memory. Products saved to disk are not deleted.
+
+        :return:
+            None
+        """
+
+        self._items.clear()
+
+
+# The cache of raster-derived products shared by all of 4GP
+raster_cache = RasterCache()
@@ -307,7 +307,8 @@ class Spectrum(object):
 
     def photometry(self, band):
         """
-        Evaluate photometry in a named photometric band, using pyphot.
+        Evaluate photometry in a named photometric band. Passbands are loaded from pyphot once per process, and
+        cached for each wavelength raster.
 
         :param band:
             Name of photometric band, as recognised by pyphot. See
@@ -320,21 +321,8 @@ class Spectrum(object):
             float AB magnitude
         """
 
-        import pyphot, tables
-        lib = pyphot.get_library()
-
-        try:
-            photometer = lib[band]
-        except tables.exceptions.NoSuchNodeError:
-            logger.error("Could not find photometric band <{}>".format(band))
-            raise
-
-        wavelengths = self.wavelengths * pyphot.unit['AA']
-        fluxes = self.values * pyphot.unit['erg/s/cm**2/AA']
-
-        flux = photometer.get_flux(slamb=wavelengths, sflux=fluxes)
-        mag = -2.5 * np.log10(flux) - photometer.AB_zero_mag
-        return mag
+        from .photometry import Photometer
+        return Photometer(bands=(band,)).magnitude(spectrum=self, band=band)
 
     def apply_redshift(self, z):
         """
@@ -267,6 +267,24 @@ class SpectrumArray(object):
         """
         return self.metadata_list[index]
 
+    def photometry(self, band):
+        """
+        Evaluate photometry for every spectrum in this SpectrumArray in a named photometric band.
+
+        :param band:
+            Name of photometric band, as recognised by pyphot. See
+            <http://mfouesneau.github.io/docs/pyphot/libcontent.html> for a list of recognised bands.
+
+        :type band:
+            str
+
+        :return:
+            np.ndarray of AB magnitudes
+        """
+
+        from .photometry import Photometer
+        return Photometer(bands=(band,)).magnitudes(spectra=self)[:, 0]
+
     def extract_item(self, index):
         """
         Extract a single spectrum from a SpectrumArray. This creates a numpy view of the spectrum, without copying the
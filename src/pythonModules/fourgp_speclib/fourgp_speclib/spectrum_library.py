@@ -159,6 +159,28 @@ class SpectrumLibrary(object):
 
         raise NotImplementedError("The insert method must be implemented by each SpectrumLibrary implementation.")
 
+    def delete(self, ids=None, filenames=None):
+        """
+        Delete some spectra from this spectrum library, together with their metadata.
+
+        :param ids:
+            List of the integer ids of the spectra to delete, or None to select them by filename.
+
+        :type ids:
+            List of int, or None
+
+        :param filenames:
+            List of the filenames of the spectra to delete, or None to select them by integer id.
+
+        :type filenames:
+            List of str, or None
+
+        :return:
+            None
+        """
+
+        raise NotImplementedError("The delete method must be implemented by each SpectrumLibrary implementation.")
+
     def import_from(self, other, overwrite=False, **kwargs):
         """
         Search for spectra within another SpectrumLibrary, and import all matching spectra into this library.
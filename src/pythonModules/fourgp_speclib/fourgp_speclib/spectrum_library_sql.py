@@ -793,6 +793,48 @@ REPLACE INTO spectra (filename, originId, libraryId, importTime)
         # Commit changes into database
         self._db.commit()
 
+    @requires_ids_or_filenames
+    def delete(self, ids=None, filenames=None):
+        """
+        Delete some spectra from this spectrum library, together with their metadata.
+
+        :param ids:
+            List of the integer ids of the spectra to delete, or None to select them by filename.
+
+        :type ids:
+            List of int, or None
+
+        :param filenames:
+            List of the filenames of the spectra to delete, or None to select them by integer id.
+
+        :type filenames:
+            List of str, or None
+
+        :return:
+            None
+        """
+
+        # Look up both the ids and filenames of the spectra
+        if filenames is not None:
+            ids = self._filenames_to_ids(filenames=filenames)
+        else:
+            filenames = self._ids_to_filenames(ids=ids)
+
+        # Delete cached spectrum count
+        if os.path.isfile(os_path.join(self._path, "spectrum_count")):
+            os.unlink(os_path.join(self._path, "spectrum_count"))
+
+        # Delete database entries
+        query_data = [(self._library_id, id_no) for id_no in ids]
+        self._parameterised_query_many("DELETE FROM spectrum_metadata WHERE libraryId=? AND specId=?;", query_data)
+        self._parameterised_query_many("DELETE FROM spectra WHERE libraryId=? AND specId=?;", query_data)
+        self._db.commit()
+
+        # Delete spectra
+        for filename in filenames:
+            if os.path.isfile(os_path.join(self._path, filename)):
+                os.unlink(os_path.join(self._path, filename))
+
     def _parameterised_query(self, sql, parameters=None):
         raise NotImplementedError
 
@@ -9,11 +9,13 @@ This is useful for crudely modelling continuum. To produce a continuum-normalise
 """
 
 import numpy as np
-from math import pi, sin, cos, acos
+from math import pi
 import logging
 from scipy.optimize import least_squares
 
-from .spectrum import Spectrum
+from .spectrum import Spectrum, hash_numpy_array
+from .spectrum_array import SpectrumArray
+from .raster_cache import raster_cache
 
 logger = logging.getLogger(__name__)
 
@@ -71,6 +73,9 @@ class SpectrumSmoothFactory:
 
         self._metadata = metadata
 
+        # Orthonormal basis used by the batched linear fitters. This is computed the first time it is needed.
+        self._orthonormal_basis = None
+
     def fit_to_continuum_via_template(self, other, template, lambda_min_norm=None, lambda_max_norm=None):
         """
         Fit a smooth function to the continuum in the spectrum <other>. The spectrum <template> is an absorption line
@@ -226,6 +231,264 @@ class SpectrumSmoothFactory:
         output.coefficients = tuple(result.x)
         return output
 
+    def _design_matrix(self):
+        """
+        Return a QR decomposition of the design matrix of this factory's family of functions, evaluated on its
+        wavelength raster. The design matrix is only computed once per factory, and is reused for all subsequent fits.
+
+        We fit coefficients in the orthonormal basis Q, which is much better conditioned than the raw basis (for
+        example, powers of wavelength), and then transform them back into coefficients of the raw basis using R.
+
+        :return:
+            Tuple (Q, R), where Q has shape (n_pixels, terms) and R has shape (terms, terms).
+        """
+
+        if self._orthonormal_basis is None:
+            basis = self._function_family.basis_matrix(raster=self._wavelengths, terms=self._terms)
+            self._orthonormal_basis = np.linalg.qr(basis)
+        return self._orthonormal_basis
+
+    def _fit_linear_batch(self, values, value_errors, templates, include, sigma_clip, clip_iterations):
+        """
+        Fit the coefficients of smooth functions to many spectra at once, using weighted linear least squares. Every
+        family of smooth functions we implement is linear in its coefficients, so we can solve the normal equations
+        for all of the spectra in a single operation, rather than calling a non-linear optimiser for each spectrum.
+
+        We minimise, for each spectrum i:
+
+        sum_j ((values[i,j] - templates[i,j] * function_i(wavelength[j])) / value_errors[i,j]) ** 2
+
+        :param values:
+            2D array of the values of the spectra we are fitting, with shape (n_spectra, n_pixels).
+
+        :param value_errors:
+            2D array of the errors in <values>.
+
+        :param templates:
+            2D array of the absorption line profiles by which the smooth function is multiplied.
+
+        :param include:
+            2D boolean array indicating which pixels we may use in the fit.
+
+        :param sigma_clip:
+            If not None, iteratively reject pixels which lie more than this many standard deviations from the fit.
+
+        :param clip_iterations:
+            The maximum number of iterations of sigma clipping to perform.
+
+        :return:
+            2D array of coefficients, with shape (n_spectra, terms). Spectra which could not be fitted have
+            coefficients of NaN.
+        """
+
+        q, r = self._design_matrix()
+        terms = q.shape[1]
+
+        # Exclude any pixels which are masked out or not finite
+        with np.errstate(invalid='ignore'):
+            good = np.isfinite(values) & np.isfinite(templates) & np.isfinite(value_errors) & (value_errors > 0)
+        good &= include
+
+        # Weight of each pixel in the fit, which is zero for any pixel we are excluding
+        inverse_variance = np.zeros(values.shape)
+        np.divide(1., value_errors * value_errors, out=inverse_variance, where=good)
+        values = np.where(good, values, 0.)
+        templates = np.where(good, templates, 0.)
+
+        # Products of pairs of basis functions at each pixel, so that the normal matrices of all the spectra can be
+        # computed with a single matrix product
+        basis_products = (q[:, :, np.newaxis] * q[:, np.newaxis, :]).reshape((q.shape[0], terms * terms))
+
+        coefficients_orthonormal = np.zeros((values.shape[0], terms))
+        for iteration in range(clip_iterations + 1):
+            weighted_templates = inverse_variance * templates
+            normal_matrices = np.dot(weighted_templates * templates, basis_products).reshape((-1, terms, terms))
+            normal_vectors = np.dot(weighted_templates * values, q)
+
+            # Use the pseudo-inverse so that spectra with too few good pixels do not raise an exception
+            coefficients_orthonormal = np.einsum('ijk,ik->ij', np.linalg.pinv(normal_matrices), normal_vectors)
+
+            if sigma_clip is None:
+                break
+
+            # Reject pixels which deviate from the fit by more than <sigma_clip> times the RMS deviation
+            residuals = (values - templates * np.dot(coefficients_orthonormal, q.T)) * np.sqrt(inverse_variance)
+            pixel_count = np.maximum(np.sum(good, axis=1), 1)
+            rms = np.sqrt(np.sum(residuals * residuals, axis=1) / pixel_count)
+            rejected = good & (np.abs(residuals) > sigma_clip * rms[:, np.newaxis])
+
+            if not np.any(rejected):
+                break
+            good &= ~rejected
+            inverse_variance[rejected] = 0
+
+        # Transform coefficients back from the orthonormal basis into the basis of the function family
+        coefficients = np.linalg.solve(r, coefficients_orthonormal.T).T
+        coefficients[np.sum(good, axis=1) < terms] = np.nan
+        return coefficients
+
+    def fit_to_continuum_via_template_batch(self, others, templates, mask=None, sigma_clip=None, clip_iterations=5):
+        """
+        Fit smooth functions to the continuum of every spectrum in the SpectrumArray <others>, all at once. This is the
+        batched equivalent of <fit_to_continuum_via_template>, and is much faster when fitting many spectra which are
+        sampled on a common raster.
+
+        As in <fit_to_continuum_via_template>, pixels are excluded if they are masked out either in the spectrum being
+        fitted, or in its template. SpectrumArray objects do not carry masks, so the masks of the spectra in <others>
+        are passed in <mask>, and only templates supplied as a single Spectrum have a mask.
+
+        :param others:
+            The spectra to fit smooth functions to.
+
+        :type others:
+            SpectrumArray
+
+        :param templates:
+            The absorption line profiles superimposed on the continuum in <others>. This may either be a
+            SpectrumArray containing one template for each spectrum in <others>, or a single Spectrum which is used as
+            the template for all of them.
+
+        :type templates:
+            SpectrumArray or Spectrum
+
+        :param mask:
+            A numpy array listing true/false for each pixel, telling us which ones are good data in <others>. This may
+            either be a 1D array shared by all the spectra, or a 2D array with one row per spectrum. If None, all
+            pixels are used.
+
+        :type mask:
+            np.ndarray
+
+        :param sigma_clip:
+            If not None, iteratively reject pixels which lie more than this many standard deviations from the fit.
+
+        :type sigma_clip:
+            float
+
+        :param clip_iterations:
+            The maximum number of iterations of sigma clipping to perform.
+
+        :type clip_iterations:
+            int
+
+        :return:
+            2D array of coefficients, with shape (n_spectra, terms). Spectra which could not be fitted have
+            coefficients of NaN.
+        """
+
+        assert isinstance(others, SpectrumArray), \
+            "The fit_to_continuum_via_template_batch method requires a SpectrumArray to fit functions to. " \
+            "Supplied object has type {}.".format(type(others))
+
+        assert isinstance(templates, (Spectrum, SpectrumArray)), \
+            "The fit_to_continuum_via_template_batch method requires templates supplied as a Spectrum or a " \
+            "SpectrumArray. Supplied object has type {}.".format(type(templates))
+
+        assert others.raster_hash == templates.raster_hash, \
+            "The spectra passed to the fit_to_continuum_via_template_batch() method must be sampled on the same raster."
+
+        assert others.raster_hash == hash_numpy_array(self._wavelengths), \
+            "The spectra passed to the fit_to_continuum_via_template_batch() method must be sampled on the same " \
+            "raster as the factory."
+
+        template_values = np.broadcast_to(templates.values, others.values.shape)
+        include = np.ones_like(others.values, dtype=bool)
+
+        if mask is not None:
+            assert isinstance(mask, np.ndarray), \
+                "The mask supplied to fit_to_continuum_via_template_batch should be a numpy array. " \
+                "Supplied object has type {}.".format(type(mask))
+            include = include * mask.astype(bool)
+
+        if isinstance(templates, Spectrum):
+            include = include * templates.mask
+
+        return self._fit_linear_batch(values=others.values,
+                                      value_errors=others.value_errors,
+                                      templates=template_values,
+                                      include=include,
+                                      sigma_clip=sigma_clip,
+                                      clip_iterations=clip_iterations)
+
+    def fit_to_continuum_via_mask_batch(self, others, mask=None, sigma_clip=None, clip_iterations=5):
+        """
+        Fit smooth functions to the continuum of every spectrum in the SpectrumArray <others>, all at once. This is the
+        batched equivalent of <fit_to_continuum_via_mask>, and is much faster when fitting many spectra which are
+        sampled on a common raster.
+
+        :param others:
+            The spectra to fit smooth functions to.
+
+        :type others:
+            SpectrumArray
+
+        :param mask:
+            A numpy array listing true/false for each pixel, telling us which ones are continuum that we should fit.
+            This may either be a 1D array shared by all the spectra, or a 2D array with one row per spectrum. If None,
+            all pixels are used.
+
+        :type mask:
+            np.ndarray
+
+        :param sigma_clip:
+            If not None, iteratively reject pixels which lie more than this many standard deviations from the fit.
+
+        :type sigma_clip:
+            float
+
+        :param clip_iterations:
+            The maximum number of iterations of sigma clipping to perform.
+
+        :type clip_iterations:
+            int
+
+        :return:
+            2D array of coefficients, with shape (n_spectra, terms). Spectra which could not be fitted have
+            coefficients of NaN.
+        """
+
+        assert isinstance(others, SpectrumArray), \
+            "The fit_to_continuum_via_mask_batch method requires a SpectrumArray to fit functions to. " \
+            "Supplied object has type {}.".format(type(others))
+
+        assert others.raster_hash == hash_numpy_array(self._wavelengths), \
+            "The spectra passed to the fit_to_continuum_via_mask_batch() method must be sampled on the same raster " \
+            "as the factory."
+
+        if mask is None:
+            mask = np.ones_like(self._wavelengths, dtype=bool)
+
+        assert isinstance(mask, np.ndarray), \
+            "The mask supplied to fit_to_continuum_via_mask_batch should be a numpy array. " \
+            "Supplied object has type {}.".format(type(mask))
+
+        include = np.broadcast_to(mask.astype(bool), others.values.shape)
+
+        return self._fit_linear_batch(values=others.values,
+                                      value_errors=others.value_errors,
+                                      templates=np.ones_like(others.values),
+                                      include=include,
+                                      sigma_clip=sigma_clip,
+                                      clip_iterations=clip_iterations)
+
+    def evaluate_batch(self, coefficients):
+        """
+        Evaluate the smooth functions described by a 2D array of coefficients, as returned by the batched fitting
+        methods, at every point on this factory's wavelength raster.
+
+        :param coefficients:
+            2D array of coefficients, with shape (n_spectra, terms).
+
+        :type coefficients:
+            np.ndarray
+
+        :return:
+            2D array of values, with shape (n_spectra, n_pixels).
+        """
+
+        basis = self._function_family.basis_matrix(raster=self._wavelengths, terms=self._terms)
+        return np.dot(np.atleast_2d(coefficients), basis.T)
+
 
 class SpectrumSmooth(Spectrum):
     """
@@ -353,12 +616,51 @@ class SpectrumSmooth(Spectrum):
 
     def evaluate_function(self, raster, coefficients):
         """
-        Evaluate function at every point on wavelength raster.
+        Evaluate function at every point on wavelength raster. The basis functions of this family are evaluated once
+        per raster and cached, so this is a single matrix-vector product.
 
         :return:
-            None
+            np.ndarray
+        """
+        return np.dot(self.basis_matrix(raster=raster, terms=self._terms),
+                      np.asarray(coefficients, dtype=np.float64))
+
+    @classmethod
+    def basis_matrix(cls, raster, terms):
+        """
+        Evaluate each of the basis functions of this family of smooth functions at every point on a wavelength raster.
+        A smooth function is the sum of these basis functions, weighted by its coefficients.
+
+        The output is held in the raster cache, and shared between all instances of this family which are sampled on
+        the same raster. It is read-only.
+
+        :param raster:
+            The wavelength raster to evaluate the basis functions on.
+
+        :type raster:
+            np.ndarray
+
+        :param terms:
+            The number of basis functions (coefficients) to evaluate.
+
+        :type terms:
+            int
+
+        :return:
+            2D array with shape (len(raster), terms)
         """
-        raise NotImplementedError("The evaluate_function method must be implemented by a subclasses.")
+        raster = np.asarray(raster, dtype=np.float64)
+        return raster_cache.fetch("smooth_basis", raster, family=cls, terms=terms)["basis"]
+
+    @classmethod
+    def _build_basis_matrix(cls, raster, terms):
+        """
+        Evaluate each of the basis functions of this family of smooth functions at every point on a wavelength raster.
+
+        :return:
+            2D array with shape (len(raster), terms)
+        """
+        raise NotImplementedError("The _build_basis_matrix method must be implemented by a subclasses.")
 
 
 class SpectrumPolynomial(SpectrumSmooth):
@@ -366,22 +668,15 @@ class SpectrumPolynomial(SpectrumSmooth):
     A class implementing a polynomial spectrum.
     """
 
-    def evaluate_function(self, raster, coefficients):
+    @classmethod
+    def _build_basis_matrix(cls, raster, terms):
         """
-        Evaluate polynomial at every point on wavelength raster.
+        Evaluate the powers of wavelength 1, x, x^2 ... at every point on wavelength raster.
 
         :return:
-            None
+            2D array with shape (len(raster), terms)
         """
-        output = np.zeros_like(raster, dtype=np.float64)
-        coefficients = np.asarray(coefficients, dtype=np.float64)
-
-        # Express polynomial as ((a_2 * x) + a_1)*x) + a_0
-        for order in range(1, self._terms + 1):
-            output *= raster
-            output += coefficients[-order]
-
-        return output
+        return np.vander(raster, N=terms, increasing=True)
 
 
 class SpectrumChebyshev(SpectrumSmooth):
@@ -389,26 +684,23 @@ class SpectrumChebyshev(SpectrumSmooth):
     A class implementing a Chebyshev polynomial spectrum.
     """
 
-    def evaluate_function(self, raster, coefficients):
+    @classmethod
+    def _build_basis_matrix(cls, raster, terms):
         """
-        Evaluate Chebyshev polynomial at every point on wavelength raster.
+        Evaluate the Chebyshev polynomials T_1, T_2 ... at every point on wavelength raster.
 
         :return:
-            None
+            2D array with shape (len(raster), terms)
         """
         x_min = raster[0]
         x_max = raster[-1]
 
         raster_normed = 2 * (raster - x_min) / (x_max - x_min) - 1  # Projects raster into range -1 to 1
-
-        output = np.zeros_like(raster, dtype=np.float64)
-        coefficients = np.asarray(coefficients, dtype=np.float64)
+        angle = np.arccos(np.clip(raster_normed, -1, 1))
 
         # Trigonometric definition of Chebyshev polynomial, https://en.wikipedia.org/wiki/Chebyshev_polynomials
-        for order in range(1, self._terms + 1):
-            output += coefficients[order - 1] * cos(order * acos(raster_normed))
-
-        return output
+        orders = np.arange(1, terms + 1)
+        return np.cos(angle[:, np.newaxis] * orders[np.newaxis, :])
 
 
 class SpectrumSinesAndCosines(SpectrumSmooth):
@@ -416,24 +708,35 @@ class SpectrumSinesAndCosines(SpectrumSmooth):
     A class implementing a spectrum comprising sines and cosines.
     """
 
-    def evaluate_function(self, raster, coefficients):
+    @classmethod
+    def _build_basis_matrix(cls, raster, terms):
         """
-        Evaluate spectrum comprising sines and cosines at every point on wavelength raster.
+        Evaluate the functions 1, sin(x), cos(x), sin(2x) ... at every point on wavelength raster.
 
         :return:
-            None
+            2D array with shape (len(raster), terms)
         """
         x_min = raster[0]
         x_max = raster[-1]
 
         raster_normed = 2 * pi * (raster - x_min) / (x_max - x_min)  # Projects raster into range 0 to 2pi
 
-        output = np.zeros_like(raster, dtype=np.float64)
-        coefficients = np.asarray(coefficients, dtype=np.float64)
+        orders = np.arange(1, terms + 1)
+        parity = orders % 2  # ... 1  0  1  0  1  0  1
+        scale = orders // 2  # 0  1  1  2  2  3  3
+        phases = scale[np.newaxis, :] * raster_normed[:, np.newaxis]
+        return np.where(parity[np.newaxis, :] == 1, np.cos(phases), np.sin(phases))
 
-        for order in range(1, self._terms + 1):
-            parity = order % 2  # ... 1  0  1  0  1  0  1
-            scale = int(order / 2)  # 0  1  1  2  2  3  3
-            output += coefficients[order - 1] * (cos if parity else sin)(scale * raster_normed)
 
-        return output
+def _build_smooth_basis(wavelengths, family, terms):
+    """
+    Builder for the basis matrices of smooth function families, for use by the raster cache.
+
+    :return:
+        Dictionary containing the basis matrix
+    """
+    return {"basis": family._build_basis_matrix(raster=wavelengths, terms=terms)}
+
+
+# Basis matrices are cheap to build, and are built for many throwaway rasters during fitting, so we don't save them
+raster_cache.register_builder(product="smooth_basis", builder=_build_smooth_basis, persist=False)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Unit tests for the Photometer class
+"""
+
+import unittest
+import numpy as np
+import fourgp_speclib
+
+
+class TestPhotometer(unittest.TestCase):
+    def setUp(self):
+        """
+        Create a top-hat passband, and a SpectrumArray of sources with flat spectra in f_nu.
+        """
+
+        passband_wavelengths = np.linspace(5000, 6000, 101)
+        passband_transmission = ((passband_wavelengths > 5100) * (passband_wavelengths < 5900)).astype(np.float64)
+        self._passband = fourgp_speclib.Passband(name="unit_test_top_hat",
+                                                 wavelengths=passband_wavelengths,
+                                                 transmission=passband_transmission)
+        fourgp_speclib.Photometer.register_passband(self._passband)
+
+        self._magnitudes = np.asarray([10., 12.5, 15.])
+        self._raster = np.linspace(4000, 7000, 3001)
+        c = 2.99792458e18  # A/s
+        values = np.asarray([3631e-23 * c / self._raster ** 2 * 10 ** (-0.4 * mag) for mag in self._magnitudes])
+        self._spectra = fourgp_speclib.SpectrumArray(wavelengths=self._raster,
+                                                     values=values,
+                                                     value_errors=np.zeros_like(values),
+                                                     metadata_list=[{}] * len(self._magnitudes))
+
+    def test_magnitudes_of_array(self):
+        photometer = fourgp_speclib.Photometer(bands=("unit_test_top_hat",))
+        magnitudes = photometer.magnitudes(spectra=self._spectra)
+        self.assertEqual(magnitudes.shape, (len(self._magnitudes), 1))
+        self.assertLess(np.max(np.abs(magnitudes[:, 0] - self._magnitudes)), 1e-3)
+
+    def test_magnitude_of_spectrum(self):
+        magnitude = self._spectra.extract_item(1).photometry("unit_test_top_hat")
+        self.assertLess(abs(magnitude - self._magnitudes[1]), 1e-3)
+
+    def test_weights_cached(self):
+        photometer = fourgp_speclib.Photometer(bands=("unit_test_top_hat",))
+        self.assertIs(photometer.weights_matrix(wavelengths=self._raster),
+                      photometer.weights_matrix(wavelengths=self._raster))
+
+    def test_reregistered_passband(self):
+        photometer = fourgp_speclib.Photometer(bands=("unit_test_top_hat",))
+        weights = photometer.weights_matrix(wavelengths=self._raster).copy()
+
+        # Registering a new passband with the same name discards the weights of the old one
+        passband = fourgp_speclib.Passband(name="unit_test_top_hat",
+                                           wavelengths=self._passband.wavelengths,
+                                           transmission=(self._passband.wavelengths < 5500).astype(np.float64))
+        fourgp_speclib.Photometer.register_passband(passband)
+        new_weights = fourgp_speclib.Photometer(bands=("unit_test_top_hat",)).weights_matrix(wavelengths=self._raster)
+        self.assertTrue(np.array_equal(new_weights[:, 0], passband.weights(raster=self._raster)))
+        self.assertFalse(np.allclose(new_weights, weights))
+
+    def test_weights_cache_bounded(self):
+        photometer = fourgp_speclib.Photometer(bands=("unit_test_top_hat",))
+        for offset in range(fourgp_speclib.raster_cache.max_items + 10):
+            photometer.magnitudes(spectra=fourgp_speclib.Spectrum(wavelengths=self._raster + offset,
+                                                                  values=np.ones_like(self._raster),
+                                                                  value_errors=np.zeros_like(self._raster)))
+        self.assertLessEqual(len(fourgp_speclib.raster_cache._items), fourgp_speclib.raster_cache.max_items)
+
+
+# Run tests if we are run from command line
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Unit tests for the RasterCache class
+"""
+
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import fourgp_speclib
+
+
+class TestRasterCache(unittest.TestCase):
+    def setUp(self):
+        """
+        Create a RasterCache with a builder which counts how many times it is called.
+        """
+
+        self._build_count = 0
+        self._raster = np.linspace(4000, 5000, 101)
+        self._directory = tempfile.mkdtemp()
+        self._cache = fourgp_speclib.RasterCache(cache_directory=self._directory)
+        self._cache.register_builder(product="doubled", builder=self._build_doubled)
+
+    def _build_doubled(self, wavelengths, factor=2):
+        self._build_count += 1
+        return {"doubled": wavelengths * factor}
+
+    def test_product_built_once(self):
+        first = self._cache.fetch("doubled", self._raster)
+        second = self._cache.fetch("doubled", self._raster.copy())
+        self.assertIs(first["doubled"], second["doubled"])
+        self.assertEqual(self._build_count, 1)
+
+    def test_parameters_cached_separately(self):
+        self._cache.fetch("doubled", self._raster)
+        tripled = self._cache.fetch("doubled", self._raster, factor=3)
+        self.assertEqual(self._build_count, 2)
+        self.assertTrue(np.array_equal(tripled["doubled"], self._raster * 3))
+
+    def test_products_read_only(self):
+        product = self._cache.fetch("doubled", self._raster)
+        with self.assertRaises(ValueError):
+            product["doubled"][0] = 0
+
+    def test_product_persisted(self):
+        self._cache.fetch("doubled", self._raster)
+        new_cache = fourgp_speclib.RasterCache(cache_directory=self._directory)
+        new_cache.register_builder(product="doubled", builder=self._build_doubled)
+        product = new_cache.fetch("doubled", self._raster)
+        self.assertEqual(self._build_count, 1)
+        self.assertTrue(np.array_equal(product["doubled"], self._raster * 2))
+
+    def tearDown(self):
+        """
+        Remove the cache directory.
+        """
+        shutil.rmtree(self._directory)
+
+
+# Run tests if we are run from command line
+if __name__ == '__main__':
+    unittest.main()
@@ -51,6 +51,30 @@ class TestSpectrumLibrarySQL(object):
         # Check that we got back the same spectrum we put in
         self.assertEqual(my_spectrum, input_spectrum)
 
+    def test_delete(self):
+        """
+        Check that we can delete spectra from the SpectrumLibrary, together with their metadata.
+        """
+
+        # Insert three random spectra into SpectrumLibrary
+        size = 50
+        for x in range(3):
+            input_spectrum = fourgp_speclib.Spectrum(wavelengths=np.arange(size),
+                                                     values=np.random.random(size),
+                                                     value_errors=np.random.random(size),
+                                                     metadata={"origin": "unit-test",
+                                                               "x_value": x})
+            self._lib.insert(input_spectrum, "x_{}".format(x))
+
+        # Delete the spectrum with x_value 1
+        self._lib.delete(ids=[self._lib.search(x_value=1)[0]['specId']])
+
+        # Check that only the other two spectra remain
+        my_spectra = self._lib.search()
+        metadata = self._lib.get_metadata(ids=[item['specId'] for item in my_spectra])
+        self.assertEqual(sorted(item['x_value'] for item in metadata), [0, 2])
+        self.assertEqual(self._lib.search(x_value=1), [])
+
     def test_search_illegal_metadata(self):
         """
         Check that we can search for spectra on a simple metadata constraint.
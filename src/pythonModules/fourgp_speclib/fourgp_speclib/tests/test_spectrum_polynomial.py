@@ -57,6 +57,82 @@ class TestSpectrumPolynomial(unittest.TestCase):
         coefficients_expected = np.asarray([0, 1, 0], dtype=np.float64)
         self.assertLess(np.max(np.abs(np.asarray(polynomial.coefficients) - coefficients_expected)), 0.1)
 
+    def test_fitting_batch_via_template(self):
+        values = np.asarray([self._observed_values * 2 + 3, self._observed_values ** 2])
+        spectra = fourgp_speclib.SpectrumArray(wavelengths=self._observed_raster,
+                                               values=values,
+                                               value_errors=np.ones_like(values),
+                                               metadata_list=[{}, {}])
+        coefficients = self._polynomial.fit_to_continuum_via_template_batch(others=spectra,
+                                                                            templates=self._absorption)
+        coefficients_expected = np.asarray([[3, 2, 0], [0, 0, 1]], dtype=np.float64)
+        self.assertLess(np.max(np.abs(coefficients - coefficients_expected)), 1e-6)
+
+    def test_fitting_batch_matches_single(self):
+        values = np.asarray([self._observed_values + np.sin(self._observed_values)])
+        spectra = fourgp_speclib.SpectrumArray(wavelengths=self._observed_raster,
+                                               values=values,
+                                               value_errors=np.ones_like(values),
+                                               metadata_list=[{}])
+        polynomial = self._polynomial.fit_to_continuum_via_mask(other=spectra.extract_item(0),
+                                                                mask=np.ones(self._size, dtype=bool))
+        coefficients = self._polynomial.fit_to_continuum_via_mask_batch(others=spectra)
+        self.assertLess(np.max(np.abs(coefficients[0] - np.asarray(polynomial.coefficients))), 1e-4)
+
+    def test_fitting_batch_via_template_masked(self):
+        random_generator = np.random.RandomState(0)
+        template_values = 1 - 0.5 * random_generator.random_sample(self._size)
+        template_values[20:25] = np.nan
+        template = fourgp_speclib.Spectrum(wavelengths=self._observed_raster,
+                                           values=template_values,
+                                           value_errors=np.zeros(self._size))
+        template.mask[30:35] = False
+
+        # Masked pixels in both the spectra and the template contain bad data, which must not affect the fit
+        values = np.asarray([(3 + 2 * self._observed_values) * template_values,
+                             (1 + self._observed_values ** 2) * template_values])
+        values += random_generator.standard_normal(values.shape)
+        values[:, 20:25] = 0
+        values[:, 30:35] = 1e6
+        values[0, 5:10] = -1e6
+        values[1, 40:45] = 1e6
+        mask = np.ones_like(values, dtype=bool)
+        mask[0, 5:10] = False
+        mask[1, 40:45] = False
+        spectra = fourgp_speclib.SpectrumArray(wavelengths=self._observed_raster,
+                                               values=values,
+                                               value_errors=np.ones_like(values),
+                                               metadata_list=[{}, {}])
+
+        coefficients = self._polynomial.fit_to_continuum_via_template_batch(others=spectra, templates=template,
+                                                                            mask=mask)
+        for index in range(values.shape[0]):
+            other = spectra.extract_item(index)
+            other.mask = mask[index]
+            polynomial = self._polynomial.fit_to_continuum_via_template(other=other, template=template)
+            self.assertLess(np.max(np.abs(coefficients[index] - np.asarray(polynomial.coefficients)) /
+                                   np.maximum(np.abs(coefficients[index]), 1)), 1e-4)
+
+    def test_fitting_batch_sigma_clip(self):
+        values = np.asarray([np.ones(self._size) * 5])
+        values[0, 10] = 1000
+        spectra = fourgp_speclib.SpectrumArray(wavelengths=self._observed_raster,
+                                               values=values,
+                                               value_errors=np.ones_like(values),
+                                               metadata_list=[{}])
+        coefficients = self._polynomial.fit_to_continuum_via_mask_batch(others=spectra, sigma_clip=3)
+        self.assertLess(np.max(np.abs(coefficients[0] - np.asarray([5, 0, 0]))), 1e-6)
+
+    def test_basis_matrix_shared(self):
+        polynomial_1 = fourgp_speclib.SpectrumPolynomial(wavelengths=self._observed_raster, terms=3,
+                                                         coefficients=(1, 2, 3))
+        polynomial_2 = fourgp_speclib.SpectrumPolynomial(wavelengths=self._observed_raster.copy(), terms=3,
+                                                         coefficients=(3, 2, 1))
+        self.assertIs(polynomial_1.basis_matrix(raster=polynomial_1.wavelengths, terms=3),
+                      polynomial_2.basis_matrix(raster=polynomial_2.wavelengths, terms=3))
+        values_expected = 1 + 2 * self._observed_raster + 3 * self._observed_raster ** 2
+        self.assertLess(np.max(np.abs(polynomial_1.values - values_expected)), 1e-6)
+
     def tearDown(self):
         """
         Tear down Spectrum objects.